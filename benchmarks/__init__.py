@@ -0,0 +1,5 @@
+'''
+Benchmarks for doppelganger, run from the top of the repository with
+`python -m benchmarks.<name> --help`.  They run on synthetic data so that
+they don't need the real directory, dlib models, or any privacy review.
+'''
@@ -0,0 +1,111 @@
+'''
+Compares the memory that each way of holding the employees in memory takes:
+every db.Entry from get_all, pictures and all, the EncodingMatrix built
+from entries, and the EncodingMatrix streamed from the database.  Also
+compares the ways of keeping just the names.
+
+    python -m benchmarks.corpus --size 100000 --picture-size 20000
+'''
+
+import argparse
+import os
+import shutil
+import tempfile
+import tracemalloc
+
+import numpy
+
+from doppelganger import (
+    db,
+    search,
+)
+
+from . import synthetic
+
+
+def measure(build):
+    '''
+    Returns what build returns, how many bytes it kept, and the most it
+    used at once while building.  Tracing slows building down too much for
+    its time to mean anything, so that's not measured.
+    '''
+    tracemalloc.start()
+    built = build()
+    (kept, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return built, kept, peak
+
+
+def layouts(database):
+    '''
+    A list of (name, function building it) for each layout
+    '''
+    return [
+        ('get_all', database.get_all),
+        ('from_entries', lambda: search.EncodingMatrix.from_entries(
+            database.entries_without_pictures()
+        )),
+        ('from_database', lambda: search.EncodingMatrix.from_database(database)),
+    ]
+
+
+def name_layouts(names):
+    '''
+    A list of (name, function building it) for each way of keeping names
+    '''
+    return [
+        ('list of str', lambda: [name.encode('utf8').decode('utf8') for name in names]),
+        ('numpy unicode', lambda: numpy.array(names, dtype=numpy.str_)),
+        ('NameTable', lambda: search.NameTable.from_names(names)),
+    ]
+
+
+def report(label, layout, measured):
+    '''
+    Prints one line of the table
+    '''
+    (_, kept, peak) = measured
+    print('{:>14} {:>14} {:>10.1f} {:>10.1f}'.format(
+        label, layout, kept / 1e6, peak / 1e6,
+    ))
+
+
+def main():
+    '''
+    Prints the memory of each layout over a synthetic database
+    '''
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--picture-size', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        database = db.Database(os.path.join(directory, 'employees.db'))
+        with database.bulk_load():
+            database.put_many(synthetic.make_entries(
+                args.size, args.picture_size, args.seed,
+            ))
+
+        print('{:>14} {:>14} {:>10} {:>10}'.format(
+            'employees', 'layout', 'kept MB', 'peak MB',
+        ))
+        for (layout, build) in layouts(database):
+            report(args.size, layout, measure(build))
+
+        names = [name for (name,) in database.connection.execute(
+            'SELECT name FROM entry'
+        )]
+        for (layout, build) in name_layouts(names):
+            report('names', layout, measure(build))
+        database.connection.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+'''
+Compares the rows per second of writing employees with Database.put, one
+commit per row, against Database.put_many inside a bulk_load session
+'''
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from doppelganger import db
+
+from . import synthetic
+
+
+def time_put(path, entries):
+    '''
+    The old write path, a put and commit per employee
+    '''
+    database = db.Database(path)
+    start = time.time()
+    for entry in entries:
+        database.put(entry)
+    return time.time() - start
+
+
+def time_put_many(path, entries, batch_size):
+    '''
+    The bulk write path, batched transactions with write ahead logging
+    '''
+    database = db.Database(path)
+    start = time.time()
+    with database.bulk_load():
+        database.put_many(entries, batch_size)
+    return time.time() - start
+
+
+def main():
+    '''
+    Runs both write paths over the same synthetic employees
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument(
+        '--put-rows', type=int, default=None,
+        help='limit the slow put path to this many rows, defaults to --rows',
+    )
+    parser.add_argument('--batch-size', type=int, default=db.BATCH_SIZE)
+    parser.add_argument('--picture-size', type=int, default=2048)
+    args = parser.parse_args()
+
+    put_rows = args.put_rows or args.rows
+    directory = tempfile.mkdtemp()
+    try:
+        entries = list(synthetic.make_entries(
+            max(args.rows, put_rows),
+            args.picture_size,
+        ))
+        results = [
+            ('put', put_rows, time_put(
+                os.path.join(directory, 'put.db'),
+                entries[:put_rows],
+            )),
+            ('put_many', args.rows, time_put_many(
+                os.path.join(directory, 'put_many.db'),
+                entries[:args.rows],
+                args.batch_size,
+            )),
+        ]
+    finally:
+        shutil.rmtree(directory)
+
+    print('{:>10} {:>10} {:>10} {:>12}'.format('path', 'rows', 'seconds', 'rows/s'))
+    for (name, rows, elapsed) in results:
+        print('{:>10} {:>10} {:>10.2f} {:>12.0f}'.format(
+            name, rows, elapsed, rows / max(elapsed, 1e-9),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''
+A local stand-in for the directory server, so that fetching employees can
+be measured, and tested, without the real one
+'''
+
+import time
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+import numpy
+
+from . import synthetic
+
+
+class FakeLdap(object):
+    '''
+    Quacks like the parts of a python-ldap connection that ldap_utils uses,
+    serving `count` synthetic employees with RFC 2696 paged results.
+
+    Every page takes `latency` seconds from when it was asked for, which is
+    how a real server on the network behaves, so asking for the next page
+    early overlaps that wait with processing the current one.
+    '''
+
+    def __init__(self, count, picture_size=2048, latency=0.0):
+        self.count = count
+        self.latency = latency
+
+        # Making random bytes is slower than a server sending them, so a
+        # few pictures are made up front and shared round robin
+        random = numpy.random.RandomState(0)
+        self.pictures = [
+            synthetic.make_picture(random, picture_size) for _ in range(16)
+        ]
+        self.requests = {}
+        self.searches = 0
+
+    def search_ext(self, _base, _scope, filterstr=None, attrlist=None,
+                   serverctrls=None):
+        '''
+        Starts a paged search, returning its message id right away
+        '''
+        assert filterstr and attrlist
+        (control,) = serverctrls
+        self.searches += 1
+        start = int(control.cookie or 0)
+        self.requests[self.searches] = (time.time(), start, control.size)
+        return self.searches
+
+    def result3(self, msgid=None):
+        '''
+        Waits for and returns a page as
+        (result type, entries, message id, server controls)
+        '''
+        (asked, start, size) = self.requests.pop(msgid)
+        time.sleep(max(0, asked + self.latency - time.time()))
+
+        end = min(start + size, self.count)
+        entries = [self.make_entry(dsid) for dsid in range(start, end)]
+        cookie = str(end).encode('ascii') if end < self.count else b''
+        control = SimplePagedResultsControl(False, size=self.count, cookie=cookie)
+        return ldap.RES_SEARCH_RESULT, entries, msgid, [control]
+
+    def make_entry(self, dsid):
+        '''
+        One employee as the server would send it, every value in a list
+        '''
+        return (
+            'appledsId={}, ou=People, o=Apple'.format(dsid),
+            {
+                'appledsId': [str(dsid)],
+                'cn': ['Employee {}'.format(dsid).encode('utf8')],
+                'applePhotoOfficial-jpeg': [
+                    self.pictures[dsid % len(self.pictures)],
+                ],
+            },
+        )
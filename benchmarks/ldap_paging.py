@@ -0,0 +1,72 @@
+'''
+Measures how fast, in entries per second, and how much memory it takes for
+ldap_utils.get_employees to page through a directory, using a local
+stand-in for the server
+'''
+
+import argparse
+import time
+import tracemalloc
+
+from doppelganger import ldap_utils
+
+from . import fake_ldap
+
+
+def measure(count, page_size, latency, picture_size):
+    '''
+    Returns the seconds and peak bytes allocated to get every employee.
+    Tracing allocations is slow, so memory is measured on a separate run.
+    '''
+    server = fake_ldap.FakeLdap(count, picture_size, latency)
+    start = time.time()
+    fetched = sum(1 for _ in ldap_utils.get_employees(server, page_size))
+    elapsed = time.time() - start
+    assert fetched == count
+
+    server = fake_ldap.FakeLdap(count, picture_size, 0)
+    tracemalloc.start()
+    for _ in ldap_utils.get_employees(server, page_size):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    '''
+    Measures paging through the fake directory at several page sizes
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument(
+        '--page-sizes', type=int, nargs='+', default=[100, 500, 2000],
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.05,
+        help='seconds the fake server takes to answer each page',
+    )
+    parser.add_argument('--picture-size', type=int, default=2048)
+    args = parser.parse_args()
+
+    print('{:>10} {:>10} {:>10} {:>12} {:>10}'.format(
+        'page size', 'entries', 'seconds', 'entries/s', 'peak MB',
+    ))
+    for page_size in args.page_sizes:
+        elapsed, peak = measure(
+            args.entries,
+            page_size,
+            args.latency,
+            args.picture_size,
+        )
+        print('{:>10} {:>10} {:>10.2f} {:>12.0f} {:>10.1f}'.format(
+            page_size,
+            args.entries,
+            elapsed,
+            args.entries / max(elapsed, 1e-9),
+            peak / 1e6,
+        ))
+
+
+if __name__ == '__main__':
+    main()
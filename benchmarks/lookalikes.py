@@ -0,0 +1,60 @@
+'''
+Times finding the lookalikes of every employee, as the lookalikes command
+does, over synthetic employees, writing the CSV nowhere
+
+    python -m benchmarks.lookalikes --size 100000
+'''
+
+import argparse
+import os
+import time
+
+import numpy
+
+from doppelganger import (
+    batch,
+    search,
+    sharded,
+)
+
+from . import synthetic
+
+
+def main():
+    '''
+    Prints how long everyone's lookalikes took, and how many a second
+    '''
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--tile-size', type=int, default=batch.TILE_SIZE)
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    matrix = search.EncodingMatrix(
+        numpy.arange(args.size),
+        ['Employee {}'.format(row) for row in range(args.size)],
+        synthetic.make_encodings(args.size, args.seed),
+    )
+
+    start = time.time()
+    with open(os.devnull, 'w') as handle:
+        batch.write_csv(handle, matrix, batch.find_lookalikes(
+            matrix,
+            range(len(matrix)),
+            args.count,
+            args.tile_size,
+            sharded.ShardedSearcher(matrix, args.shards),
+        ))
+    elapsed = time.time() - start
+    print('{} employees in {:.1f}s, {:.0f} a second'.format(
+        args.size, elapsed, args.size / elapsed,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+Measures each of the profiles.PROFILES on a fixed directory of images: how long
+an image takes, how many faces are found, and how often the top twin of the
+first face agrees with the one the reference profile finds.
+
+Unlike the other benchmarks this needs the dlib models in ~/Downloads, some
+real photos, and a database from `init` to search for twins in.
+'''
+
+import argparse
+import glob
+import os
+import time
+
+from doppelganger import (
+    db,
+    ml,
+    profiles,
+    sidecar,
+)
+
+
+def load_images(directory):
+    '''
+    Returns the sorted paths and decoded images of the photos in directory
+    '''
+    paths = sorted(
+        path for path in glob.glob(os.path.join(directory, '*'))
+        if os.path.splitext(path)[1].lower() in ('.jpg', '.jpeg', '.png')
+    )
+    images = []
+    for path in paths:
+        with open(path, 'rb') as handle:
+            images.append(ml.decode_image(handle.read()))
+    return paths, images
+
+
+def measure(images, pipeline, matrix, profile):
+    '''
+    Returns the seconds per image, the faces found, and the dsid of the top
+    twin of the first face of each image, or None where there's no face
+    '''
+    start = time.time()
+    results = [
+        ml.calculate_encodings_for_images([image], pipeline, profile)[0]
+        for image in images
+    ]
+    elapsed = (time.time() - start) / max(len(images), 1)
+
+    top = []
+    for faces in results:
+        if faces:
+            (indices, _) = matrix.nearest(faces[0].encoding, 1)
+            top.append(int(matrix.dsids[indices[0]]))
+        else:
+            top.append(None)
+    return elapsed, sum(len(faces) for faces in results), top
+
+
+def main():
+    '''
+    Prints latency and top-1 agreement of every profile
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('images', help='a directory of jpegs or pngs')
+    parser.add_argument('--database', default=db.DB_PATH)
+    parser.add_argument(
+        '--reference', choices=sorted(profiles.PROFILES), default='accurate',
+        help='the profile whose answers the others are compared with',
+    )
+    args = parser.parse_args()
+
+    (_, images) = load_images(args.images)
+    pipeline = ml.get_pipeline()
+    matrix = sidecar.load_matrix(db.Database(args.database), args.database)
+
+    # Warm the pipeline up so that the first profile isn't measured cold
+    ml.calculate_encodings_for_images(images[:1], pipeline)
+
+    measured = dict(
+        (name, measure(images, pipeline, matrix, name))
+        for name in sorted(profiles.PROFILES)
+    )
+    reference = measured[args.reference][2]
+
+    print('{:>10} {:>8} {:>12} {:>8} {:>12}'.format(
+        'profile', 'images', 'ms/image', 'faces', 'top-1 agree',
+    ))
+    for (name, (elapsed, faces, top)) in sorted(measured.items()):
+        agreed = sum(1 for (mine, theirs) in zip(top, reference) if mine == theirs)
+        print('{:>10} {:>8} {:>12.1f} {:>8} {:>12.3f}'.format(
+            name,
+            len(images),
+            elapsed * 1000,
+            faces,
+            agreed / max(len(images), 1),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+Measures the recall and latency of quantized.QuantizedMatrix, at several
+corpus sizes and numbers of candidates re-ranked, against the exact search
+of search.EncodingMatrix and its float32 first pass in nearest_many, with
+queries given one at a time as the web service does.  Also checks that the
+distances of every twin found are the exact ones.
+
+    python -m benchmarks.quantized --sizes 10000 100000 1000000
+'''
+
+import argparse
+import functools
+import time
+
+import numpy
+
+from doppelganger import (
+    quantized,
+    search,
+)
+
+from . import synthetic
+
+
+def make_queries(matrix, query_count, seed):
+    '''
+    Stored faces with a little noise added, as new photos of them would be
+    '''
+    random = numpy.random.RandomState(seed)
+    rows = random.choice(len(matrix), min(query_count, len(matrix)), replace=False)
+    noise = random.normal(0, 0.01, (len(rows), search.ENCODING_SIZE))
+    return (matrix.encodings[rows] + noise).astype(numpy.float32)
+
+
+def time_queries(nearest, queries, count):
+    '''
+    Returns the results of nearest for each query and the milliseconds
+    per query
+    '''
+    start = time.time()
+    results = [nearest(query, count) for query in queries]
+    return results, (time.time() - start) * 1000 / max(1, len(queries))
+
+
+def nearest_blocked(matrix, query, count):
+    '''
+    One query through the float32 first pass of nearest_many
+    '''
+    return matrix.nearest_many([query], count)[0]
+
+
+def compare(exact, approximate):
+    '''
+    Returns the recall of approximate, and whether every row it found has
+    just the distance that the exact search gives that row
+    '''
+    found = 0
+    identical = True
+    for ((rows, distances), (approximate_rows, approximate_distances)) in zip(
+            exact, approximate):
+        found += len(set(rows.tolist()).intersection(approximate_rows.tolist()))
+        exact_distances = dict(zip(rows.tolist(), distances.tolist()))
+        for (row, distance) in zip(approximate_rows.tolist(), approximate_distances.tolist()):
+            if row in exact_distances and exact_distances[row] != distance:
+                identical = False
+    recall = float(found) / max(1, sum(len(rows) for (rows, _) in exact))
+    return recall, identical
+
+
+def main():
+    '''
+    Prints recall and milliseconds per query at each size and number of
+    candidates, the exact search being the line with no candidates
+    '''
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument(
+        '--candidates', type=int, nargs='+', default=[64, 128, 256, 512],
+    )
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print('{:>10} {:>10} {:>8} {:>10} {:>10}'.format(
+        'employees', 'candidates', 'recall', 'ms/query', 'identical',
+    ))
+    for size in args.sizes:
+        encodings = synthetic.make_encodings(size, args.seed)
+        matrix = search.EncodingMatrix(numpy.arange(size), [''] * size, encodings)
+        del encodings
+        queries = make_queries(matrix, args.queries, args.seed + 1)
+
+        (exact, elapsed) = time_queries(matrix.nearest, queries, args.count)
+        print('{:>10} {:>10} {:>8.4f} {:>10.3f} {:>10}'.format(
+            size, 'exact', 1.0, elapsed, '',
+        ))
+
+        # The float32 matrix multiply first pass, to tell how much of the
+        # difference is quantizing and how much is the matrix multiply
+        (blocked, elapsed) = time_queries(
+            functools.partial(nearest_blocked, matrix),
+            queries,
+            args.count,
+        )
+        print('{:>10} {:>10} {:>8.4f} {:>10.3f} {:>10}'.format(
+            size, 'float32', compare(exact, blocked)[0], elapsed, '',
+        ))
+
+        for candidates in args.candidates:
+            searcher = quantized.QuantizedMatrix(matrix, candidates)
+            (approximate, elapsed) = time_queries(searcher.nearest, queries, args.count)
+            (recall, identical) = compare(exact, approximate)
+            print('{:>10} {:>10} {:>8.4f} {:>10.3f} {:>10}'.format(
+                size, candidates, recall, elapsed, str(identical),
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+Compares the time to serialize, and the size of, /process responses in the
+old format, a json list of Response namedtuples with every picture embedded,
+against the versioned schema in responses, both full and compact
+'''
+
+import argparse
+import collections
+import functools
+import json
+import time
+
+import numpy
+
+from doppelganger import (
+    logic,
+    ml,
+    responses,
+)
+
+from . import synthetic
+
+
+# What /process used to answer with, fields in whatever order the set gave
+LegacyResponse = collections.namedtuple('LegacyResponse', {
+    'location',
+    'landmarks',
+    'twins',
+})
+
+
+def make_faces(face_count, twin_count, picture_size):
+    '''
+    Returns a list of (ml.PipelineResult, Twins without pictures) per face
+    and a dictionary of the twins' pictures
+    '''
+    random = numpy.random.RandomState(0)
+    pictures = {}
+    faces = []
+    for face in range(face_count):
+        twins = []
+        for twin in range(twin_count):
+            dsid = face * twin_count + twin
+            pictures[dsid] = synthetic.make_picture(random, picture_size)
+            twins.append(logic.Twin(
+                float(random.rand()),
+                'Employee {}'.format(dsid),
+                dsid,
+                None,
+            ))
+        result = ml.PipelineResult(
+            location={'x': 100, 'y': 100, 'width': 200, 'height': 200},
+            landmarks=[{'x': 150, 'y': 150}] * 68,
+            encoding=None,
+        )
+        faces.append((result, twins))
+    return faces, pictures
+
+
+def lookup_pictures(pictures, dsids):
+    '''
+    Looks the pictures of dsids up as the database would
+    '''
+    return dict((dsid, pictures[dsid]) for dsid in dsids)
+
+
+def legacy_dumps(faces, get_pictures):
+    '''
+    The old /process body, as it would be if it had worked on python 3
+    '''
+    return json.dumps([
+        LegacyResponse(
+            location=result.location,
+            landmarks=result.landmarks,
+            twins=logic.add_pictures(twins, get_pictures),
+        )
+        for (result, twins) in faces
+    ])
+
+
+def measure(encode, repeats):
+    '''
+    Returns the best seconds of several runs of encode, and its size
+    '''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.time()
+        body = encode()
+        best = min(best, time.time() - start)
+    return best, len(body.encode('utf-8'))
+
+
+def main():
+    '''
+    Prints the time and size of each encoding at several numbers of faces
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--faces', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--twins', type=int, default=20)
+    parser.add_argument('--picture-size', type=int, default=20000)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    print('{:>6} {:>8} {:>10} {:>10}'.format('faces', 'format', 'ms', 'KB'))
+    for face_count in args.faces:
+        (faces, pictures) = make_faces(face_count, args.twins, args.picture_size)
+
+        get_pictures = functools.partial(lookup_pictures, pictures)
+        encodings = [
+            ('legacy', functools.partial(legacy_dumps, faces, get_pictures)),
+            ('full', functools.partial(responses.dumps, faces, False, get_pictures)),
+            ('compact', functools.partial(responses.dumps, faces)),
+        ]
+        for (name, encode) in encodings:
+            (elapsed, size) = measure(encode, args.repeats)
+            print('{:>6} {:>8} {:>10.3f} {:>10.1f}'.format(
+                face_count, name, elapsed * 1000, size / 1000,
+            ))
+
+
+if __name__ == '__main__':
+    main()
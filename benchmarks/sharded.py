@@ -0,0 +1,92 @@
+'''
+Measures how search scales with the number of shards searched in parallel,
+from one up to the number of CPU cores, for one face at a time and for a
+batch of faces, over the exact and the quantized first passes.
+
+    OPENBLAS_NUM_THREADS=1 python -m benchmarks.sharded --size 1000000
+
+Limit BLAS to one thread as above, or it may already spread each matrix
+multiply over the cores and hide what sharding does.
+'''
+
+import argparse
+import os
+import time
+
+import numpy
+
+from doppelganger import (
+    quantized,
+    search,
+    sharded,
+)
+
+from . import synthetic
+
+
+def time_batches(searcher, batches, count):
+    '''
+    Milliseconds per batch of queries that searcher takes
+    '''
+    start = time.time()
+    for batch in batches:
+        searcher.nearest_many(batch, count)
+    return (time.time() - start) * 1000 / max(1, len(batches))
+
+
+def main():
+    '''
+    Prints milliseconds per search and the speed up over one shard for
+    each number of shards
+    '''
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument(
+        '--shards', type=int, nargs='+',
+        default=list(range(1, (os.cpu_count() or 1) + 1)),
+    )
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    matrix = search.EncodingMatrix(
+        numpy.arange(args.size),
+        [''] * args.size,
+        synthetic.make_encodings(args.size, args.seed),
+    )
+    first_passes = [
+        ('float32', matrix),
+        ('int8', quantized.QuantizedMatrix(matrix)),
+    ]
+    random = numpy.random.RandomState(args.seed + 1)
+
+    print('{} employees on {} cores'.format(args.size, os.cpu_count()))
+    print('{:>8} {:>6} {:>7} {:>10} {:>8}'.format(
+        'pass', 'batch', 'shards', 'ms/batch', 'speedup',
+    ))
+    for (name, searcher) in first_passes:
+        for batch in args.batch:
+            batches = [
+                matrix.encodings[random.randint(0, args.size, batch)]
+                for _ in range(args.repeats)
+            ]
+            single = None
+            for shard_count in args.shards:
+                elapsed = time_batches(
+                    sharded.ShardedSearcher(searcher, shard_count),
+                    batches,
+                    args.count,
+                )
+                single = single or elapsed
+                print('{:>8} {:>6} {:>7} {:>10.3f} {:>8.2f}'.format(
+                    name, batch, shard_count, elapsed, single / elapsed,
+                ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+'''
+Runs every benchmark of search, storage and serving over synthetic
+corpora of several sizes, saves the results as json, and optionally
+compares them with an earlier run, failing on any that regressed.
+
+    python -m benchmarks.suite --sizes 1000 100000 1000000 --output new.json
+    python -m benchmarks.suite --baseline old.json --threshold 0.1
+
+The same seed always makes the same corpora, so runs on the same machine
+can be compared.  /process is measured end to end through flask with the
+dlib part of the pipeline stubbed out, since the models aren't needed to
+measure everything around them.
+'''
+
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy
+from mock import patch
+
+from doppelganger import (
+    db,
+    flask_app,
+    logic,
+    ml,
+    search,
+)
+
+from . import synthetic
+
+
+class Results(object):
+    '''
+    Named measurements, each with its unit and which way is better
+    '''
+
+    def __init__(self):
+        self.measurements = {}
+
+    def add(self, name, value, unit, higher_is_better):
+        '''
+        Records one measurement and prints it as it comes in
+        '''
+        self.measurements[name] = {
+            'value': value,
+            'unit': unit,
+            'higher_is_better': higher_is_better,
+        }
+        print('{:<32} {:>14.3f} {}'.format(name, value, unit))
+        sys.stdout.flush()
+
+    def to_json(self, args):
+        '''
+        The measurements along with what they were measured on
+        '''
+        return {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'machine': platform.platform(),
+            'sizes': args.sizes,
+            'seed': args.seed,
+            'measurements': self.measurements,
+        }
+
+
+def rate(count, elapsed):
+    '''
+    Things per second, without dividing by zero
+    '''
+    return count / max(elapsed, 1e-9)
+
+
+def bench_compare(results, size, employees, queries):
+    '''
+    logic.compare, which builds the search matrix on every call, and
+    logic.find_twins with the matrix built once as the server does
+    '''
+    start = time.time()
+    for query in queries:
+        logic.compare(query, employees, 20)
+    results.add('compare@{}'.format(size), rate(len(queries), time.time() - start),
+                'queries/s', True)
+
+    matrix = search.EncodingMatrix.from_entries(employees)
+    start = time.time()
+    for query in queries:
+        logic.find_twins(matrix, query, 20)
+    results.add('find_twins@{}'.format(size), rate(len(queries), time.time() - start),
+                'queries/s', True)
+
+
+def bench_codec(results, size, encodings):
+    '''
+    Round trips of encodings through the database's blob format
+    '''
+    start = time.time()
+    for encoding in encodings:
+        db.bin_to_nparray(db.nparray_to_bin(encoding))
+    results.add('codec@{}'.format(size), rate(len(encodings), time.time() - start),
+                'round trips/s', True)
+
+
+def bench_writes(results, size, directory, args):
+    '''
+    Database.put, one commit per row, on at most put_rows employees, then
+    put_many filling the database that the rest of the benchmarks read
+    '''
+    put_rows = min(size, args.put_rows)
+    database = db.Database(os.path.join(directory, 'put.db'))
+    start = time.time()
+    for entry in synthetic.make_entries(put_rows, args.picture_size, args.seed):
+        database.put(entry)
+    results.add('put@{}'.format(size), rate(put_rows, time.time() - start),
+                'rows/s', True)
+    database.connection.close()
+
+    path = os.path.join(directory, 'employees.db')
+    database = db.Database(path)
+    start = time.time()
+    with database.bulk_load():
+        database.put_many(synthetic.make_entries(size, args.picture_size, args.seed))
+    results.add('put_many@{}'.format(size), rate(size, time.time() - start),
+                'rows/s', True)
+    return database, path
+
+
+def bench_loads(results, size, database):
+    '''
+    Loading every employee, with and without their pictures.  Returns the
+    employees, for the benchmarks that need them in memory.
+    '''
+    start = time.time()
+    for _ in database.entries_without_pictures():
+        pass
+    results.add('entries@{}'.format(size), time.time() - start, 's', False)
+
+    start = time.time()
+    employees = database.get_all()
+    results.add('get_all@{}'.format(size), time.time() - start, 's', False)
+    return employees
+
+
+def make_upload(seed):
+    '''
+    A webcam sized jpeg of noise, as /process would be sent it
+    '''
+    random = numpy.random.RandomState(seed)
+    pixels = random.randint(0, 256, (480, 640, 3)).astype(numpy.uint8)
+    _, jpeg = cv2.imencode('.jpg', pixels)  # pylint: disable=no-member
+    return 'data:image/jpeg;base64,' + base64.b64encode(jpeg.tobytes()).decode()
+
+
+def bench_process(results, size, path, queries, args):
+    '''
+    /process end to end, from the form post to the json, with one face per
+    upload whose encoding is the next of the queries
+    '''
+    encodings = iter(queries * (args.requests // len(queries) + 1))
+
+    def calculate(images, _pipeline, _profile):
+        '''
+        Stands in for the dlib part of the pipeline
+        '''
+        return [
+            [ml.PipelineResult(
+                location={'x': 0, 'y': 0, 'width': 100, 'height': 100},
+                landmarks=[{'x': 0, 'y': 0}] * 68,
+                encoding=next(encodings),
+            )]
+            for _ in images
+        ]
+
+    flask_app.CACHE.clear()
+    flask_app.APP.config.update(
+        BATCH_WINDOW=args.batch_window,
+        RESULT_CACHE_SIZE=0,
+        SNAPSHOT_INTERVAL=3600,
+    )
+    upload = {'image_uri': make_upload(args.seed)}
+    with patch('doppelganger.flask_app.db.DB_PATH', path), \
+            patch('doppelganger.flask_app.ml.get_pipeline'), \
+            patch('doppelganger.flask_app.ml.calculate_encodings_for_images', calculate):
+        client = flask_app.APP.test_client()
+        assert client.post('/process', data=upload).status_code == 200
+
+        latencies = []
+        for _ in range(args.requests):
+            start = time.time()
+            response = client.post('/process', data=upload)
+            latencies.append(time.time() - start)
+            assert response.status_code == 200
+    flask_app.CACHE.clear()
+
+    results.add('process_p50@{}'.format(size),
+                numpy.percentile(latencies, 50) * 1000, 'ms', False)
+    results.add('process_p99@{}'.format(size),
+                numpy.percentile(latencies, 99) * 1000, 'ms', False)
+
+
+def run(args):
+    '''
+    Runs every benchmark at every size, returning the Results
+    '''
+    results = Results()
+    for size in args.sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            queries = list(synthetic.make_encodings(args.queries, args.seed + 1))
+            bench_codec(results, size, synthetic.make_encodings(min(size, 100000), args.seed))
+            (database, path) = bench_writes(results, size, directory, args)
+            employees = bench_loads(results, size, database)
+            bench_compare(results, size, employees, queries)
+            del employees
+            bench_process(results, size, path, queries, args)
+            database.connection.close()
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+def compare(baseline, current, threshold):
+    '''
+    Returns a list of (name, baseline value, current value, change) for
+    every measurement that got worse by more than threshold, a fraction
+    '''
+    regressions = []
+    for (name, measured) in sorted(current['measurements'].items()):
+        if name not in baseline['measurements']:
+            continue
+        before = baseline['measurements'][name]['value']
+        after = measured['value']
+        change = (after - before) / max(abs(before), 1e-12)
+        worse = -change if measured['higher_is_better'] else change
+        if worse > threshold:
+            regressions.append((name, before, after, change))
+    return regressions
+
+
+def main():
+    '''
+    Runs the suite, saves it, and compares it with a baseline if given one
+    '''
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1000, 100000],
+        help='the numbers of employees to benchmark, 1000000 works but is slow',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--picture-size', type=int, default=2048)
+    parser.add_argument(
+        '--put-rows', type=int, default=2000,
+        help='the most rows to time the slow one commit per row put on',
+    )
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument(
+        '--batch-window', type=float,
+        default=flask_app.APP.config['BATCH_WINDOW'],
+    )
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='an earlier --output to compare with')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='the fraction worse than the baseline that counts as a regression',
+    )
+    args = parser.parse_args()
+
+    current = run(args).to_json(args)
+    with open(args.output, 'w') as handle:
+        json.dump(current, handle, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+        regressions = compare(baseline, current, args.threshold)
+        for (name, before, after, change) in regressions:
+            print('REGRESSED {}: {:.3f} -> {:.3f} ({:+.1%})'.format(
+                name, before, after, change,
+            ))
+        if regressions:
+            sys.exit(1)
+        print('No regressions beyond {:.0%}'.format(args.threshold))
+
+
+if __name__ == '__main__':
+    main()
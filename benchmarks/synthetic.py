@@ -0,0 +1,59 @@
+'''
+Generates fake but realistically shaped employees for the benchmarks
+'''
+
+import numpy
+
+from doppelganger import (
+    db,
+    search,
+)
+
+
+def make_encodings(count, seed=0, center_count=None, spread=0.04):
+    '''
+    Returns a count x 128 float64 matrix of encodings clumped around
+    center_count centers, one per hundred by default, each spread about
+    its center by that standard deviation, shaped about like the ones the
+    dlib ResNet produces
+    '''
+    random = numpy.random.RandomState(seed)
+    centers = random.normal(0, 0.09, (center_count or max(1, count // 100), 128))
+    encodings = centers[random.randint(0, len(centers), count)]
+    encodings += random.normal(0, spread, (count, 128))
+    return encodings
+
+
+def make_matrix(count, seed=0, first_dsid=0, **shape):
+    '''
+    A search.EncodingMatrix of count employees with encodings from
+    make_encodings, shaped by its center_count and spread if given, and
+    dsids counting up from first_dsid
+    '''
+    return search.EncodingMatrix(
+        range(first_dsid, first_dsid + count),
+        ['Employee {}'.format(row) for row in range(count)],
+        make_encodings(count, seed, **shape),
+    )
+
+
+def make_picture(random, size):
+    '''
+    Random bytes behind a jpeg header, roughly the size of a real photo
+    '''
+    header = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x01\x00H\x00H\x00\x00'
+    return header + random.bytes(max(0, size - len(header)))
+
+
+def make_entries(count, picture_size=2048, seed=0):
+    '''
+    Generates count db.Entry with unique dsids, names, and pictures
+    '''
+    random = numpy.random.RandomState(seed)
+    for (dsid, encoding) in enumerate(make_encodings(count, seed)):
+        yield db.Entry(
+            dsid=dsid + 1,
+            name='Employee {}'.format(dsid + 1),
+            facial_encoding=encoding,
+            picture=make_picture(random, picture_size),
+        )
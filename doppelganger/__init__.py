@@ -3,13 +3,25 @@
 
 '''
 Scrapes Apple Directory and determines doppelgängers
+
+The modules are imported the first time they're used rather than all up
+front, so that each entry point only loads what it needs.  The CLI doesn't
+need flask, and most commands need neither python-ldap nor dlib.
 '''
 
-from . import (
-    cli,
-    db,
-    ldap_utils,
-    ml,
-    flask_app,
-    logic,
-)
+import importlib
+
+
+def __getattr__(name):
+    '''
+    Imports the submodule of the given name on first use, so that
+    `doppelganger.db` works just as if it had been imported up front
+    '''
+    try:
+        return importlib.import_module('.' + name, __name__)
+    except ModuleNotFoundError as error:
+        if error.name != '{}.{}'.format(__name__, name):
+            raise
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name)
+        ) from None
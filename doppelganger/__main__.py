@@ -4,6 +4,7 @@ This is the main module.  It is executed when run with `python -m doppleganger`
 
 from testlogger import logger
 
+from . import timings
 from .cli import argument_parser
 
 
@@ -13,7 +14,10 @@ def main():
     '''
     logger.info('Starting process')
     args = argument_parser().parse_args()
+    timings.enable(args.timings)
     args.func(args)
+    if args.timings:
+        print(timings.summary())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+'''
+The top lookalikes of many employees at once, up to everyone, written out
+as CSV or JSON lines as they're found
+
+Employees are searched for a tile of them at a time.  Each tile goes through
+search.EncodingMatrix.nearest_many, which compares it against a block of
+employees at a time, so that memory stays bounded by the size of a tile
+times the size of a block however many employees there are.
+'''
+
+import csv
+import json
+
+import numpy
+from testlogger import logger
+
+from . import (
+    logic,
+    responses,
+)
+
+
+# How many employees are searched for at once
+TILE_SIZE = 1024
+
+
+CSV_COLUMNS = ['dsid', 'name', 'rank', 'twin_dsid', 'twin_name', 'distance']
+
+
+def find_rows(matrix, dsids):
+    '''
+    Returns the rows of the matrix of each of dsids, leaving out, with a
+    warning, those that aren't in it
+    '''
+    known = dict((dsid, row) for (row, dsid) in enumerate(matrix.dsids.tolist()))
+    rows = []
+    for dsid in dsids:
+        if dsid in known:
+            rows.append(known[dsid])
+        else:
+            logger.warning('No employee with dsid %s', dsid)
+    return rows
+
+
+def find_lookalikes(matrix, rows, count, tile_size=TILE_SIZE, searcher=None):
+    '''
+    Generates a tuple of (row, Twins without pictures) for each of the rows
+    of the matrix, in order, with the `count` employees that look most like
+    them, not counting themselves
+
+    searcher is anything with the nearest_many of the matrix to search with
+    instead, like a sharded.ShardedSearcher of it
+    '''
+    searcher = searcher or matrix
+    rows = numpy.asarray(rows, dtype=numpy.intp)
+    for start in range(0, len(rows), tile_size):
+        tile = rows[start:start + tile_size]
+        nearest = searcher.nearest_many(matrix.encodings[tile], count + 1)
+        for (row, (indices, distances)) in zip(tile.tolist(), nearest):
+            others = indices != row
+            twins = logic.make_twins(matrix, indices[others], distances[others])
+            yield row, twins[:count]
+        logger.info('Found lookalikes for %s of %s', start + len(tile), len(rows))
+
+
+def write_csv(handle, matrix, lookalikes):
+    '''
+    Writes a line per employee and twin, ranked from 1 nearest
+    '''
+    writer = csv.writer(handle)
+    writer.writerow(CSV_COLUMNS)
+    for (row, twins) in lookalikes:
+        for (rank, twin) in enumerate(twins, 1):
+            writer.writerow([
+                int(matrix.dsids[row]),
+                matrix.names[row],
+                rank,
+                twin.dsid,
+                twin.name,
+                repr(twin.distance),
+            ])
+
+
+def write_jsonl(handle, matrix, lookalikes):
+    '''
+    Writes a json object per employee with their twins as in the responses
+    schema, nearest first
+    '''
+    for (row, twins) in lookalikes:
+        handle.write(json.dumps({
+            'dsid': int(matrix.dsids[row]),
+            'name': matrix.names[row],
+            'twins': [responses.twin_to_dict(twin, True) for twin in twins],
+        }))
+        handle.write('\n')
+
+
+FORMATS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+}
@@ -3,15 +3,18 @@ Code mostly used by the CLI version of this app
 '''
 
 import argparse
-import base64
+import collections
 
 from testlogger import logger
 
 from . import (
+    batch,
+    cluster,
     db,
-    ldap_utils,
-    ml,
+    ivf,
     logic,
+    profiles,
+    sidecar,
 )
 
 
@@ -23,33 +26,245 @@ def get_database():
     return db.Database(db.DB_PATH)
 
 
-def init(_):
+def init(args):
     '''
-    Sets up a database for you
+    Sets up a database for you, or brings an existing one up to date by only
+    encoding the photos that changed and removing employees that are gone
     '''
+    # These pull in python-ldap and dlib, which only init needs, so they're
+    # imported here to keep them from slowing down every other command
+    # pylint: disable=import-outside-toplevel
+    from . import (
+        ldap_utils,
+        workers,
+    )
+
     # All these are expensive to do so we do them once out here
     database = get_database()  # Connections are expensive and limited
     ldap_instance = ldap_utils.init_ldap()  # This is actually over the network
-    pipeline = ml.get_pipeline()  # This loads a lot of files and is slow
-
-    for employee in ldap_utils.get_employees(ldap_instance):
-        logger.info('Looking at %s, %s', employee['cn'], employee['appledsId'])
-        image_bytes = base64.b64decode(employee['applePhotoOfficial-jpeg'])
-        file_name = ml.save_bytes_to_file(image_bytes)
-        results = ml.calculate_encoding_for_image(file_name, pipeline)
-        if not results:
-            logger.warning('No faces found')
-        else:
-            if len(results) > 1:
+    sync = Sync(database, profiles.get_model_version(args.profile))
+
+    # Loading the pipeline is slow, so each worker does that just once
+    employees = sync.changed(
+        ldap_utils.get_employees(
+            ldap_instance,
+            args.page_size or ldap_utils.PAGE_SIZE,
+        )
+    )
+    results = workers.encode_employees(employees, args.workers, args.profile)
+
+    # The workers only encode, all the writing happens here on one connection
+    with database.bulk_load():
+        database.put_many(sync.entries(results))
+        sync.finish()
+
+    sync.log()
+
+    # Brought up to date here, so the web service and the other commands
+    # don't have to before they can start
+    sidecar.get_current_manifest(database, db.DB_PATH)
+
+
+class Sync(object):
+    '''
+    Compares what init gets from the directory with what's already in the
+    database, so that only new or changed photos are encoded again.  That
+    includes photos that no face was found in, which are remembered apart
+    from the entries.
+    '''
+
+    def __init__(self, database, model_version=None):
+        self.database = database
+        self.model_version = model_version or profiles.get_model_version()
+
+        # Photos without faces are known with a name of None
+        self.known = dict(
+            (dsid, (None, photo_hash, version))
+            for (dsid, (photo_hash, version))
+            in db.Faceless(database).get_fingerprints().items()
+        )
+        self.known.update(database.get_fingerprints())
+        self.stale = set(self.known)
+        self.renamed = {}
+        self.faceless = []
+        self.counts = collections.Counter()
+
+    def changed(self, employees):
+        '''
+        Given employee records from ldap_utils, generates only the ones whose
+        photos are new or changed, handling the rest without encoding them.
+        Changed records get a photo_hash to be stored with them.
+
+        This is pulled lazily as the encoding goes, in between the writes
+        of put_many, so it must not touch the database itself.
+        '''
+        from . import workers  # pylint: disable=import-outside-toplevel
+
+        for employee in employees:
+            dsid = int(employee['appledsId'])
+            self.stale.discard(dsid)
+            photo_hash = db.hash_picture(workers.get_image_bytes(employee))
+
+            (name, known_hash, known_version) = self.known.get(
+                dsid,
+                (None, None, None),
+            )
+            if (known_hash, known_version) != (photo_hash, self.model_version):
+                employee['photo_hash'] = photo_hash
+                yield employee
+            elif name is None:
+                # No face was found in this very photo last time either
+                self.counts['faceless'] += 1
+            elif name != employee['cn']:
+                # Names can change without the photo changing
+                self.renamed[dsid] = employee['cn']
+                self.counts['updated'] += 1
+            else:
+                self.counts['unchanged'] += 1
+
+    def entries(self, results):
+        '''
+        Given the results of workers.encode_employees, generates a db.Entry
+        for every employee that a face was found for
+        '''
+        for (employee, encodings, _error) in results:
+            dsid = int(employee['appledsId'])
+            if encodings is None:
+                # This failed and was already logged, so keep what we had
+                self.counts['failed'] += 1
+                continue
+            if not encodings:
+                logger.warning(
+                    'No faces found for %s, %s',
+                    employee['cn'],
+                    employee['appledsId'],
+                )
+
+                # Whatever we had is of an old photo, so finish removes it
+                self.faceless.append((dsid, employee['photo_hash'], self.model_version))
+                self.counts['faceless'] += 1
+                continue
+
+            if len(encodings) > 1:
                 logger.warning(
-                    'Found %s faces, using first', len(results))
+                    'Found %s faces, using first', len(encodings))
 
-            result = results[0]
-            entry = db.create_entry_from_record(
-                employee,
-                result.encoding,
+            had_entry = self.known.get(dsid, (None,))[0] is not None
+            self.counts['updated' if had_entry else 'added'] += 1
+            entry = db.create_entry_from_record(employee, encodings[0])
+            yield entry._replace(
+                photo_hash=employee['photo_hash'],
+                model_version=self.model_version,
             )
-            database.put(entry)
+
+    def finish(self):
+        '''
+        Renames the employees that only changed their names, removes the
+        ones whose new photos have no face, and deletes the ones that didn't
+        come back from the directory, once all are seen
+        '''
+        for (dsid, name) in self.renamed.items():
+            self.database.rename(dsid, name)
+        self.database.delete_many(dsid for (dsid, _, _) in self.faceless)
+
+        faceless = db.Faceless(self.database)
+        faceless.put_many(self.faceless)
+        faceless.delete_many(self.stale)
+        faceless.delete_found()
+
+        self.counts['deleted'] = self.database.delete_many(self.stale)
+
+    def log(self):
+        '''
+        Logs how many employees were added, updated, unchanged, and deleted
+        from the directory, and how many had no face or failed
+        '''
+        logger.info(
+            'Added %s, updated %s, unchanged %s, deleted %s '
+            '(%s without faces, %s failed)',
+            self.counts['added'],
+            self.counts['updated'],
+            self.counts['unchanged'],
+            self.counts['deleted'],
+            self.counts['faceless'],
+            self.counts['failed'],
+        )
+
+
+def load_matrix(database):
+    '''
+    Loads every employee in the database into a search.EncodingMatrix,
+    memory mapped from the sidecar files next to the database
+    '''
+    logger.info('Loading all employees')
+    return sidecar.load_matrix(database, db.DB_PATH)
+
+
+def write_index(database, list_count=None, iterations=20, seed=0):
+    '''
+    Trains the approximate nearest neighbour index over the database
+    and saves it next to it for the web service to pick up
+    '''
+    matrix = load_matrix(database)
+    if not matrix:
+        logger.warning('No employees to index')
+        return None
+
+    ivf_index = ivf.IVFIndex.train(matrix, list_count, iterations, seed)
+    ivf_index.save(ivf.get_index_path(db.DB_PATH))
+    return ivf_index
+
+
+def build_index(args):
+    '''
+    Builds the approximate nearest neighbour index, which the web service
+    searches instead of every employee if its NPROBE setting is set
+    '''
+    database = get_database()
+    ivf_index = write_index(database, args.lists, args.iterations, args.seed)
+    if ivf_index is not None:
+        report_index(ivf_index.matrix, ivf_index, args)
+
+
+def index_report(args):
+    '''
+    Measures the recall and latency of the saved index at several nprobes
+    '''
+    matrix = load_matrix(get_database())
+    ivf_index = ivf.IVFIndex.load(ivf.get_index_path(db.DB_PATH), matrix)
+    report_index(matrix, ivf_index, args)
+
+
+def report_index(matrix, ivf_index, args):
+    '''
+    Prints recall at count vs latency against the exact search
+    '''
+    report = ivf.recall_report(
+        matrix,
+        ivf_index,
+        args.nprobe,
+        args.count,
+        args.queries,
+    )
+    ivf.print_report(report)
+
+
+def add_report_arguments(parser):
+    '''
+    The arguments shared by everything that prints an index report
+    '''
+    parser.add_argument(
+        '--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+        help='the numbers of lists to probe per query to report on',
+    )
+    parser.add_argument(
+        '--count', type=int, default=20,
+        help='the number of matches to measure recall over',
+    )
+    parser.add_argument(
+        '--queries', type=int, default=100,
+        help='the number of stored faces to use as queries',
+    )
 
 
 def analyze(args):
@@ -60,22 +275,191 @@ def analyze(args):
     employee = database.get_by_dsid(args.dsid)
     logger.info('Finding matches for %s', employee.name)
 
-    logger.info('Loading all employees')
-    all_employees = database.get_all()
+    matrix = load_matrix(database)
 
-    twins = logic.compare(employee.facial_encoding, all_employees, 20)
+    twins = logic.find_twins(matrix, employee.facial_encoding, args.count)
     logic.print_twins(twins)
 
 
+def lookalikes(args):
+    '''
+    Writes the top matches of many employees, or everyone, as they're found
+    '''
+    # pylint: disable=import-outside-toplevel
+    from . import sharded
+
+    matrix = load_matrix(get_database())
+    if args.dsids:
+        rows = batch.find_rows(matrix, args.dsids)
+    else:
+        rows = range(len(matrix))
+    logger.info('Finding lookalikes for %s employees', len(rows))
+
+    found = batch.find_lookalikes(
+        matrix,
+        rows,
+        args.count,
+        args.tile_size,
+        sharded.ShardedSearcher(matrix, args.shards),
+    )
+    batch.FORMATS[args.format](args.output, matrix, found)
+    args.output.flush()
+
+
+def cluster_employees(args):
+    '''
+    Groups everyone by their encodings, or only fits in those who changed
+    since they were last grouped if there are few of them, then prints the
+    groups whose members look most alike
+    '''
+    database = get_database()
+    clusters = db.Clusters(database)
+    size = database.count()
+    if not size:
+        logger.warning('No employees to cluster')
+        return
+
+    (centroids, weights) = clusters.get_centroids()
+    count = args.clusters or len(centroids) or cluster.default_cluster_count(size)
+    if count > size:
+        # There can't be more centroids than there are employees to pick
+        # them from, and asking for the same count again has to find the
+        # same number stored to fit the changed employees in incrementally
+        logger.warning(
+            'Only %s employees to put in %s clusters, using %s clusters',
+            size, count, size,
+        )
+        count = size
+    changed = clusters.count_changed()
+    if args.full or count != len(centroids) or changed > args.incremental * size:
+        logger.info('Clustering %s employees into %s clusters', size, count)
+        recluster(database, count, args)
+    else:
+        logger.info('Fitting %s changed employees into their clusters', changed)
+        recluster_changed(database, centroids, weights, args.chunk_size)
+
+    print_groups(clusters.get_members(), args.groups, args.group_size)
+
+
+def recluster(database, count, args):
+    '''
+    Clusters every employee from scratch with mini-batch k-means, streaming
+    their encodings out of the database a chunk at a time each epoch
+    '''
+    chunk_size = max(args.chunk_size, count)
+
+    def get_chunks():
+        '''
+        Every encoding, a chunk at a time, in the same order every epoch
+        '''
+        for (_, encodings, _) in database.encoding_chunks(chunk_size):
+            yield encodings
+
+    (centroids, weights) = cluster.minibatch_kmeans(
+        get_chunks,
+        count,
+        args.epochs,
+        args.seed,
+    )
+    clusters = db.Clusters(database)
+    clusters.put_centroids(centroids, weights)
+    for chunk in database.encoding_chunks(chunk_size):
+        clusters.put_members(get_members(chunk, centroids))
+    clusters.delete_stale_members()
+
+
+def recluster_changed(database, centroids, weights, chunk_size):
+    '''
+    Takes the employees who are gone out of their clusters and moves the
+    centroids to take in the ones who are new or changed, leaving everyone
+    else in the cluster they were in
+    '''
+    clusters = db.Clusters(database)
+    for (label, removed) in clusters.delete_stale_members().items():
+        weights[label] = max(0, weights[label] - removed)
+
+    # Read them all before writing any, since being written changes which
+    # are left to read, but there should only be a few
+    changed = list(database.encoding_chunks(chunk_size, changed_only=True))
+    for (_, encodings, _) in changed:
+        cluster.update(centroids, weights, encodings)
+
+    clusters.put_centroids(centroids, weights)
+    for chunk in changed:
+        clusters.put_members(get_members(chunk, centroids))
+
+
+def get_members(chunk, centroids):
+    '''
+    The cluster_member rows of a chunk from db.Database.encoding_chunks,
+    each in the cluster of the nearest centroid
+    '''
+    (dsids, encodings, fingerprints) = chunk
+    labels = cluster.assign(encodings, centroids)
+    distances = cluster.distances_to(encodings, centroids, labels)
+    return [
+        (dsid, label, distance, photo_hash, model_version)
+        for (dsid, label, distance, (photo_hash, model_version))
+        in zip(dsids.tolist(), labels.tolist(), distances.tolist(), fingerprints)
+    ]
+
+
+def print_groups(members, group_count, group_size):
+    '''
+    Given the members from db.Clusters.get_members, prints the group_count
+    clusters of more than one person whose members are nearest their
+    centroid on average, with up to group_size of the nearest of each
+    '''
+    groups = collections.OrderedDict()
+    for (label, dsid, name, distance) in members:
+        groups.setdefault(label, []).append((dsid, name, distance))
+
+    tightest = sorted(
+        (label for label in groups if len(groups[label]) > 1),
+        key=lambda label: (
+            sum(distance for (_, _, distance) in groups[label]) / len(groups[label]),
+            label,
+        ),
+    )
+    for label in tightest[:group_count]:
+        logger.info('Cluster %s of %s people:', label, len(groups[label]))
+        for (dsid, name, distance) in groups[label][:group_size]:
+            logger.info('    DSID: %s Name: %s (%.3f from center)', dsid, name, distance)
+
+
+def add_profile_argument(parser):
+    '''
+    The argument picking the speed vs accuracy of the ml pipeline
+    '''
+    parser.add_argument(
+        '--profile', choices=sorted(profiles.PROFILES), default=profiles.DEFAULT_PROFILE,
+        help='how hard to look for faces, trading speed for accuracy',
+    )
+
+
 def argument_parser():
     '''
     The processor of arguments
     '''
     logger.info('Building argument parser')
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--timings', action='store_true',
+        help='print how long each stage of processing photos took at the end',
+    )
     subparsers = parser.add_subparsers()
 
     init_parser = subparsers.add_parser('init')
+    init_parser.add_argument(
+        '--workers', type=int, default=1,
+        help='the number of processes to encode faces with',
+    )
+    init_parser.add_argument(
+        '--page-size', type=int, default=None,
+        help='the number of employees to get from ldap at a time, '
+        'ldap_utils.PAGE_SIZE by default',
+    )
+    add_profile_argument(init_parser)
     init_parser.set_defaults(func=init)
 
     init_parser = subparsers.add_parser('analyze')
@@ -86,4 +470,85 @@ def argument_parser():
     )
     init_parser.set_defaults(func=analyze)
 
+    lookalikes_parser = subparsers.add_parser('lookalikes')
+    lookalikes_parser.add_argument(
+        'dsids', type=int, nargs='*',
+        help='the people to match with, everyone if none are given',
+    )
+    lookalikes_parser.add_argument(
+        '--count', type=int, default=10,
+        help='the number of matches to retain per person',
+    )
+    lookalikes_parser.add_argument('--format', choices=sorted(batch.FORMATS), default='csv')
+    lookalikes_parser.add_argument(
+        '--output', type=argparse.FileType('w'), default='-',
+        help='where to write the matches, stdout by default',
+    )
+    lookalikes_parser.add_argument(
+        '--tile-size', type=int, default=batch.TILE_SIZE,
+        help='the number of people to match at once, bounding memory',
+    )
+    lookalikes_parser.add_argument(
+        '--shards', type=int, default=1,
+        help='the number of threads to search each tile with',
+    )
+    lookalikes_parser.set_defaults(func=lookalikes)
+
+    cluster_parser = subparsers.add_parser('cluster')
+    cluster_parser.add_argument(
+        '--clusters', type=int, default=None,
+        help='the number of clusters, the same as last time or one per '
+        '{} employees by default'.format(cluster.DEFAULT_CLUSTER_SIZE),
+    )
+    cluster_parser.add_argument(
+        '--chunk-size', type=int, default=10000,
+        help='the most encodings to have in memory at once',
+    )
+    cluster_parser.add_argument(
+        '--epochs', type=int, default=3,
+        help='the number of passes over every employee',
+    )
+    cluster_parser.add_argument(
+        '--seed', type=int, default=0,
+        help='the random seed for picking the initial centroids',
+    )
+    cluster_parser.add_argument(
+        '--incremental', type=float, default=0.1,
+        help='the most of the employees, as a fraction, that can have changed '
+        'for them to be fitted into the existing clusters',
+    )
+    cluster_parser.add_argument(
+        '--full', action='store_true',
+        help='cluster everyone from scratch however few changed',
+    )
+    cluster_parser.add_argument(
+        '--groups', type=int, default=10,
+        help='the number of the most alike groups to print',
+    )
+    cluster_parser.add_argument(
+        '--group-size', type=int, default=5,
+        help='the most people to print per group',
+    )
+    cluster_parser.set_defaults(func=cluster_employees)
+
+    index_parser = subparsers.add_parser('build-index')
+    index_parser.add_argument(
+        '--lists', type=int, default=None,
+        help='the number of k-means lists, about sqrt(employees) by default',
+    )
+    index_parser.add_argument(
+        '--iterations', type=int, default=20,
+        help='the most k-means iterations to train for',
+    )
+    index_parser.add_argument(
+        '--seed', type=int, default=0,
+        help='the random seed for picking the initial centroids',
+    )
+    add_report_arguments(index_parser)
+    index_parser.set_defaults(func=build_index)
+
+    report_parser = subparsers.add_parser('index-report')
+    add_report_arguments(report_parser)
+    report_parser.set_defaults(func=index_report)
+
     return parser
@@ -0,0 +1,161 @@
+'''
+Clustering of facial encodings, used to partition the corpus and to group
+employees who look alike
+
+kmeans needs every encoding in memory at once.  minibatch_kmeans only
+needs a chunk at a time, so it can stream over any number of employees.
+'''
+
+import numpy
+from testlogger import logger
+
+
+# Keeps the temporary block x centroid distance matrices at a few megabytes
+ASSIGN_BLOCK_SIZE = 4096
+
+
+# How many people a cluster of lookalikes has on average unless told otherwise
+DEFAULT_CLUSTER_SIZE = 50
+
+
+def kmeans(data, count, iterations=20, seed=0):
+    '''
+    Plain Lloyd's k-means over the rows of data, returning a count x d
+    float32 matrix of centroids.  The same seed always gives the same answer.
+    '''
+    data = numpy.asarray(data, dtype=numpy.float32)
+    count = max(1, min(count, len(data)))
+    random = numpy.random.RandomState(seed)
+
+    # Start from distinct rows so that no centroid begins empty
+    centroids = data[random.choice(len(data), count, replace=False)].copy()
+
+    for iteration in range(iterations):
+        labels = assign(data, centroids)
+        sizes = numpy.bincount(labels, minlength=count)
+
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, labels, data)
+
+        moved = centroids.copy()
+        filled = sizes > 0
+        moved[filled] = sums[filled] / sizes[filled, numpy.newaxis]
+
+        # A centroid that lost all its rows is restarted on a random row
+        empty = numpy.flatnonzero(~filled)
+        if len(empty):
+            moved[empty] = data[random.choice(len(data), len(empty))]
+
+        shift = numpy.abs(moved - centroids).max()
+        centroids = moved
+        logger.info('k-means iteration %s moved at most %s', iteration, shift)
+        if shift == 0:
+            break
+
+    return centroids
+
+
+def assign(data, centroids):
+    '''
+    Returns the index of the nearest centroid for every row of data
+    '''
+    data = numpy.asarray(data, dtype=numpy.float32)
+    centroids = numpy.asarray(centroids, dtype=numpy.float32)
+    centroid_norms = numpy.einsum('ij,ij->i', centroids, centroids)
+
+    labels = numpy.empty(len(data), dtype=numpy.intp)
+    for start in range(0, len(data), ASSIGN_BLOCK_SIZE):
+        block = data[start:start + ASSIGN_BLOCK_SIZE]
+
+        # |x - c|^2 = |x|^2 - 2x.c + |c|^2, and |x|^2 doesn't change the order
+        scores = centroid_norms - 2 * numpy.dot(block, centroids.T)
+        labels[start:start + len(block)] = scores.argmin(axis=1)
+
+    return labels
+
+
+def default_cluster_count(size):
+    '''
+    Enough clusters for about DEFAULT_CLUSTER_SIZE employees in each
+    '''
+    return max(1, int(round(float(size) / DEFAULT_CLUSTER_SIZE)))
+
+
+def minibatch_kmeans(get_chunks, count, epochs=3, seed=0):
+    '''
+    Mini-batch k-means over chunks of rows, returning a count x d float32
+    matrix of centroids and how many rows each was trained on.  get_chunks
+    is called once per epoch and returns an iterable of the chunks, in the
+    same order every time, so the same seed always gives the same answer.
+
+    The centroids start on rows of the first chunk, picked as in
+    k-means++, so it should have at least count rows.
+    '''
+    random = numpy.random.RandomState(seed)
+    centroids = None
+    weights = None
+    for epoch in range(epochs):
+        for chunk in get_chunks():
+            chunk = numpy.asarray(chunk, dtype=numpy.float32)
+            if centroids is None:
+                centroids = spread_rows(chunk, count, random)
+                weights = numpy.zeros(len(centroids), dtype=numpy.int64)
+            update(centroids, weights, chunk)
+        logger.info('Mini-batch k-means epoch %s done', epoch)
+
+    if centroids is None:
+        return numpy.empty((0, 0), dtype=numpy.float32), numpy.empty(0, dtype=numpy.int64)
+    return centroids, weights
+
+
+def spread_rows(data, count, random):
+    '''
+    Picks count distinct rows of data, each picked with a chance that
+    grows with its squared distance to the nearest row already picked, as
+    k-means++ does, which spreads them over the data.  Mini-batch k-means
+    can't move centroids as far as Lloyd's, so it needs a better start.
+    '''
+    count = min(count, len(data))
+    picked = [random.randint(len(data))]
+    nearest = numpy.full(len(data), numpy.inf, dtype=numpy.float64)
+    for _ in range(count - 1):
+        differences = data - data[picked[-1]]
+        nearest = numpy.minimum(
+            nearest,
+            numpy.einsum('ij,ij->i', differences, differences),
+        )
+        if nearest.sum() > 0:
+            picked.append(random.choice(len(data), p=nearest / nearest.sum()))
+        else:
+            # Everything left is a duplicate of something picked
+            remaining = numpy.setdiff1d(numpy.arange(len(data)), picked)
+            picked.append(remaining[0])
+    return data[picked].copy()
+
+
+def update(centroids, weights, chunk):
+    '''
+    Moves the centroids, in place, to take in a chunk of rows.  Each
+    centroid stays the mean of every row it has taken in, the weights,
+    at the positions it was at when it took them in, so it moves less and
+    less as it sees more.  Returns the labels of the chunk.
+    '''
+    labels = assign(chunk, centroids)
+    sizes = numpy.bincount(labels, minlength=len(centroids))
+    sums = numpy.zeros_like(centroids)
+    numpy.add.at(sums, labels, chunk)
+
+    weights += sizes
+    filled = sizes > 0
+    centroids[filled] += (
+        sums[filled] - sizes[filled, numpy.newaxis] * centroids[filled]
+    ) / weights[filled, numpy.newaxis]
+    return labels
+
+
+def distances_to(data, centroids, labels):
+    '''
+    The distance from every row of data to its labelled centroid
+    '''
+    differences = numpy.asarray(data, dtype=numpy.float32) - centroids[labels]
+    return numpy.sqrt(numpy.einsum('ij,ij->i', differences, differences))
@@ -4,7 +4,10 @@ All the code pertaining to the file database backing
 
 import base64
 import collections
+import contextlib
+import hashlib
 import io
+import itertools
 import sqlite3
 
 import numpy
@@ -16,7 +19,9 @@ Entry = collections.namedtuple('Entry', [
     'dsid',  # A string?
     'facial_encoding',  # A numpy array
     'picture',  # The binary blob of jpeg bits
-])
+    'photo_hash',  # hash_picture of the picture, to notice when it changes
+    'model_version',  # profiles.get_model_version() of what made the facial_encoding
+], defaults=(None, None))
 
 
 INIT_SCRIPT = '''
@@ -24,14 +29,83 @@ CREATE TABLE IF NOT EXISTS entry (
     dsid INTEGER PRIMARY KEY,
     name TEXT NOT NULL,
     facial_encoding BLOB NOT NULL,
-    picture BLOB NOT NULL
+    picture BLOB NOT NULL,
+    photo_hash TEXT,
+    model_version TEXT
+);
+
+CREATE TABLE IF NOT EXISTS revision (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    number INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS entry_inserted AFTER INSERT ON entry
+BEGIN
+    UPDATE revision SET number = number + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS entry_updated AFTER UPDATE ON entry
+BEGIN
+    UPDATE revision SET number = number + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS entry_deleted AFTER DELETE ON entry
+BEGIN
+    UPDATE revision SET number = number + 1;
+END;
+
+CREATE TABLE IF NOT EXISTS cluster (
+    id INTEGER PRIMARY KEY,
+    centroid BLOB NOT NULL,
+    weight INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS cluster_member (
+    dsid INTEGER PRIMARY KEY,
+    cluster INTEGER NOT NULL,
+    distance REAL NOT NULL,
+    photo_hash TEXT,
+    model_version TEXT
+);
+
+CREATE TABLE IF NOT EXISTS faceless (
+    dsid INTEGER PRIMARY KEY,
+    photo_hash TEXT NOT NULL,
+    model_version TEXT NOT NULL
 );
 '''
 
 
+# Columns added since the first version of the entry table, which older
+# databases get with an ALTER TABLE when they are opened
+ADDED_COLUMNS = [
+    ('photo_hash', 'TEXT'),
+    ('model_version', 'TEXT'),
+]
+
+
 DB_PATH = './doppelganger.db'
 
 
+PUT_STATEMENT = '''
+    INSERT OR REPLACE INTO entry (
+        dsid, name, facial_encoding, picture, photo_hash, model_version
+    ) VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+# How many rows put_many writes per transaction
+BATCH_SIZE = 1000
+
+
+# Whether an entry changed since it was put in its cluster, or was never
+CHANGED_SINCE_CLUSTERED = '''
+    member.dsid IS NULL
+    OR entry.photo_hash IS NOT member.photo_hash
+    OR entry.model_version IS NOT member.model_version
+'''
+
+
 def create_entry_from_record(record, facial_encoding):
     '''
     Given some record from active directory, returns an Entry
@@ -48,14 +122,24 @@ def create_entry_from_row(row):
     '''
     Converts a row in the DB into an Entry object
     '''
+    columns = row.keys()
     return Entry(
         dsid=row['dsid'],
         name=row['name'],
         facial_encoding=bin_to_nparray(row['facial_encoding']),
-        picture=str(row['picture']),
+        picture=bytes(row['picture']),
+        photo_hash=row['photo_hash'] if 'photo_hash' in columns else None,
+        model_version=row['model_version'] if 'model_version' in columns else None,
     )
 
 
+def hash_picture(picture):
+    '''
+    A short fingerprint of the jpeg bytes of a picture
+    '''
+    return hashlib.sha1(picture).hexdigest()
+
+
 class Database(object):
     '''
     Encapsulates the interaction with a single database
@@ -70,7 +154,39 @@ class Database(object):
         # allow us to access row values by string
         self.connection.row_factory = sqlite3.Row
 
+        # Creating what already exists doesn't write, so opening a database
+        # that's set up never waits on a writer like init
         self.connection.executescript(INIT_SCRIPT)
+        self.add_revision()
+        self.add_missing_columns()
+
+    def add_revision(self):
+        '''
+        Starts the revision of a new database at 0, only writing if it
+        hasn't been already
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT count(*) FROM revision')
+        if not cursor.fetchone()[0]:
+            with self.connection:
+                self.connection.execute('INSERT OR IGNORE INTO revision VALUES (0, 0)')
+
+    def add_missing_columns(self):
+        '''
+        Brings the entry table of a database made by an older version up to
+        date.  New columns start out NULL, which init treats as changed.
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('PRAGMA table_info(entry)')
+        existing = set(row['name'] for row in cursor)
+        for (column, column_type) in ADDED_COLUMNS:
+            if column not in existing:
+                logger.info('Adding column %s to entry', column)
+                cursor.execute('ALTER TABLE entry ADD COLUMN {} {}'.format(
+                    column,
+                    column_type,
+                ))
+        self.connection.commit()
 
     def entries(self):
         '''
@@ -81,9 +197,26 @@ class Database(object):
         for row in cursor:
             yield create_entry_from_row(row)
 
+    def entries_without_pictures(self):
+        '''
+        Generator for entries in the DB, leaving out the pictures since they
+        are by far the biggest part of each row and aren't needed to compare
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT dsid, name, facial_encoding FROM entry')
+        for row in cursor:
+            yield Entry(
+                dsid=row['dsid'],
+                name=row['name'],
+                facial_encoding=bin_to_nparray(row['facial_encoding']),
+                picture=None,
+            )
+
     def get_all(self):
         '''
-        Loads all the data into an array in memory
+        Loads all the data into an array in memory, pictures and all,
+        which is a lot of memory for a big directory.  To search, use
+        search.EncodingMatrix.from_database instead.
         '''
         logger.info('Loading all employees')
         all_entries = []
@@ -91,6 +224,35 @@ class Database(object):
             all_entries.append(entry)
         return all_entries
 
+    def count(self):
+        '''
+        Returns the number of entries in the DB
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT count(*) FROM entry')
+        return cursor.fetchone()[0]
+
+    def get_revision(self):
+        '''
+        Returns a number that goes up whenever the entry table changes, so
+        that copies derived from the table can tell when they are stale
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT number FROM revision')
+        return cursor.fetchone()[0]
+
+    @contextlib.contextmanager
+    def consistent_reads(self):
+        '''
+        Everything read inside this block sees the same version of the
+        DB, even if another connection writes to it in the meantime
+        '''
+        self.connection.execute('BEGIN')
+        try:
+            yield
+        finally:
+            self.connection.execute('COMMIT')
+
     def get_by_dsid(self, dsid):
         '''
         Given a DSID, return the exact match employee Entry from our database
@@ -105,22 +267,336 @@ class Database(object):
         row = cursor.fetchone()
         return create_entry_from_row(row)
 
+    def get_fingerprints(self):
+        '''
+        Returns a dictionary of every DSID to a tuple of their name,
+        photo_hash, and model_version, which is enough to tell if an
+        employee changed without loading any encodings or pictures
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT dsid, name, photo_hash, model_version FROM entry')
+        return dict(
+            (row['dsid'], (row['name'], row['photo_hash'], row['model_version']))
+            for row in cursor
+        )
+
+    def rename(self, dsid, name):
+        '''
+        Changes just the name of an employee, leaving the rest as it was
+        '''
+        with self.connection:
+            self.connection.execute(
+                'UPDATE entry SET name=? WHERE dsid=?',
+                (name, dsid),
+            )
+
+    def delete_many(self, dsids):
+        '''
+        Removes the entries of every DSID given, in one transaction,
+        returning how many were actually removed
+        '''
+        with self.connection:
+            cursor = self.connection.executemany(
+                'DELETE FROM entry WHERE dsid=?',
+                [(dsid,) for dsid in dsids],
+            )
+        return max(cursor.rowcount, 0)
+
+    def get_picture(self, dsid):
+        '''
+        Given a DSID, return just the jpeg bytes of their picture or None
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT picture FROM entry WHERE dsid=?', (dsid,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return bytes(row['picture'])
+
+    def get_pictures(self, dsids):
+        '''
+        Given a list of DSIDs, return a dictionary of DSID to jpeg bytes
+        for those that exist, all in one query
+        '''
+        dsids = list(dsids)
+        if not dsids:
+            return {}
+        statement = 'SELECT dsid, picture FROM entry WHERE dsid IN ({})'.format(
+            ', '.join('?' * len(dsids))
+        )
+        cursor = self.connection.cursor()
+        cursor.execute(statement, dsids)
+        return dict((row['dsid'], bytes(row['picture'])) for row in cursor)
+
     def put(self, entry):
         '''
         Given an Entry tuple, insert this into the database,
         overwriting any prior matching entry by DSID
         '''
         cursor = self.connection.cursor()
-        statement = 'INSERT OR REPLACE INTO entry VALUES(?, ?, ?, ?)'
-        values = (
-            entry.dsid,
-            entry.name,
-            sqlite3.Binary(nparray_to_bin(entry.facial_encoding)),
-            sqlite3.Binary(entry.picture),
-        )
-        cursor.execute(statement, values)
+        cursor.execute(PUT_STATEMENT, entry_to_values(entry))
         self.connection.commit()
 
+    def put_many(self, entries, batch_size=BATCH_SIZE):
+        '''
+        Given an iterable of Entry tuples, insert them all like put, but
+        batch_size at a time in one transaction each, which saves a commit
+        and its fsync per row.  Returns how many entries were written.
+        '''
+        entries = iter(entries)
+        written = 0
+        while True:
+            batch = [
+                entry_to_values(entry)
+                for entry in itertools.islice(entries, batch_size)
+            ]
+            if not batch:
+                return written
+
+            # The connection as a context manager commits or rolls back
+            with self.connection:
+                self.connection.executemany(PUT_STATEMENT, batch)
+            written += len(batch)
+            logger.info('Wrote %s entries', written)
+
+    def encoding_chunks(self, chunk_size, changed_only=False):
+        '''
+        Generates the encodings in the DB in order of dsid, chunk_size at a
+        time, as tuples of an array of dsids, a float32 matrix of their
+        encodings, and a list of their (photo_hash, model_version).  Only
+        the entries that changed since they were clustered, if changed_only.
+        '''
+        if changed_only:
+            source = '''
+                entry LEFT JOIN cluster_member AS member USING (dsid)
+                WHERE {}
+            '''.format(CHANGED_SINCE_CLUSTERED)
+        else:
+            source = 'entry'
+        statement = '''
+            SELECT entry.dsid, entry.facial_encoding,
+                   entry.photo_hash, entry.model_version
+            FROM {}
+            ORDER BY entry.dsid
+        '''.format(source)
+        cursor = self.connection.cursor()
+        cursor.execute(statement)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield (
+                numpy.array([row['dsid'] for row in rows], dtype=numpy.int64),
+                numpy.array(
+                    [bin_to_nparray(row['facial_encoding']) for row in rows],
+                    dtype=numpy.float32,
+                ),
+                [(row['photo_hash'], row['model_version']) for row in rows],
+            )
+
+    @contextlib.contextmanager
+    def bulk_load(self):
+        '''
+        Tunes the database for writing lots of rows at once and then
+        puts it back.  Use together with put_many.
+
+        The journal is switched to write ahead logging, which stays on
+        since it also lets readers carry on while we write, and syncing to
+        disk only happens at checkpoints rather than every commit.  A crash
+        can lose the last few commits but never corrupts the database.
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('PRAGMA synchronous')
+        synchronous = cursor.fetchone()[0]
+
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        try:
+            yield self
+        finally:
+            self.connection.commit()
+            cursor.execute('PRAGMA synchronous={}'.format(int(synchronous)))
+            cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+class Clusters(object):
+    '''
+    The clusters of a Database, each a centroid and the members nearest it
+
+    None of this changes the revision, since the entries it's derived from
+    don't change, so snapshots and sidecars aren't rebuilt for it.
+    '''
+
+    def __init__(self, database):
+        self.database = database
+
+    def count_changed(self):
+        '''
+        Returns how many entries changed since they were clustered
+        '''
+        cursor = self.database.connection.cursor()
+        cursor.execute('''
+            SELECT count(*)
+            FROM entry LEFT JOIN cluster_member AS member USING (dsid)
+            WHERE {}
+        '''.format(CHANGED_SINCE_CLUSTERED))
+        return cursor.fetchone()[0]
+
+    def get_centroids(self):
+        '''
+        Returns the centroids of the clusters as a float32 matrix and how
+        many encodings each has been trained on, both in order of id
+        '''
+        cursor = self.database.connection.cursor()
+        cursor.execute('SELECT centroid, weight FROM cluster ORDER BY id')
+        rows = cursor.fetchall()
+        centroids = numpy.array(
+            [bin_to_nparray(row['centroid']) for row in rows],
+            dtype=numpy.float32,
+        )
+        weights = numpy.array([row['weight'] for row in rows], dtype=numpy.int64)
+        return centroids, weights
+
+    def put_centroids(self, centroids, weights):
+        '''
+        Replaces every cluster with the given centroids and weights, and
+        with them every member if the number of clusters changed, since
+        their clusters no longer exist
+        '''
+        with self.database.connection:
+            if len(centroids) != len(self.get_centroids()[0]):
+                self.database.connection.execute('DELETE FROM cluster_member')
+            self.database.connection.execute('DELETE FROM cluster')
+            self.database.connection.executemany(
+                'INSERT INTO cluster (id, centroid, weight) VALUES (?, ?, ?)',
+                [
+                    (index, sqlite3.Binary(nparray_to_bin(centroid)), int(weight))
+                    for (index, (centroid, weight)) in enumerate(zip(centroids, weights))
+                ],
+            )
+
+    def put_members(self, members):
+        '''
+        Given an iterable of (dsid, cluster, distance to its centroid,
+        photo_hash, model_version), puts each dsid in its cluster
+        '''
+        with self.database.connection:
+            self.database.connection.executemany(
+                '''
+                INSERT OR REPLACE INTO cluster_member (
+                    dsid, cluster, distance, photo_hash, model_version
+                ) VALUES (?, ?, ?, ?, ?)
+                ''',
+                members,
+            )
+
+    def delete_stale_members(self):
+        '''
+        Takes everyone who's no longer in the DB out of their clusters,
+        returning how many were in each cluster as a dictionary
+        '''
+        cursor = self.database.connection.cursor()
+        cursor.execute('''
+            SELECT cluster, count(*) AS size FROM cluster_member
+            WHERE dsid NOT IN (SELECT dsid FROM entry)
+            GROUP BY cluster
+        ''')
+        removed = dict((row['cluster'], row['size']) for row in cursor)
+        with self.database.connection:
+            self.database.connection.execute(
+                'DELETE FROM cluster_member WHERE dsid NOT IN (SELECT dsid FROM entry)'
+            )
+        return removed
+
+    def get_members(self):
+        '''
+        Returns a list of (cluster, dsid, name, distance to its centroid)
+        of everyone clustered, by cluster and then nearest first
+        '''
+        cursor = self.database.connection.cursor()
+        cursor.execute('''
+            SELECT member.cluster, member.dsid, entry.name, member.distance
+            FROM cluster_member AS member JOIN entry USING (dsid)
+            ORDER BY member.cluster, member.distance, member.dsid
+        ''')
+        return [
+            (row['cluster'], row['dsid'], row['name'], row['distance'])
+            for row in cursor
+        ]
+
+
+class Faceless(object):
+    '''
+    The photos of a Database that no face was found in, which aren't
+    entries but are remembered so that init doesn't look at them again
+    until they change
+
+    These aren't searched, so they don't change the revision either.
+    '''
+
+    def __init__(self, database):
+        self.database = database
+
+    def get_fingerprints(self):
+        '''
+        Returns a dictionary of every DSID without a face to a tuple of the
+        photo_hash and model_version it was looked for with
+        '''
+        cursor = self.database.connection.cursor()
+        cursor.execute('SELECT dsid, photo_hash, model_version FROM faceless')
+        return dict(
+            (row['dsid'], (row['photo_hash'], row['model_version']))
+            for row in cursor
+        )
+
+    def put_many(self, fingerprints):
+        '''
+        Given an iterable of (dsid, photo_hash, model_version), remembers
+        that no face was found in each of those photos
+        '''
+        with self.database.connection:
+            self.database.connection.executemany(
+                '''
+                INSERT OR REPLACE INTO faceless (dsid, photo_hash, model_version)
+                VALUES (?, ?, ?)
+                ''',
+                fingerprints,
+            )
+
+    def delete_many(self, dsids):
+        '''
+        Forgets the photos of every DSID given
+        '''
+        with self.database.connection:
+            self.database.connection.executemany(
+                'DELETE FROM faceless WHERE dsid=?',
+                [(dsid,) for dsid in dsids],
+            )
+
+    def delete_found(self):
+        '''
+        Forgets the photos of every DSID that has since been found with a
+        face in a new photo
+        '''
+        with self.database.connection:
+            self.database.connection.execute(
+                'DELETE FROM faceless WHERE dsid IN (SELECT dsid FROM entry)'
+            )
+
+
+def entry_to_values(entry):
+    '''
+    Converts an Entry into the values of a row in the DB, in column order
+    '''
+    return (
+        entry.dsid,
+        entry.name,
+        sqlite3.Binary(nparray_to_bin(entry.facial_encoding)),
+        sqlite3.Binary(entry.picture),
+        entry.photo_hash,
+        entry.model_version,
+    )
+
 
 def nparray_to_bin(nparray):
     '''
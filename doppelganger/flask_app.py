@@ -3,29 +3,86 @@ Defines the flask web service part of this repository (as opposed to the CLI)
 '''
 
 import base64
-import collections
+import hashlib
 import json
+import threading
+import time
 
 from flask import (
     Flask,
+    abort,
+    g,
     url_for,
     redirect,
     request,
+    stream_with_context,
 )
+from testlogger import logger
 
 from . import (
     ml,
     db,
     logic,
+    lru,
+    profiles,
+    responses,
+    scheduler,
+    search,
+    snapshot,
+    timings,
 )
 
 
 APP = Flask(__name__, static_url_path='')
 
 
+# These can be overridden by a file of settings named by this env variable
+APP.config.from_mapping(
+    # Seconds that /process waits to batch an upload with others
+    BATCH_WINDOW=0.01,
+    # The most uploads processed in one batch
+    BATCH_SIZE=32,
+    # The most uploads waiting for a batch before turning more away
+    BATCH_QUEUE=256,
+    # Seconds between checks for a changed database to load
+    SNAPSHOT_INTERVAL=5.0,
+    # Seconds the database has to go unchanged before it's loaded, so that
+    # a long init isn't loaded again after every batch it writes
+    SNAPSHOT_SETTLE=30.0,
+    # How many lists of the approximate index to probe per face, if
+    # build-index made one, or None to search every employee
+    NPROBE=None,
+    # Unless searching the index, how many candidates per face a quantized first pass
+    # keeps to re-rank exactly, or None to search exactly from the start
+    QUANTIZED_CANDIDATES=None,
+    # Unless searching the index, how many threads search each face, in parallel
+    SEARCH_SHARDS=1,
+    # The profiles.PROFILES profile uploads are run through
+    PROFILE=profiles.DEFAULT_PROFILE,
+    # The most uploads whose results are remembered, 0 to turn that off
+    RESULT_CACHE_SIZE=256,
+    # Seconds that the results of an upload are remembered for
+    RESULT_CACHE_TTL=60.0,
+    # Whether /process leaves pictures out for the browser to get by dsid
+    COMPACT_RESPONSES=True,
+    # Whether to time each stage of /process for /metrics
+    TIMINGS=True,
+)
+APP.config.from_envvar('DOPPELGANGER_SETTINGS', silent=True)
+timings.enable(APP.config['TIMINGS'])
+
+
 CACHE = {}
 
 
+# Guards creating things in CACHE that there must only ever be one of
+CACHE_LOCK = threading.Lock()
+
+
+# Set once warm_up has loaded and run everything /process needs
+READY = threading.Event()
+
+
 @APP.route('/')
 def index():
     '''
@@ -34,13 +91,6 @@ def index():
     return redirect(url_for('static', filename='index.html'))
 
 
-Response = collections.namedtuple('Response', {
-    'location',
-    'landmarks',
-    'twins',
-})
-
-
 @APP.route('/process', methods=['POST'])
 def process():
     '''
@@ -48,23 +98,186 @@ def process():
     '''
     image_uri = request.form['image_uri']
     _data_header, encoded_data = image_uri.split(',')
-    image_bytes = base64.b64decode(encoded_data)
-
-    file_name = ml.save_bytes_to_file(image_bytes)
-    pipeline_results = ml.calculate_encoding_for_image(file_name, get_pipeline())
-
-    responses = []
-    for pipeline_result in pipeline_results:
-        twins = logic.compare(pipeline_result.encoding, get_employees(), 20)
-        response = Response(
-            location=pipeline_result.location,
-            landmarks=pipeline_result.landmarks,
-            twins=twins,
-        )
+    with timings.stage('b64_decode'):
+        image_bytes = base64.b64decode(encoded_data)
+
+    # The webcam often sends the very same frame again, so remember results
+    # by the image's contents for as long as the employees don't change
+    key = hashlib.sha1(image_bytes).digest()
+    version = get_snapshot().version
+    results = get_result_cache().get(key, version)
+    if results is None:
+        try:
+            results = get_batcher().submit(image_bytes)
+        except scheduler.Overloaded:
+            abort(503)
+        except ValueError:
+            abort(400)
+        get_result_cache().put(key, results, version)
+
+    for (_, twins) in results:
         logic.print_twins(twins)
-        responses.append(response)
 
-    return json.dumps(responses)
+    if wants_compact():
+        with timings.stage('json'):
+            body = responses.dumps(results)
+        return APP.response_class(body, mimetype='application/json')
+
+    # Embedded pictures make for big responses, so send them a face at a
+    # time as they're written, looking up each face's pictures as we go
+    return APP.response_class(
+        stream_with_context(responses.stream(
+            results,
+            compact=False,
+            get_pictures=get_database().get_pictures,
+        )),
+        mimetype='application/json',
+    )
+
+
+def wants_compact():
+    '''
+    Whether to leave pictures out of the /process response, as asked for
+    by the request's compact field, or else by the COMPACT_RESPONSES setting
+    '''
+    compact = request.form.get('compact')
+    if compact is None:
+        return APP.config['COMPACT_RESPONSES']
+    return compact.lower() not in ('0', 'false', 'no')
+
+
+def process_images(images):
+    '''
+    Processes a batch of uploaded images on the batcher's thread, returning
+    for each a list of (PipelineResult, Twins without pictures) per face,
+    or the error if it couldn't be decoded
+
+    All the faces of all the images are encoded in one batch, then all of
+    their twins are found with one pass over the employees.
+    '''
+    decoded = []
+    results = []
+    for image_bytes in images:
+        try:
+            decoded.append(ml.decode_image(image_bytes))
+            results.append([])
+        except ValueError as error:
+            results.append(error)
+
+    pipeline_results = ml.calculate_encodings_for_images(
+        decoded,
+        get_pipeline(),
+        APP.config['PROFILE'],
+    )
+    faces = [face for image_results in pipeline_results for face in image_results]
+    twins = iter(logic.find_twins_many(
+        get_snapshot().searcher,
+        [face.encoding for face in faces],
+        20,
+    ))
+
+    # Hand the faces and twins back out to the images they came from
+    image_results = iter(pipeline_results)
+    for result in results:
+        if isinstance(result, Exception):
+            continue
+        for face in next(image_results):
+            result.append((face, next(twins)))
+    return results
+
+
+def get_batcher():
+    '''
+    Returns the scheduler that batches uploads for process_images
+
+    It has the only thread that runs the pipeline and searches, so those
+    never compete with each other for the CPU across request threads
+    '''
+    if 'batcher' not in CACHE:
+        with CACHE_LOCK:
+            if 'batcher' not in CACHE:
+                CACHE['batcher'] = scheduler.MicroBatcher(
+                    process_images,
+                    window=APP.config['BATCH_WINDOW'],
+                    max_batch=APP.config['BATCH_SIZE'],
+                    max_queue=APP.config['BATCH_QUEUE'],
+                )
+    return CACHE['batcher']
+
+
+def get_result_cache():
+    '''
+    Returns the lru.LRUCache of the results of recent uploads
+    '''
+    if 'results' not in CACHE:
+        with CACHE_LOCK:
+            if 'results' not in CACHE:
+                CACHE['results'] = lru.LRUCache(
+                    max_size=APP.config['RESULT_CACHE_SIZE'],
+                    max_age=APP.config['RESULT_CACHE_TTL'],
+                )
+    return CACHE['results']
+
+
+@APP.route('/metrics')
+def metrics():
+    '''
+    How long each stage of processing uploads takes, for Prometheus
+    '''
+    return APP.response_class(
+        timings.prometheus(),
+        mimetype='text/plain; version=0.0.4',
+    )
+
+
+@APP.route('/stats/cache')
+def cache_stats():
+    '''
+    How well the cache of upload results is doing, to help size it
+    '''
+    return json.dumps(get_result_cache().stats())
+
+
+@APP.route('/picture/<int:dsid>')
+def picture(dsid):
+    '''
+    The jpeg of a single employee, cacheable by the browser so that faces
+    don't need to be sent again with every response they appear in.  The
+    browser checks its copy against the ETag every time, so a picture
+    replaced by a new init shows up straight away, for just a 304 when it
+    hasn't been.
+    '''
+    jpeg = get_database().get_picture(dsid)
+    if jpeg is None:
+        abort(404)
+
+    response = APP.response_class(jpeg, mimetype='image/jpeg')
+    response.set_etag(hashlib.sha1(jpeg).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def get_database():
+    '''
+    Returns a connection to the database for the current request
+
+    sqlite connections can't be shared across threads, so each request
+    gets its own, which is closed by close_database when the request ends
+    '''
+    if 'database' not in g:
+        g.database = db.Database(db.DB_PATH)
+    return g.database
+
+
+@APP.teardown_appcontext
+def close_database(_):
+    '''
+    Closes the connection opened by get_database, if any
+    '''
+    database = g.pop('database', None)
+    if database is not None:
+        database.connection.close()
 
 
 def get_pipeline():
@@ -74,16 +287,78 @@ def get_pipeline():
     This allows us to not build the pipeline for each request, but just once
     '''
     if 'pipeline' not in CACHE:
-        CACHE['pipeline'] = ml.get_pipeline()
+        with CACHE_LOCK:
+            if 'pipeline' not in CACHE:
+                CACHE['pipeline'] = ml.get_pipeline()
     return CACHE['pipeline']
 
 
-def get_employees():
+def get_snapshot():
     '''
-    Returns the full list of employee data in memory
+    Returns the current snapshot.Snapshot of the employees in memory
 
-    This allows us to not build this list from disk every request
+    This allows us to not load the employees from disk every request, while
+    still picking up a new init or build-index without a restart.  Get it
+    once per request so that the whole request sees the same employees.
     '''
-    if 'employees' not in CACHE:
-        CACHE['employees'] = db.Database(db.DB_PATH).get_all()
-    return CACHE['employees']
+    if 'snapshots' not in CACHE:
+        with CACHE_LOCK:
+            if 'snapshots' not in CACHE:
+                CACHE['snapshots'] = snapshot.Refresher(
+                    db.DB_PATH,
+                    APP.config['SNAPSHOT_INTERVAL'],
+                    APP.config['SNAPSHOT_SETTLE'],
+                    candidates=APP.config['QUANTIZED_CANDIDATES'],
+                    shards=APP.config['SEARCH_SHARDS'],
+                    nprobe=APP.config['NPROBE'],
+                )
+    return CACHE['snapshots'].get()
+
+
+@APP.route('/ready')
+def ready():
+    '''
+    Whether the server has warmed up and is ready for /process, for load
+    balancers to wait on before sending users here
+    '''
+    response = APP.response_class(
+        json.dumps({'ready': READY.is_set()}),
+        mimetype='application/json',
+    )
+    if not READY.is_set():
+        response.status_code = 503
+    return response
+
+
+def start():
+    '''
+    Starts warming up in the background, so that the server can already
+    answer /ready while it does.  Returns the thread doing it.
+    '''
+    thread = threading.Thread(target=warm_up, name='warm-up')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def warm_up():
+    '''
+    Loads the models and employees and runs each once, so that the first
+    user after a deploy doesn't wait on any of that, then marks us READY
+    '''
+    start_time = time.time()
+    try:
+        ml.warm_up(get_pipeline(), APP.config['PROFILE'])
+        logic.find_twins_many(
+            get_snapshot().searcher,
+            [[0.0] * search.ENCODING_SIZE],
+            20,
+        )
+        get_batcher()
+    except Exception:  # pylint: disable=broad-except
+        # Stay not ready, so that this server never gets any traffic
+        logger.exception('Could not warm up')
+        return
+
+    READY.set()
+    logger.info('Warmed up and ready in %.2fs', time.time() - start_time)
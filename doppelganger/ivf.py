@@ -0,0 +1,271 @@
+'''
+An approximate nearest neighbour index (IVF) over the facial encodings
+
+A coarse k-means quantizer splits the corpus into lists of similar faces.
+A query only scans the `nprobe` lists whose centroids are closest to it,
+instead of every employee, trading a little recall for a lot of speed.
+'''
+
+import os
+import time
+
+import numpy
+from testlogger import logger
+
+from . import (
+    cluster,
+    search,
+)
+
+
+# How many of the nearest lists a query scans unless told otherwise
+DEFAULT_NPROBE = 8
+
+
+def get_index_path(database_path):
+    '''
+    The index is persisted next to the database it was built from
+    '''
+    return os.path.splitext(database_path)[0] + '.ivf.npz'
+
+
+def default_list_count(size):
+    '''
+    The usual rule of thumb, roughly sqrt(N) lists of sqrt(N) faces each
+    '''
+    return max(1, int(round(numpy.sqrt(size))))
+
+
+class IVFIndex(search.MatrixView):
+    '''
+    Inverted lists over a search.EncodingMatrix.  Its nearest and
+    nearest_many only look through the lists nearest each query, and work
+    out exact distances to everyone in them, so there's no first pass.
+    '''
+
+    def __init__(self, matrix, centroids, labels, nprobe=DEFAULT_NPROBE):
+        '''
+        labels[i] is the list that row i of the matrix belongs to
+        '''
+        self.matrix = matrix
+        self.centroids = numpy.asarray(centroids, dtype=numpy.float32)
+        self.nprobe = nprobe
+
+        # Rows are regrouped by list so that each list is one contiguous
+        # block of encodings, and offsets says where each list starts
+        self.rows = numpy.argsort(labels, kind='mergesort')
+        sizes = numpy.bincount(labels, minlength=len(self.centroids))
+        self.offsets = numpy.concatenate([[0], numpy.cumsum(sizes)])
+        self._encodings = None
+
+    @property
+    def encodings(self):
+        '''
+        The encodings of the matrix regrouped by list, copied out of the
+        matrix the first time they're needed unless they've been set from
+        somewhere shared first, like sidecar.share_index does
+        '''
+        if self._encodings is None:
+            self._encodings = self.matrix.encodings[self.rows]
+        return self._encodings
+
+    @encodings.setter
+    def encodings(self, encodings):
+        self._encodings = encodings
+
+    @classmethod
+    def train(cls, matrix, list_count=None, iterations=20, seed=0):
+        '''
+        Trains the coarse quantizer over every encoding in the matrix
+        and files each row under its nearest centroid
+        '''
+        if list_count is None:
+            list_count = default_list_count(len(matrix))
+        logger.info('Training %s lists over %s faces', list_count, len(matrix))
+        centroids = cluster.kmeans(matrix.encodings, list_count, iterations, seed)
+        return cls(matrix, centroids, cluster.assign(matrix.encodings, centroids))
+
+    def save(self, path):
+        '''
+        Writes the centroids and the dsids in each list to path
+
+        Lists are stored by dsid rather than by row so that the index
+        still lines up with a matrix loaded in a different order
+        '''
+        logger.info('Saving index to %s', path)
+        labels = numpy.empty(len(self.rows), dtype=numpy.int32)
+        labels[self.rows] = numpy.repeat(
+            numpy.arange(len(self.centroids)),
+            numpy.diff(self.offsets),
+        )
+        with open(path, 'wb') as handle:
+            numpy.savez(
+                handle,
+                centroids=self.centroids,
+                dsids=self.matrix.dsids,
+                labels=labels,
+            )
+
+    @classmethod
+    def load(cls, path, matrix, nprobe=DEFAULT_NPROBE):
+        '''
+        Reads an index written by save and lines it up with matrix
+
+        Employees that have since been removed are dropped and new ones are
+        filed under their nearest centroid, so a slightly stale index is
+        still correct, just a little less well balanced.
+        '''
+        logger.info('Loading index from %s', path)
+        with numpy.load(path, allow_pickle=False) as saved:
+            centroids = saved['centroids']
+            labels = match_labels(saved['dsids'], saved['labels'], matrix.dsids)
+
+        unknown = numpy.flatnonzero(labels < 0)
+        if len(unknown):
+            logger.info('Filing %s faces missing from the index', len(unknown))
+            labels[unknown] = cluster.assign(matrix.encodings[unknown], centroids)
+
+        return cls(matrix, centroids, labels, nprobe)
+
+    def nearest(self, encoding, count, nprobe=None):
+        '''
+        Returns a tuple of (indices, distances) of the matrix rows closest
+        to encoding, looking only in the nprobe lists nearest to it
+        '''
+        if nprobe is None:
+            nprobe = self.nprobe
+        nprobe = max(1, min(nprobe, len(self.centroids)))
+
+        query = numpy.asarray(encoding, dtype=numpy.float32)
+        centroid_distances = numpy.linalg.norm(self.centroids - query, axis=1)
+        probed = numpy.argpartition(centroid_distances, nprobe - 1)[:nprobe]
+
+        positions = numpy.concatenate([
+            numpy.arange(self.offsets[probe], self.offsets[probe + 1])
+            for probe in probed
+        ])
+        differences = self.encodings[positions] - query
+        distances = numpy.sqrt(numpy.einsum('ij,ij->i', differences, differences))
+
+        return search.closest(distances, count, self.rows[positions])
+
+    def nearest_many(self, encodings, count, nprobe=None):
+        '''
+        Like nearest, for each row of a matrix of query encodings.  Every
+        list is scanned at most once, for all the queries that probe it.
+        '''
+        if nprobe is None:
+            nprobe = self.nprobe
+        nprobe = max(1, min(nprobe, len(self.centroids)))
+
+        queries = search.as_queries(encodings)
+        centroid_distances = numpy.linalg.norm(
+            queries[:, numpy.newaxis] - self.centroids,
+            axis=2,
+        )
+        probed = numpy.argpartition(centroid_distances, nprobe - 1, axis=1)
+        probed = probed[:, :nprobe]
+
+        found_positions = [[] for _ in queries]
+        found_distances = [[] for _ in queries]
+        for probe in numpy.unique(probed):
+            probing = numpy.flatnonzero((probed == probe).any(axis=1))
+            (positions, distances) = self.scan_list(probe, queries[probing])
+            for (query, query_distances) in zip(probing, distances):
+                found_positions[query].append(positions)
+                found_distances[query].append(query_distances)
+
+        return [
+            search.closest(
+                numpy.concatenate(query_distances),
+                count,
+                self.rows[numpy.concatenate(positions)],
+            )
+            for (positions, query_distances)
+            in zip(found_positions, found_distances)
+        ]
+
+    def scan_list(self, probe, queries):
+        '''
+        Returns the positions of the encodings in one list and a matrix of
+        their distances to each of the queries
+        '''
+        positions = numpy.arange(self.offsets[probe], self.offsets[probe + 1])
+        differences = (
+            self.encodings[positions][numpy.newaxis]
+            - queries[:, numpy.newaxis]
+        )
+        return positions, numpy.sqrt(
+            numpy.einsum('ijk,ijk->ij', differences, differences)
+        )
+
+
+def match_labels(saved_dsids, saved_labels, dsids):
+    '''
+    Looks up the saved list of each of dsids, or -1 if it wasn't saved
+    '''
+    labels = numpy.full(len(dsids), -1, dtype=numpy.intp)
+    if not len(saved_dsids):  # pylint: disable=len-as-condition
+        return labels
+
+    order = numpy.argsort(saved_dsids)
+    positions = order[numpy.minimum(
+        numpy.searchsorted(saved_dsids, dsids, sorter=order),
+        len(order) - 1,
+    )]
+    found = saved_dsids[positions] == dsids
+    labels[found] = saved_labels[positions[found]]
+    return labels
+
+
+def recall_report(matrix, ivf_index, nprobes, count=20, query_count=100):
+    '''
+    Compares the index against the exact search over the whole matrix, the
+    same ranking logic.compare gives, for a sample of stored faces as queries
+
+    Returns a list of (nprobe, recall at count, milliseconds per query),
+    with the exact search itself reported as an nprobe of None.
+    '''
+    random = numpy.random.RandomState(0)
+    query_count = min(query_count, len(matrix))
+    queries = matrix.encodings[
+        random.choice(len(matrix), query_count, replace=False)
+    ]
+
+    start = time.time()
+    truths = [set(matrix.nearest(query, count)[0].tolist()) for query in queries]
+    report = [(None, 1.0, (time.time() - start) * 1000 / max(1, query_count))]
+
+    for nprobe in nprobes:
+        recall, elapsed = measure_probe(ivf_index, queries, truths, count, nprobe)
+        report.append((nprobe, recall, elapsed))
+
+    return report
+
+
+def measure_probe(ivf_index, queries, truths, count, nprobe):
+    '''
+    Returns the recall and milliseconds per query of the index at one nprobe
+    '''
+    found = 0
+    start = time.time()
+    for (query, truth) in zip(queries, truths):
+        indices, _ = ivf_index.nearest(query, count, nprobe)
+        found += len(truth.intersection(indices.tolist()))
+    elapsed = (time.time() - start) * 1000 / max(1, len(queries))
+    recall = float(found) / max(1, sum(len(truth) for truth in truths))
+    return recall, elapsed
+
+
+def print_report(report):
+    '''
+    Logs the output of recall_report as a small table
+    '''
+    logger.info('%8s %10s %12s', 'nprobe', 'recall', 'ms/query')
+    for (nprobe, recall, elapsed) in report:
+        logger.info(
+            '%8s %10.4f %12.3f',
+            'exact' if nprobe is None else nprobe,
+            recall,
+            elapsed,
+        )
@@ -5,10 +5,15 @@ Things that interact with ldap
 import base64
 
 import ldap
+from ldap.controls import SimplePagedResultsControl
 
 from testlogger import logger
 
 
+# How many employees to ask the server for at a time
+PAGE_SIZE = 500
+
+
 def init_ldap():
     '''
     Initializes a connection to the ldap server
@@ -40,40 +45,83 @@ def get_filter_string():
     )
 
 
-def get_employees(ldap_instance):
+def get_employees(ldap_instance, page_size=PAGE_SIZE):
     '''
     This is a generator where, given an LDAP instance, we ask it for all Apple
     Employees with photos, returning a dictionary of name, id, and photo
+
+    Results come a page at a time using RFC 2696 paged results.  Each page
+    needs the cookie from the one before it, so at most one more can be in
+    flight, and we ask for it before processing the current page so that
+    the server works on it while we do.  This stops after the last page.
     '''
-    logger.info('Getting employees')
-    result_id = ldap_instance.search(
+    logger.info('Getting employees %s at a time', page_size)
+    control = SimplePagedResultsControl(True, size=page_size, cookie='')
+    message_id = search_page(ldap_instance, control)
+    pages = 0
+    while message_id is not None:
+        # The first value is the result-type which is unused
+        (_, result_datas, _, server_controls) = ldap_instance.result3(
+            msgid=message_id,
+        )
+        pages += 1
+
+        control.cookie = get_cookie(server_controls)
+        if control.cookie:
+            message_id = search_page(ldap_instance, control)
+        else:
+            message_id = None
+
+        for result_data in result_datas:
+            # Search references point elsewhere and have no attributes
+            if result_data[0] is None:
+                continue
+            yield process_entry(result_data)
+
+    logger.info('Got all employees in %s pages', pages)
+
+
+def search_page(ldap_instance, control):
+    '''
+    Asks for the page of employees after control's cookie, without waiting
+    for it, returning the message id to get the results with
+    '''
+    return ldap_instance.search_ext(
         "o=Apple",
         ldap.SCOPE_SUBTREE,  # pylint: disable=maybe-no-member
         filterstr=get_filter_string(),
         attrlist=['applePhotoOfficial-jpeg', 'cn', 'appledsId'],
+        serverctrls=[control],
     )
-    while True:
-        # The first value is the result-type which is unused
-        (_, result_datas) = ldap_instance.result(
-            msgid=result_id,
-            all=0,
-        )
-        yield process_result(result_datas)
 
 
-def process_result(result_datas):
+def get_cookie(server_controls):
     '''
-    Given an ldap result, returns a normal looking dictionary pulling out
-    all the values from their wrapping arrays and stuff.
+    Returns the cookie for the next page from the controls the server sent
+    back with a page, which is empty once there are no more pages
     '''
-    logger.info('Processing employee')
+    for control in server_controls or []:
+        if control.controlType == SimplePagedResultsControl.controlType:
+            return control.cookie
+    logger.warning('Server ignored the paged results control')
+    return None
 
-    # The docs are ambiguous on twhat result_data is so I'm guessing here
-    # and asserting my assumptions.  I think it's always an array of 1
-    # because we set all=0 which returns results one at a time.  I guess if
-    # I passed all=1, then result_data would be a list of all results.
+
+def process_result(result_datas):
+    '''
+    Given an ldap result of a single entry, returns a normal looking
+    dictionary pulling out all the values from their wrapping arrays.
+    '''
     assert len(result_datas) == 1
-    result_data = result_datas[0]
+    return process_entry(result_datas[0])
+
+
+def process_entry(result_data):
+    '''
+    Given one entry of an ldap result, returns a normal looking dictionary
+    pulling out all the values from their wrapping arrays and stuff.
+    '''
+    logger.info('Processing employee')
 
     # The first value is the distinguished name (dn), we don't use it
     (_, attributes) = result_data
@@ -4,11 +4,14 @@ This module contains the business logic around gluing things together
 
 import base64
 import collections
-import heapq
 
-import numpy
 from testlogger import logger
 
+from . import (
+    search,
+    timings,
+)
+
 
 Twin = collections.namedtuple('Twin', [
     'distance',  # Some number between 0 and 1, 1 being far, 0 being identical
@@ -31,42 +34,93 @@ def print_twins(twins):
         )
 
 
-def compare(candidate_facial_encoding, employees, count):
+def find_twins(matrix, candidate_facial_encoding, count, get_pictures=None):
     '''
-    Given some target facial encoding, find the `count` most
-    similar employees as a tuple of (distance, Entry)
+    Given a search.EncodingMatrix and some target facial encoding, find the
+    `count` most similar employees as Twins, nearest first
+
+    Ranking only looks at ids and distances.  Pictures are fetched for the
+    survivors afterwards through get_pictures, which is given a list of
+    dsids and returns a dictionary of dsid to jpeg bytes, for example
+    db.Database.get_pictures.  Without it, Twins have no picture.
     '''
     logger.info('Comparing')
-    twins = []
-    for employee in employees:
-        distance = numpy.linalg.norm(
-            employee.facial_encoding - candidate_facial_encoding
-        )
+    with timings.stage('compare'):
+        indices, distances = matrix.nearest(candidate_facial_encoding, count)
+    return add_pictures(make_twins(matrix, indices, distances), get_pictures)
+
+
+def find_twins_many(matrix, candidate_facial_encodings, count, get_pictures=None):
+    '''
+    Like find_twins, but for many target facial encodings at once, which
+    is much cheaper than one at a time.  Returns a list of Twins per target.
+    '''
+    logger.info('Comparing %s faces', len(candidate_facial_encodings))
+    with timings.stage('compare'):
+        nearest = matrix.nearest_many(candidate_facial_encodings, count)
+    return [
+        add_pictures(make_twins(matrix, indices, distances), get_pictures)
+        for (indices, distances) in nearest
+    ]
+
 
-        # Unconditionally add, then remove the later
-        # We use negative distance because this is a min heap
-        # and we want to pop the furthest items efficiently
-        # Thus 0 aka identity would stay zero and be at the top
-        # 1 aka opposite would be -1 and would be popped first
-        twin = Twin(
-            -distance,
-            employee.name,
-            employee.dsid,
-            base64.b64encode(employee.picture),
+def make_twins(matrix, indices, distances):
+    '''
+    Turns matrix rows and their distances into Twins without pictures
+    '''
+    return [
+        Twin(
+            float(distance),
+            matrix.names[index],
+            int(matrix.dsids[index]),
+            None,
         )
-        heapq.heappush(twins, twin)
+        for (index, distance) in zip(indices, distances)
+    ]
 
-        while len(twins) > count:
-            heapq.heappop(twins)
 
-    # Before we return this, we should invert the distances
-    # again because it's more intuitive as a positive number
-    twins = [
-        Twin(-twin.distance, twin.name, twin.dsid, twin.picture)
+def add_pictures(twins, get_pictures):
+    '''
+    Fills in the pictures of twins using get_pictures, as in find_twins
+    '''
+    if not get_pictures:
+        return twins
+
+    pictures = get_pictures([twin.dsid for twin in twins])
+    return [
+        twin._replace(picture=encode_picture(pictures.get(twin.dsid)))
         for twin in twins
     ]
 
-    twins = sorted(twins, key=lambda twin: twin.distance)
 
-    # Return the twins with intuitive distances
-    return twins
+def encode_picture(picture):
+    '''
+    Base64 encodes a jpeg as text for embedding in a Twin, which json
+    can serialize, passing through None
+    '''
+    if picture is None:
+        return None
+    return base64.b64encode(picture).decode('ascii')
+
+
+def compare(candidate_facial_encoding, employees, count):
+    '''
+    Given some target facial encoding, find the `count` most
+    similar employees out of a list of db.Entry as Twins
+
+    Prefer building a search.EncodingMatrix once and calling find_twins
+    when comparing against the same employees more than once.
+    '''
+    employees = list(employees)
+    matrix = search.EncodingMatrix.from_entries(employees)
+    pictures = dict(
+        (int(employee.dsid), employee.picture) for employee in employees
+    )
+
+    def get_pictures(dsids):
+        '''
+        Looks up the pictures of the given dsids from the employees
+        '''
+        return dict((dsid, pictures[dsid]) for dsid in dsids)
+
+    return find_twins(matrix, candidate_facial_encoding, count, get_pictures)
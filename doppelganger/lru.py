@@ -0,0 +1,93 @@
+'''
+A small thread safe least recently used cache with an age limit, for
+results that are only good for as long as the employees they came from
+'''
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    '''
+    Maps keys to values, holding at most max_size of them for at most
+    max_age seconds each, and dropping the least recently used first.
+
+    Every get and put is given the version of whatever the values were
+    computed from, which must only ever go up.  Seeing a newer version
+    empties the cache, while a get from an older one just misses and a put
+    from one is ignored, so a value never outlives its version and a slow
+    request can't wipe out the values of the version after its own.
+    '''
+
+    def __init__(self, max_size=256, max_age=60.0, clock=time.time):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        self.version = None
+        self.counts = collections.Counter()
+
+    def get(self, key, version):
+        '''
+        Returns the value for key, or None if there isn't one
+        '''
+        with self.lock:
+            if not self.check_version(version):
+                self.counts['misses'] += 1
+                return None
+            item = self.items.get(key)
+            if item is None:
+                self.counts['misses'] += 1
+                return None
+
+            (stored, value) = item
+            if self.clock() - stored > self.max_age:
+                del self.items[key]
+                self.counts['expired'] += 1
+                self.counts['misses'] += 1
+                return None
+
+            self.items.move_to_end(key)
+            self.counts['hits'] += 1
+            return value
+
+    def put(self, key, value, version):
+        '''
+        Stores value for key, unless version is no longer the current one
+        '''
+        with self.lock:
+            if version != self.version:
+                return
+            self.items[key] = (self.clock(), value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.counts['evicted'] += 1
+
+    def check_version(self, version):
+        '''
+        Empties the cache if version is newer than the one its values came
+        from, and returns whether version is now the current one
+        '''
+        if self.version is None or version > self.version:
+            if self.items:
+                self.counts['invalidated'] += 1
+            self.items.clear()
+            self.version = version
+        return version == self.version
+
+    def stats(self):
+        '''
+        The counts of hits, misses and items dropped so far, and the size
+        '''
+        with self.lock:
+            stats = dict(
+                (name, self.counts[name])
+                for name in ['hits', 'misses', 'expired', 'evicted', 'invalidated']
+            )
+            stats['size'] = len(self.items)
+            stats['max_size'] = self.max_size
+            stats['max_age'] = self.max_age
+            return stats
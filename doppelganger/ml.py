@@ -6,11 +6,17 @@ import collections
 import os
 import tempfile
 
+import cv2
 import dlib
 import numpy
 
 from testlogger import logger
 
+from . import (
+    profiles,
+    timings,
+)
+
 
 Pipeline = collections.namedtuple('Pipeline', [
     'face_detector',
@@ -53,40 +59,186 @@ def get_pipeline():
     return Pipeline(face_detector, pose_analyzer, face_encoder)
 
 
-def calculate_encoding_for_image(file_name, pipeline):
+def calculate_encoding_for_image(file_name, pipeline, profile=profiles.DEFAULT_PROFILE):
     '''
     Given the path to some image, calculate the encoding for the faces.
     '''
-    face_image = dlib.load_rgb_image(file_name)  # pylint: disable=no-member
+    with open(file_name, 'rb') as handle:
+        return calculate_encoding_for_bytes(handle.read(), pipeline, profile)
 
-    face_locations = pipeline.face_detector(face_image, 1)
 
-    result = []
-    for location in face_locations:
-        result.append(calculate_encoding_for_face(
-            pipeline,
-            face_image,
-            location,
-        ))
+def calculate_encoding_for_bytes(image_bytes, pipeline, profile=profiles.DEFAULT_PROFILE):
+    '''
+    Given the bytes of a jpeg or png, calculate the encoding for the faces,
+    all in memory without going through a file on disk.  The faces of a
+    group photo are all encoded together in one batch.
+    '''
+    face_image = decode_image(image_bytes)
+    return calculate_encodings_for_images([face_image], pipeline, profile)[0]
 
-    logger.info('Found %s faces', len(result))
 
-    return result
+def calculate_encodings_for_images(face_images, pipeline, profile=profiles.DEFAULT_PROFILE):
+    '''
+    Given a list of decoded images, returns a list of the PipelineResults
+    for the faces in each.  Detection and landmarks run per image, but the
+    descriptors of every face in every image are computed in one batched
+    call, which the dlib ResNet does much faster than one face at a time.
+
+    The profile, a name from profiles.PROFILES or a profiles.Profile, picks how hard to look.
+    '''
+    # pylint: disable=no-member
+    profile = profiles.get_profile(profile)
+    locations = []
+    landmarks = []
+    for face_image in face_images:
+        with timings.stage('detection'):
+            face_locations = detect_faces(pipeline, face_image, profile)
+        face_landmarks = dlib.full_object_detections()
+        with timings.stage('landmarks'):
+            for location in face_locations:
+                face_landmarks.append(pipeline.pose_analyzer(face_image, location))
+        locations.append(face_locations)
+        landmarks.append(face_landmarks)
+
+    # The batched call wants only images that actually have faces in them
+    with_faces = [
+        index for (index, face_landmarks) in enumerate(landmarks)
+        if len(face_landmarks)  # pylint: disable=len-as-condition
+    ]
+    encodings = [[] for _ in face_images]
+    if with_faces:
+        with timings.stage('encoding'):
+            batch = pipeline.face_encoder.compute_face_descriptor(
+                [face_images[index] for index in with_faces],
+                [landmarks[index] for index in with_faces],
+                profile.jitter,
+            )
+        for (index, image_encodings) in zip(with_faces, batch):
+            encodings[index] = image_encodings
+
+    results = [
+        [
+            build_pipeline_result(location, face_landmarks, encoding)
+            for (location, face_landmarks, encoding)
+            in zip(face_locations, image_landmarks, image_encodings)
+        ]
+        for (face_locations, image_landmarks, image_encodings)
+        in zip(locations, landmarks, encodings)
+    ]
+
+    logger.info(
+        'Found %s faces in %s images',
+        sum(len(result) for result in results),
+        len(results),
+    )
+
+    return results
 
 
-def calculate_encoding_for_face(pipeline, face_image, location):
+def detect_faces(pipeline, face_image, profile):
     '''
-    Given the location of a single face to focus on, returns the
-    PipelineResult object containing the landmarks and encodings
-    for that one specific face.
+    Returns the locations of the faces in an image, found in a copy shrunk
+    to the profile's max_size but given in the full size image's coordinates
     '''
-    landmarks = pipeline.pose_analyzer(face_image, location)
-    encoding = pipeline.face_encoder.compute_face_descriptor(
+    # pylint: disable=no-member
+    scale = get_scale(face_image.shape, profile.max_size)
+    if scale == 1:
+        return pipeline.face_detector(face_image, profile.upsample)
+
+    small_image = cv2.resize(
         face_image,
-        landmarks,
-        1,  # Upsample once to make things bigger and detect more faces
+        None,
+        fx=scale,
+        fy=scale,
+        interpolation=cv2.INTER_AREA,
+    )
+    return dlib.rectangles([
+        scale_rectangle(location, 1 / scale)
+        for location in pipeline.face_detector(small_image, profile.upsample)
+    ])
+
+
+def get_scale(shape, max_size):
+    '''
+    How much to shrink an image of the given shape so that neither of its
+    sides is more than max_size, which is 1 if it already fits
+    '''
+    if max_size is None or max(shape[:2]) <= max_size:
+        return 1
+    return max_size / max(shape[:2])
+
+
+def scale_rectangle(location, scale):
+    '''
+    Returns a dlib.rectangle scaled about the origin of the image
+    '''
+    # pylint: disable=no-member
+    return dlib.rectangle(
+        int(round(location.left() * scale)),
+        int(round(location.top() * scale)),
+        int(round(location.right() * scale)),
+        int(round(location.bottom() * scale)),
     )
 
+
+def warm_up(pipeline, profile=profiles.DEFAULT_PROFILE):
+    '''
+    Runs every stage of the pipeline once on a made up image, so that the
+    models are paged in and their first slow run isn't a user's request
+    '''
+    # pylint: disable=no-member
+    image = make_warm_up_image()
+    calculate_encodings_for_images([image], pipeline, profile)
+
+    # There's no face in it to find, so make the rest of the pipeline run
+    # on a made up face in the middle anyway
+    (height, width) = image.shape[:2]
+    location = dlib.rectangle(width // 4, height // 4, width * 3 // 4, height * 3 // 4)
+    landmarks = dlib.full_object_detections()
+    landmarks.append(pipeline.pose_analyzer(image, location))
+    pipeline.face_encoder.compute_face_descriptor(
+        [image],
+        [landmarks],
+        profiles.get_profile(profile).jitter,
+    )
+
+
+def make_warm_up_image(size=256):
+    '''
+    A smooth made up image, put through jpeg and back just like an upload
+    '''
+    # pylint: disable=no-member
+    ramp = numpy.linspace(0, 255, size).astype(numpy.uint8)
+    image = numpy.dstack([
+        numpy.tile(ramp, (size, 1)),
+        numpy.tile(ramp[:, numpy.newaxis], (1, size)),
+        numpy.full((size, size), 128, dtype=numpy.uint8),
+    ])
+    _, jpeg = cv2.imencode('.jpg', image)
+    return decode_image(jpeg.tobytes())
+
+
+def decode_image(image_bytes):
+    '''
+    Decodes the bytes of a jpeg or png into an RGB numpy array, which is
+    the same thing dlib.load_rgb_image gives us but without needing a file
+    '''
+    # OpenCV is C-linked just like dlib, so pylint can't see its functions
+    # pylint: disable=no-member
+    with timings.stage('image_load'):
+        buffer_array = numpy.frombuffer(image_bytes, dtype=numpy.uint8)
+        image = cv2.imdecode(buffer_array, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Could not decode image')
+
+    # OpenCV decodes into BGR order but dlib expects RGB
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def build_pipeline_result(location, landmarks, encoding):
+    '''
+    Given the dlib answers for a single face, returns them as a PipelineResult
+    '''
     # Convert the dlib based answers into python primitives
     # This allows us to do future stuff like json dumps
     encoding = primitivize_encoding(encoding)
@@ -121,7 +273,7 @@ def primitivize_landmarks(landmarks):
     dictionary list of dictionaries that contain an x and a y (x, y).  This
     makes things json-able.
     '''
-    return map(point_to_dict, landmarks.parts())
+    return [point_to_dict(point) for point in landmarks.parts()]
 
 
 def primitivize_encoding(encoding):
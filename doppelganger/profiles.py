@@ -0,0 +1,59 @@
+'''
+Named ways of trading the accuracy of the machine learning pipeline for
+speed, kept apart from ml so that picking one doesn't need dlib loaded
+'''
+
+import collections
+
+
+# Identifies what produces the encodings.  Change this whenever the models
+# or how they are run changes, so init knows to encode every photo again.
+MODEL_VERSION = 'dlib_face_recognition_resnet_model_v1'
+
+
+Profile = collections.namedtuple('Profile', [
+    'max_size',  # Shrink images bigger than this on a side to detect, or None
+    'upsample',  # Times the detector upsamples, to find smaller faces
+    'jitter',  # Jittered copies of each face the encoder averages over
+])
+
+
+# Ways of trading accuracy for speed.  Shrinking only affects detection,
+# the landmarks and encodings still come from the full size image.
+PROFILES = {
+    'fast': Profile(max_size=480, upsample=0, jitter=1),
+    'balanced': Profile(max_size=1024, upsample=1, jitter=1),
+    'accurate': Profile(max_size=None, upsample=1, jitter=10),
+}
+
+
+DEFAULT_PROFILE = 'balanced'
+
+
+def get_profile(profile):
+    '''
+    Returns the Profile of the given name, or the Profile itself if given one
+    '''
+    if isinstance(profile, Profile):
+        return profile
+    if profile not in PROFILES:
+        raise ValueError('Unknown profile {}, pick from {}'.format(
+            profile,
+            ', '.join(sorted(PROFILES)),
+        ))
+    return PROFILES[profile]
+
+
+def get_model_version(profile=DEFAULT_PROFILE):
+    '''
+    The model_version of encodings made with a profile.  Every setting
+    goes into it, since how faces are detected decides which faces are
+    found in a photo, and so which one is encoded.
+    '''
+    profile = get_profile(profile)
+    return '{}/max{}/upsample{}/jitter{}'.format(
+        MODEL_VERSION,
+        profile.max_size,
+        profile.upsample,
+        profile.jitter,
+    )
@@ -0,0 +1,102 @@
+'''
+A quantized first pass over the facial encodings, re-ranked exactly
+
+Each dimension of the encodings is scaled into a signed byte, so a first
+pass over every employee reads a quarter of the memory that the float32
+matrix would.  The few hundred best candidates it finds for a query are
+then re-ranked with exact float32 distances from the matrix, so that the
+distances are the same as the exact search gives, and so are the twins,
+as long as they were amongst the candidates.
+'''
+
+import numpy
+from testlogger import logger
+
+from . import search
+
+
+# How many candidates per query the first pass keeps to re-rank exactly
+DEFAULT_CANDIDATES = 256
+
+
+# Codes run from -LEVELS to LEVELS
+LEVELS = 127
+
+
+class QuantizedMatrix(search.MatrixView, search.Searcher):
+    '''
+    A search.EncodingMatrix with an int8 copy of its encodings to search
+    first, whose candidates the matrix re-ranks exactly
+    '''
+
+    def __init__(self, matrix, candidates=DEFAULT_CANDIDATES):
+        '''
+        Quantizes every encoding of the matrix
+        '''
+        self.matrix = matrix
+        self.candidates = candidates
+        (self.codes, self.center, self.scale) = quantize(matrix.encodings)
+
+        # The squared length of every row as the codes have it, which the
+        # first pass needs just as search.EncodingMatrix.norms
+        self.norms = numpy.empty(len(self.codes), dtype=numpy.float32)
+        for start in range(0, len(self.codes), search.BLOCK_SIZE):
+            block = self.codes[start:start + search.BLOCK_SIZE] * self.scale
+            self.norms[start:start + len(block)] = numpy.einsum('ij,ij->i', block, block)
+
+    def first_pass(self, queries, count, shard=None, block_size=search.BLOCK_SIZE):
+        '''
+        The quantized part of nearest_many, over just the rows in shard, a
+        range, if given, as in search.EncodingMatrix.first_pass.  It keeps
+        candidates rows per query, however few are asked for.
+
+        With e = center + scale * code, |q - e|^2 is |q - center|^2
+        - 2 (q - center) * scale . code + |scale * code|^2.  The first term
+        is the same for every row, so it's left out of the ranking.
+        '''
+        weights = (queries - self.center) * self.scale
+
+        def score(block_start, block_end):
+            '''
+            The approximate squared distances to a block of employees, bar
+            the query's own term
+            '''
+            block = self.codes[block_start:block_end].astype(numpy.float32)
+            return self.norms[block_start:block_end] - 2 * numpy.dot(weights, block.T)
+
+        return search.scan_blocks(
+            score,
+            range(len(self)) if shard is None else shard,
+            len(queries),
+            max(count, self.candidates),
+            block_size,
+        )
+
+
+def quantize(encodings):
+    '''
+    Returns the encodings as an int8 matrix of codes, along with the
+    center and scale of each dimension that encodings are approximately
+    center + scale * code by.  Each dimension's range is spread over all
+    the codes, so that none of its precision is spent on values it never
+    takes.
+    '''
+    logger.info('Quantizing %s encodings', len(encodings))
+    codes = numpy.empty((len(encodings), search.ENCODING_SIZE), dtype=numpy.int8)
+    if not len(encodings):  # pylint: disable=len-as-condition
+        center = numpy.zeros(search.ENCODING_SIZE, dtype=numpy.float32)
+        return codes, center, numpy.ones(search.ENCODING_SIZE, dtype=numpy.float32)
+
+    lowest = encodings.min(axis=0)
+    highest = encodings.max(axis=0)
+    center = ((lowest + highest) / 2).astype(numpy.float32)
+    scale = numpy.maximum((highest - lowest) / (2 * LEVELS), 1e-12).astype(numpy.float32)
+
+    for start in range(0, len(encodings), search.BLOCK_SIZE):
+        block = encodings[start:start + search.BLOCK_SIZE]
+        codes[start:start + len(block)] = numpy.clip(
+            numpy.rint((block - center) / scale),
+            -LEVELS,
+            LEVELS,
+        )
+    return codes, center, scale
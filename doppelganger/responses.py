@@ -0,0 +1,83 @@
+'''
+The json that /process answers with, a versioned schema with explicit keys:
+
+    {
+        "version": 1,
+        "compact": true,
+        "faces": [
+            {
+                "location": {"x": 0, "y": 0, "width": 0, "height": 0},
+                "landmarks": [{"x": 0, "y": 0}, ...],
+                "twins": [
+                    {"dsid": 0, "name": "", "distance": 0.0, "picture": ""},
+                    ...
+                ]
+            },
+            ...
+        ]
+    }
+
+Compact responses leave out each twin's picture, which the browser fetches
+from /picture/<dsid> instead, where it can be cached.  Full responses embed
+the base64 jpeg as the picture, and are written a face at a time so that
+they can be streamed rather than built up whole in memory.
+'''
+
+import json
+
+from . import logic
+
+
+# Bump whenever the schema changes in a way that clients would notice
+VERSION = 1
+
+
+def twin_to_dict(twin, compact):
+    '''
+    One logic.Twin in the schema
+    '''
+    data = {
+        'dsid': twin.dsid,
+        'name': twin.name,
+        'distance': twin.distance,
+    }
+    if not compact:
+        data['picture'] = twin.picture
+    return data
+
+
+def face_to_dict(pipeline_result, twins, compact):
+    '''
+    One face, given its ml.PipelineResult and its Twins, in the schema
+    '''
+    return {
+        'location': pipeline_result.location,
+        'landmarks': list(pipeline_result.landmarks),
+        'twins': [twin_to_dict(twin, compact) for twin in twins],
+    }
+
+
+def stream(faces, compact=True, get_pictures=None):
+    '''
+    Generates the response for a list of (ml.PipelineResult, Twins) a face
+    at a time.  Full responses look up each face's pictures with
+    get_pictures, as in logic.find_twins, just before writing it.
+    '''
+    yield '{{"version": {}, "compact": {}, "faces": ['.format(
+        VERSION,
+        json.dumps(compact),
+    )
+    for (index, (pipeline_result, twins)) in enumerate(faces):
+        if not compact:
+            twins = logic.add_pictures(twins, get_pictures)
+        yield (',' if index else '') + json.dumps(
+            face_to_dict(pipeline_result, twins, compact)
+        )
+    yield ']}'
+
+
+def dumps(faces, compact=True, get_pictures=None):
+    '''
+    The whole response at once, as a string
+    '''
+    return ''.join(stream(faces, compact, get_pictures))
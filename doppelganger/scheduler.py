@@ -0,0 +1,119 @@
+'''
+Groups work that arrives close together into batches, so that the per-call
+overhead of the machine learning pipeline and search is paid once per batch
+rather than once per request
+'''
+
+import queue
+import threading
+import time
+
+from testlogger import logger
+
+
+class Overloaded(Exception):
+    '''
+    Raised instead of queueing when too much work is already waiting
+    '''
+
+
+class Job(object):
+    '''
+    One item of work and, once the batch it was in has run, its result
+    '''
+
+    def __init__(self, item):
+        self.item = item
+        self.arrived = time.time()
+        self.result = None
+        self.done = threading.Event()
+
+    def finish(self, result):
+        '''
+        Hands the result to whoever is waiting on this job
+        '''
+        self.result = result
+        self.done.set()
+
+    def wait(self):
+        '''
+        Blocks until the job is done, then returns its result, or raises it
+        if it's an exception
+        '''
+        self.done.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class MicroBatcher(object):
+    '''
+    Runs process_batch on a single background thread over batches of the
+    items given to submit.  process_batch takes a list of items and returns
+    a list with the result of each, in order.  A result that is an exception
+    is raised to just the caller whose item it was.
+
+    A batch starts with the oldest waiting item and takes whatever else
+    arrives within `window` seconds of it, up to max_batch items, so no item
+    waits more than the window for its batch to start.  When max_queue items
+    are already waiting, submit raises Overloaded rather than queueing more.
+    '''
+
+    def __init__(self, process_batch, window=0.01, max_batch=32, max_queue=256):
+        self.process_batch = process_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.jobs = queue.Queue(max_queue)
+
+        self.thread = threading.Thread(target=self.run, name='micro-batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item):
+        '''
+        Queues item for the next batch and blocks until its result is ready
+        '''
+        job = Job(item)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            raise Overloaded(
+                '{} jobs are already waiting'.format(self.jobs.maxsize)
+            ) from None
+        return job.wait()
+
+    def next_batch(self):
+        '''
+        Blocks for the next job, then gathers the jobs that arrive
+        until the window of the first one closes
+        '''
+        batch = [self.jobs.get()]
+        deadline = batch[0].arrived + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self.jobs.get(timeout=remaining))
+                else:
+                    # Still take what's already waiting, it's waited enough
+                    batch.append(self.jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        '''
+        Processes batches forever, on the background thread
+        '''
+        while True:
+            batch = self.next_batch()
+            logger.info('Processing a batch of %s', len(batch))
+            try:
+                results = self.process_batch([job.item for job in batch])
+            except Exception as error:  # pylint: disable=broad-except
+                # Don't let one bad batch kill the thread, fail it instead
+                logger.exception('Batch failed')
+                results = [error] * len(batch)
+
+            for (job, result) in zip(batch, results):
+                job.finish(result)
@@ -0,0 +1,401 @@
+'''
+The numeric nearest neighbour search over all of the known facial encodings
+'''
+
+import numpy
+from testlogger import logger
+
+
+# The dlib ResNet produces 128 measurements per face
+ENCODING_SIZE = 128
+
+# How many extra candidates per query nearest_many takes from its fast but
+# slightly imprecise pass to have their exact distances calculated
+RERANK_MARGIN = 32
+
+# How many employees nearest_many compares against all queries at a time,
+# small enough that a block of encodings stays in the CPU's cache
+BLOCK_SIZE = 2048
+
+
+class NameTable(object):
+    '''
+    The names of every row, interned.  Each distinct name is stored once,
+    utf8 encoded, end to end in one byte array, and each row holds just the
+    number of its name.  That's a few bytes a row, rather than a python
+    string each or a numpy unicode array padded out to the longest name.
+    '''
+
+    def __init__(self, data, offsets, rows):
+        '''
+        Name i is data[offsets[i]:offsets[i + 1]], and row r is named
+        name rows[r].  Like EncodingMatrix, these can be memory maps.
+        '''
+        self.data = data
+        self.offsets = offsets
+        self.rows = rows
+
+    @classmethod
+    def from_names(cls, names):
+        '''
+        Interns a name per row from any iterable of them
+        '''
+        interned = {}
+        rows = [intern_name(interned, name) for name in names]
+        return cls.from_interned(interned, rows)
+
+    @classmethod
+    def from_interned(cls, interned, rows):
+        '''
+        Builds the table from a dictionary of every distinct name to its
+        number, as filled in by intern_name, and the name number of each row
+        '''
+        encoded = [
+            name.encode('utf8')
+            for (name, _) in sorted(interned.items(), key=lambda item: item[1])
+        ]
+        offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(name) for name in encoded], out=offsets[1:])
+        return cls(
+            numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8),
+            offsets,
+            numpy.asarray(rows, dtype=numpy.int32),
+        )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, row):
+        name = self.rows[row]
+        start = self.offsets[name]
+        end = self.offsets[name + 1]
+        return self.data[start:end].tobytes().decode('utf8')
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+
+def intern_name(interned, name):
+    '''
+    Returns the number of name in the dictionary interned, adding it with
+    the next number if it's new
+    '''
+    return interned.setdefault(name, len(interned))
+
+
+def fill_columns(entries, encodings, dsids, rows):
+    '''
+    Streams an iterable of db.Entry into preallocated arrays of encodings,
+    dsids, and name numbers, one row each, so that no more than one entry
+    is held at a time.  Returns the dictionary of interned names.
+    '''
+    interned = {}
+    for (row, entry) in enumerate(entries):
+        encodings[row] = entry.facial_encoding
+        dsids[row] = entry.dsid
+        rows[row] = intern_name(interned, entry.name)
+    return interned
+
+
+class Searcher(object):
+    '''
+    A nearest neighbour search over the rows of a matrix of encodings,
+    made of a fast first_pass that finds candidates for many queries at
+    once, and a rerank of each query's candidates by exact distance
+    '''
+
+    def nearest(self, encoding, count):
+        '''
+        Returns a tuple of (indices, distances) for the `count` rows closest
+        to encoding, ordered nearest first
+        '''
+        return self.nearest_many([encoding], count)[0]
+
+    def nearest_many(self, encodings, count, block_size=BLOCK_SIZE):
+        '''
+        Like nearest, but for an F x 128 matrix of query encodings at once,
+        returning a list with the (indices, distances) of each query.  The
+        first pass is made for all of the queries together.
+        '''
+        queries = as_queries(encodings)
+        if not len(self) or not len(queries):  # pylint: disable=len-as-condition
+            return [closest(numpy.empty(0), count) for _ in queries]
+
+        (best_rows, _) = self.first_pass(queries, count, block_size=block_size)
+        return [
+            self.rerank(query, candidates, count)
+            for (query, candidates) in zip(queries, best_rows)
+        ]
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def first_pass(self, queries, count, shard=None, block_size=BLOCK_SIZE):
+        '''
+        Returns matrices of the candidate rows for each query to re-rank,
+        from just the rows in shard, a range, if given, and their
+        approximate scores, which are comparable between shards
+        '''
+        raise NotImplementedError
+
+    def rerank(self, encoding, candidates, count):
+        '''
+        The closest count of the candidate rows to encoding, by exact distance
+        '''
+        raise NotImplementedError
+
+
+class MatrixView(object):
+    '''
+    Something searched in place of its matrix, an EncodingMatrix or a
+    Searcher over one, with the same rows, dsids, and names, so that it can
+    be handed to logic.find_twins instead.  Subclasses set matrix.
+    '''
+
+    matrix = None
+
+    @property
+    def dsids(self):
+        '''
+        The dsids of the underlying matrix, by row
+        '''
+        return self.matrix.dsids
+
+    @property
+    def names(self):
+        '''
+        The names of the underlying matrix, by row
+        '''
+        return self.matrix.names
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def rerank(self, encoding, candidates, count):
+        '''
+        The closest count of the candidate rows to encoding, as the matrix
+        ranks them
+        '''
+        return self.matrix.rerank(encoding, candidates, count)
+
+
+class EncodingMatrix(Searcher):
+    '''
+    Every known facial encoding packed into one contiguous N x 128 float32
+    matrix, with parallel arrays of dsids and names, so that a search is a
+    single batched numpy operation instead of a python loop
+
+    Pictures are deliberately not kept here.  Ranking only needs ids and
+    distances, so pictures are looked up afterwards for the few survivors.
+    '''
+
+    def __init__(self, dsids, names, encodings):
+        '''
+        Row i of encodings belongs to dsids[i] and names[i].  names can be
+        a NameTable or any sequence of names, which is interned into one.
+
+        Arrays that already have the right type, like memory maps, are used
+        as they are rather than copied
+        '''
+        self.dsids = numpy.asarray(dsids, dtype=numpy.int64)
+        if isinstance(names, NameTable):
+            self.names = names
+        else:
+            self.names = NameTable.from_names(names)
+        self.encodings = numpy.ascontiguousarray(
+            encodings,
+            dtype=numpy.float32,
+        ).reshape(-1, ENCODING_SIZE)
+        self._norms = None
+
+    @classmethod
+    def from_entries(cls, entries):
+        '''
+        Builds the matrix from any iterable of db.Entry, like the
+        generator from db.Database.entries() or a list from get_all()
+
+        Any pictures on the entries are ignored, so prefer
+        db.Database.entries_without_pictures() to avoid loading them
+        '''
+        logger.info('Building encoding matrix')
+        dsids = []
+        names = []
+        encodings = []
+        for entry in entries:
+            dsids.append(entry.dsid)
+            names.append(entry.name)
+            encodings.append(entry.facial_encoding)
+
+        if not encodings:
+            encodings = numpy.empty((0, ENCODING_SIZE), dtype=numpy.float32)
+
+        logger.info('Built encoding matrix of %s employees', len(dsids))
+        return cls(dsids, names, encodings)
+
+    @classmethod
+    def from_database(cls, database):
+        '''
+        Builds the matrix from a db.Database, streaming the rows straight
+        into arrays sized up front, without pictures or a db.Entry for
+        every employee.  Pictures can be looked up afterwards by dsid with
+        db.Database.get_pictures for the few that are needed.
+        '''
+        logger.info('Loading encoding matrix')
+        with database.consistent_reads():
+            count = database.count()
+            encodings = numpy.empty((count, ENCODING_SIZE), dtype=numpy.float32)
+            dsids = numpy.empty(count, dtype=numpy.int64)
+            rows = numpy.empty(count, dtype=numpy.int32)
+            interned = fill_columns(
+                database.entries_without_pictures(),
+                encodings,
+                dsids,
+                rows,
+            )
+
+        logger.info('Loaded encoding matrix of %s employees', count)
+        return cls(dsids, NameTable.from_interned(interned, rows), encodings)
+
+    def __len__(self):
+        return len(self.dsids)
+
+    def distances(self, encoding):
+        '''
+        Returns the euclidean distance from encoding to every row
+        '''
+        query = numpy.asarray(encoding, dtype=numpy.float32)
+        differences = self.encodings - query
+        return numpy.sqrt(numpy.einsum('ij,ij->i', differences, differences))
+
+    def nearest(self, encoding, count):
+        '''
+        Returns a tuple of (indices, distances) for the `count` rows closest
+        to encoding, ordered nearest first
+        '''
+        return closest(self.distances(encoding), count)
+
+    def first_pass(self, queries, count, shard=None, block_size=BLOCK_SIZE):
+        '''
+        The fast part of nearest_many, over just the rows in shard, a range,
+        if given.  Returns matrices of the candidate rows for each query to
+        re-rank and their approximate scores, which are comparable between
+        shards.
+
+        This is one pass over the employees however many queries there are.
+        The employees are taken block_size rows at a time, so that each block
+        is still in cache while every query is compared against it, and the
+        best candidates of each query so far are carried from block to block.
+
+        Distances come from a matrix multiply, |q - e|^2 = |q|^2 - 2q.e + |e|^2.
+        That loses a little precision, so RERANK_MARGIN more candidates than
+        asked for are kept for rerank, which makes the results the same as
+        nearest would give.
+        '''
+        query_norms = numpy.einsum('ij,ij->i', queries, queries)[:, numpy.newaxis]
+
+        def score(block_start, block_end):
+            '''
+            The approximate squared distances to a block of employees
+            '''
+            return (
+                query_norms
+                - 2 * numpy.dot(queries, self.encodings[block_start:block_end].T)
+                + self.norms()[block_start:block_end]
+            )
+
+        return scan_blocks(
+            score,
+            range(len(self)) if shard is None else shard,
+            len(queries),
+            count + RERANK_MARGIN,
+            block_size,
+        )
+
+    def rerank(self, encoding, candidates, count):
+        '''
+        The closest count of the candidate rows to encoding, by exact distance
+        '''
+        differences = self.encodings[candidates] - encoding
+        exact = numpy.sqrt(numpy.einsum('ij,ij->i', differences, differences))
+        return closest(exact, count, candidates)
+
+    def norms(self):
+        '''
+        The squared length of every row, calculated once and then kept
+        '''
+        if self._norms is None:
+            self._norms = numpy.einsum('ij,ij->i', self.encodings, self.encodings)
+        return self._norms
+
+
+def as_queries(encodings):
+    '''
+    Any number of query encodings as an F x 128 float32 matrix
+    '''
+    queries = numpy.asarray(encodings, dtype=numpy.float32)
+    return queries.reshape(-1, ENCODING_SIZE)
+
+
+def scan_blocks(score, rows, query_count, count, block_size=BLOCK_SIZE):
+    '''
+    Scores a range of rows block_size at a time, keeping the count lowest
+    scoring rows for each query as it goes.  Returns query_count x count
+    matrices of those rows, in no particular order, and their scores.
+
+    score(start, end) gives the query_count x (end - start) scores of a
+    block of rows.
+    '''
+    best_rows = numpy.empty((query_count, 0), dtype=numpy.intp)
+    best_scores = numpy.empty((query_count, 0), dtype=numpy.float32)
+    for start in range(rows.start, rows.stop, block_size):
+        end = min(start + block_size, rows.stop)
+        scores = score(start, end)
+        block_rows = numpy.broadcast_to(numpy.arange(start, end), scores.shape)
+        best_rows, best_scores = keep_smallest(
+            numpy.hstack([best_rows, block_rows]),
+            numpy.hstack([best_scores, scores]),
+            count,
+        )
+    return best_rows, best_scores
+
+
+def keep_smallest(rows, scores, count):
+    '''
+    Given F x M matrices of rows and their scores, keeps just the count
+    lowest scoring rows of each of the F, in no particular order
+    '''
+    if scores.shape[1] <= count:
+        return rows, scores
+    kept = numpy.argpartition(scores, count - 1, axis=1)[:, :count]
+    return (
+        numpy.take_along_axis(rows, kept, axis=1),
+        numpy.take_along_axis(scores, kept, axis=1),
+    )
+
+
+def closest(distances, count, rows=None):
+    '''
+    Given the distances to some rows, returns a tuple of (rows, distances)
+    for the `count` smallest, ordered nearest first.  rows maps positions in
+    distances to row numbers and defaults to the positions themselves.
+
+    Equal distances are ordered by row so that results are stable.
+    '''
+    if rows is None:
+        rows = numpy.arange(len(distances))
+
+    count = min(count, len(distances))
+    if count <= 0:
+        empty = numpy.empty(0, dtype=numpy.intp)
+        return empty, numpy.empty(0, dtype=numpy.float32)
+
+    # A partial sort only guarantees the first `count` are the smallest,
+    # so we still need to order those few amongst themselves afterwards
+    if count < len(distances):
+        positions = numpy.argpartition(distances, count - 1)[:count]
+    else:
+        positions = numpy.arange(len(distances))
+
+    positions = positions[numpy.lexsort((rows[positions], distances[positions]))]
+    return rows[positions], distances[positions]
@@ -0,0 +1,14 @@
+'''
+The web service as it should be served, which starts loading and warming
+up everything as the server starts rather than on the first request
+
+    FLASK_APP=doppelganger.server flask run
+'''
+
+from . import flask_app
+
+
+APP = flask_app.APP
+
+
+flask_app.start()
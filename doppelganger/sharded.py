@@ -0,0 +1,86 @@
+'''
+Searches across several CPU cores at once
+
+The employees are split into contiguous shards and the first pass over each
+shard runs on its own thread.  numpy lets go of the GIL for the matrix
+multiplies that are most of the work, so the threads really do run at the
+same time, and share the one copy of the encodings that every thread can
+read.  The best candidates of every shard are merged and then re-ranked
+exactly, just as if there had been one shard.
+'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from . import search
+
+
+# Shards smaller than this cost more to hand to a thread than they save
+MIN_SHARD_SIZE = search.BLOCK_SIZE
+
+
+# A thread pool per number of threads, shared by every ShardedSearcher
+POOLS = {}
+POOL_LOCK = threading.Lock()
+
+
+def get_pool(size):
+    '''
+    Returns the shared pool of size threads, starting it if it's the first
+    time one of that size is needed
+    '''
+    if size not in POOLS:
+        with POOL_LOCK:
+            if size not in POOLS:
+                POOLS[size] = ThreadPoolExecutor(size, thread_name_prefix='shard')
+    return POOLS[size]
+
+
+def split(size, shard_count):
+    '''
+    Splits size rows into at most shard_count contiguous ranges of nearly
+    equal length, but none shorter than MIN_SHARD_SIZE unless there's only
+    one
+    '''
+    shard_count = max(1, min(shard_count, size // MIN_SHARD_SIZE))
+    bounds = numpy.linspace(0, size, shard_count + 1).astype(int)
+    return [range(start, end) for (start, end) in zip(bounds[:-1], bounds[1:])]
+
+
+class ShardedSearcher(search.MatrixView, search.Searcher):
+    '''
+    Runs the first pass of matrix, a search.EncodingMatrix or any other
+    search.Searcher like a quantized.QuantizedMatrix, over shards in
+    parallel, and re-ranks the merged candidates with it
+    '''
+
+    def __init__(self, searcher, shard_count):
+        self.matrix = searcher
+        self.shards = split(len(searcher), shard_count)
+
+    def first_pass(self, queries, count, shard=None, block_size=search.BLOCK_SIZE):
+        '''
+        The candidates of every shard, or of just shard if given, found on
+        the pool's threads and merged
+        '''
+        shards = self.shards if shard is None else [shard]
+
+        def shard_pass(rows):
+            '''
+            The candidates of one shard, on one of the pool's threads
+            '''
+            return self.matrix.first_pass(queries, count, rows, block_size)
+
+        if len(shards) == 1:
+            found = [shard_pass(shards[0])]
+        else:
+            found = list(get_pool(len(shards)).map(shard_pass, shards))
+
+        # Every shard keeps as many candidates as the whole would have
+        return search.keep_smallest(
+            numpy.hstack([rows for (rows, _) in found]),
+            numpy.hstack([scores for (_, scores) in found]),
+            max(rows.shape[1] for (rows, _) in found),
+        )
@@ -0,0 +1,299 @@
+'''
+A memory mapped copy of the encodings, kept next to the database
+
+The entry table stays the source of truth.  The sidecar is a derived copy
+laid out as plain .npy files, one contiguous float32 matrix plus dsid and
+interned name arrays, so the web service can numpy.memmap them instead of
+decoding every row, and so that several processes share the same page
+cache pages.
+
+Each rebuild writes a new generation of files named after the database
+revision they were built from, and only then points the manifest at them.
+Readers never see a half written generation, and ones that already have
+an older generation mapped keep reading it safely.
+
+Many processes, like the workers of a prefork web server, can serve from
+the same sidecar, so that there's one copy of the employees in memory no
+matter how many workers there are.  To keep that safe:
+
+ * Only one process at a time builds anything, under build_lock, and
+   checks again once it has the lock whether another already built it.
+ * The last KEEP_GENERATIONS generations are kept rather than just the
+   newest, so that a process that read the manifest just before a swap
+   can still open the generation it names.  If it's too late even for
+   that, it reads the manifest again and opens the newer one.
+'''
+
+import contextlib
+import fcntl
+import glob
+import json
+import os
+
+import numpy
+from numpy.lib import format as npy_format
+from testlogger import logger
+
+from . import search
+
+
+ARRAYS = ['encodings', 'dsids', 'name_data', 'name_offsets', 'name_rows']
+
+
+# How many generations to keep around, the current one included
+KEEP_GENERATIONS = 2
+
+
+# How many times to try opening the current generation before giving up,
+# should newer generations keep replacing it while we do
+OPEN_ATTEMPTS = 3
+
+
+def get_manifest_path(database_path):
+    '''
+    The manifest names the current generation of sidecar files
+    '''
+    return os.path.splitext(database_path)[0] + '.sidecar.json'
+
+
+def get_array_path(database_path, revision, array):
+    '''
+    Where one of the ARRAYS of a given generation lives
+    '''
+    return '{}.{}.{}.npy'.format(
+        os.path.splitext(database_path)[0],
+        revision,
+        array,
+    )
+
+
+def get_lock_path(database_path):
+    '''
+    The file locked while a generation is built
+    '''
+    return os.path.splitext(database_path)[0] + '.sidecar.lock'
+
+
+@contextlib.contextmanager
+def build_lock(database_path):
+    '''
+    Holds an exclusive lock, shared between processes, while building
+    '''
+    with open(get_lock_path(database_path), 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def read_manifest(database_path):
+    '''
+    Returns the manifest of the current generation, or None if there isn't
+    one or it points at files that are missing
+    '''
+    try:
+        with open(get_manifest_path(database_path)) as handle:
+            manifest = json.load(handle)
+    except (IOError, OSError, ValueError):
+        return None
+
+    for array in ARRAYS:
+        if not os.path.exists(get_array_path(database_path, manifest['revision'], array)):
+            return None
+    return manifest
+
+
+def write(database, database_path):
+    '''
+    Streams every encoding out of the database into a new generation of
+    sidecar files and points the manifest at it, returning the manifest
+    '''
+    with database.consistent_reads():
+        revision = database.get_revision()
+        count = database.count()
+        logger.info('Writing sidecar of %s employees at revision %s', count, revision)
+
+        temporary = '{}.{}'.format(
+            get_array_path(database_path, revision, 'encodings'),
+            os.getpid(),
+        )
+        encodings = npy_format.open_memmap(
+            temporary,
+            mode='w+',
+            dtype=numpy.float32,
+            shape=(count, search.ENCODING_SIZE),
+        )
+        dsids = numpy.empty(count, dtype=numpy.int64)
+        rows = numpy.empty(count, dtype=numpy.int32)
+        interned = search.fill_columns(
+            database.entries_without_pictures(),
+            encodings,
+            dsids,
+            rows,
+        )
+
+    encodings.flush()
+    del encodings
+    os.rename(temporary, get_array_path(database_path, revision, 'encodings'))
+    save_array(get_array_path(database_path, revision, 'dsids'), dsids)
+    names = search.NameTable.from_interned(interned, rows)
+    save_array(get_array_path(database_path, revision, 'name_data'), names.data)
+    save_array(get_array_path(database_path, revision, 'name_offsets'), names.offsets)
+    save_array(get_array_path(database_path, revision, 'name_rows'), names.rows)
+
+    manifest = {'revision': revision, 'count': count}
+    save_manifest(database_path, manifest)
+    remove_old_generations(database_path, revision)
+    return manifest
+
+
+def save_array(path, array):
+    '''
+    Saves an array so that it appears at path all at once
+    '''
+    temporary = '{}.{}'.format(path, os.getpid())
+    with open(temporary, 'wb') as handle:
+        numpy.save(handle, array)
+    os.rename(temporary, path)
+
+
+def save_manifest(database_path, manifest):
+    '''
+    Atomically points the manifest at a new generation
+    '''
+    path = get_manifest_path(database_path)
+    temporary = '{}.{}'.format(path, os.getpid())
+    with open(temporary, 'w') as handle:
+        json.dump(manifest, handle)
+    os.rename(temporary, path)
+
+
+def remove_old_generations(database_path, revision):
+    '''
+    Deletes the files of all but the last KEEP_GENERATIONS generations up
+    to the given one.  Processes that still have them mapped keep their
+    copy until they let go of it.
+    '''
+    prefix = os.path.splitext(database_path)[0] + '.'
+    generations = {}
+    for path in glob.glob(prefix + '*.npy'):
+        generation = path[len(prefix):].split('.', 1)[0]
+        if generation.isdigit():
+            generations.setdefault(int(generation), []).append(path)
+
+    older = sorted(generation for generation in generations if generation <= revision)
+    for generation in older[:-KEEP_GENERATIONS]:
+        for path in generations[generation]:
+            logger.info('Removing old sidecar %s', path)
+            os.remove(path)
+
+
+def open_matrix(database_path, manifest):
+    '''
+    Memory maps the generation named by the manifest as an EncodingMatrix
+    '''
+    arrays = dict(
+        (array, numpy.load(
+            get_array_path(database_path, manifest['revision'], array),
+            mmap_mode='r',
+        ))
+        for array in ARRAYS
+    )
+    return search.EncodingMatrix(
+        arrays['dsids'],
+        search.NameTable(
+            arrays['name_data'],
+            arrays['name_offsets'],
+            arrays['name_rows'],
+        ),
+        arrays['encodings'],
+    )
+
+
+def is_current(manifest, database):
+    '''
+    Whether the manifest names a generation of the database as it is now
+    '''
+    return manifest is not None and manifest['revision'] == database.get_revision()
+
+
+def load_generation(database, database_path):
+    '''
+    Returns the manifest of the current generation and its EncodingMatrix,
+    first rebuilding the sidecar if it's missing or older than the database
+    '''
+    for _ in range(OPEN_ATTEMPTS - 1):
+        manifest = get_current_manifest(database, database_path)
+        try:
+            return manifest, open_matrix(database_path, manifest)
+        except (IOError, OSError):
+            # Newer generations replaced this one before we could open it
+            logger.info('Sidecar generation %s is gone, trying again', manifest)
+
+    manifest = get_current_manifest(database, database_path)
+    return manifest, open_matrix(database_path, manifest)
+
+
+def get_current_manifest(database, database_path):
+    '''
+    Returns the manifest, once it names a generation of the database as it
+    is now, building that generation if no one else has yet
+    '''
+    manifest = read_manifest(database_path)
+    if not is_current(manifest, database):
+        with build_lock(database_path):
+            # Someone else may have built it while we waited for the lock
+            manifest = read_manifest(database_path)
+            if not is_current(manifest, database):
+                logger.info('Sidecar is missing or stale, rebuilding it')
+                manifest = write(database, database_path)
+    return manifest
+
+
+def load_matrix(database, database_path):
+    '''
+    Returns the EncodingMatrix for the database from its sidecar, as in
+    load_generation
+    '''
+    return load_generation(database, database_path)[1]
+
+
+def share_index(database_path, manifest, ivf_index, index_path):
+    '''
+    Gives the ivf.IVFIndex of a generation's matrix the encodings regrouped
+    by list from a file that every process serving that generation maps,
+    rather than a copy of its own.  Whoever needs it first writes it.
+    '''
+    stamp = os.stat(index_path).st_mtime_ns
+    path = get_array_path(
+        database_path,
+        manifest['revision'],
+        'ivf{}'.format(stamp),
+    )
+    if not os.path.exists(path):
+        with build_lock(database_path):
+            if not os.path.exists(path):
+                write_grouped(path, ivf_index)
+    ivf_index.encodings = numpy.load(path, mmap_mode='r')
+
+
+def write_grouped(path, ivf_index):
+    '''
+    Writes the encodings of an ivf.IVFIndex regrouped by list, a block at
+    a time so that there's never a whole copy of them in memory
+    '''
+    logger.info('Writing index lists to %s', path)
+    temporary = '{}.{}'.format(path, os.getpid())
+    grouped = npy_format.open_memmap(
+        temporary,
+        mode='w+',
+        dtype=numpy.float32,
+        shape=(len(ivf_index.rows), search.ENCODING_SIZE),
+    )
+    for start in range(0, len(ivf_index.rows), search.BLOCK_SIZE):
+        rows = ivf_index.rows[start:start + search.BLOCK_SIZE]
+        grouped[start:start + len(rows)] = ivf_index.matrix.encodings[rows]
+    grouped.flush()
+    del grouped
+    os.rename(temporary, path)
@@ -0,0 +1,160 @@
+'''
+Versioned, read only snapshots of the employees that the web service
+searches, kept up to date by a background thread as the database changes
+'''
+
+import collections
+import os
+import threading
+import time
+
+from testlogger import logger
+
+from . import (
+    db,
+    ivf,
+    quantized,
+    sharded,
+    sidecar,
+)
+
+
+Snapshot = collections.namedtuple('Snapshot', [
+    'version',  # Changes whenever the database or the index does
+    'matrix',  # The search.EncodingMatrix of every employee
+    'searcher',  # What to search with, an ivf.IVFIndex if asked for and
+                 # there is one, or else the matrix, maybe quantized or sharded
+])
+
+
+def get_version(database, database_path, nprobe=None):
+    '''
+    Returns something that changes whenever what a snapshot is made of
+    does, which is the revision of the database and, if nprobe asks for
+    the index to be searched, the index file.  Both only ever go up, so
+    later versions compare greater.
+    '''
+    index_path = ivf.get_index_path(database_path)
+    index_time = 0
+    if nprobe and os.path.exists(index_path):
+        index_time = os.path.getmtime(index_path)
+    return (database.get_revision(), index_time)
+
+
+def load(database, database_path, candidates=None, shards=1, nprobe=None):
+    '''
+    Builds a whole new Snapshot of the database.  Given an nprobe, it's
+    searched approximately through the index probing that many lists, if
+    build-index made one.  Otherwise it's searched through a
+    quantized.QuantizedMatrix that re-ranks candidates per query, if given,
+    or else exactly, split into shards searched in parallel if there's more
+    than one.
+    '''
+    version = get_version(database, database_path, nprobe)
+    logger.info('Loading snapshot %s', version)
+    (manifest, matrix) = sidecar.load_generation(database, database_path)
+
+    index_path = ivf.get_index_path(database_path)
+    if nprobe and os.path.exists(index_path):
+        searcher = ivf.IVFIndex.load(index_path, matrix, nprobe)
+        sidecar.share_index(database_path, manifest, searcher, index_path)
+    else:
+        searcher = matrix
+        if candidates:
+            searcher = quantized.QuantizedMatrix(searcher, candidates)
+        if shards > 1:
+            searcher = sharded.ShardedSearcher(searcher, shards)
+
+    return Snapshot(version, matrix, searcher)
+
+
+class Refresher(object):
+    '''
+    Holds the current Snapshot and swaps in a new one when the database
+    changes.  New snapshots are built on a background thread, off the
+    request path, and swapped in with a single assignment.
+
+    A database being written to changes again and again, as init commits a
+    batch at a time, so a new snapshot is only loaded once the database has
+    stayed the same for settle seconds, rather than loading one per batch
+    only to throw it away a moment later.
+
+    Callers should get() a snapshot once and use it for everything they do,
+    so that they see one consistent version even if it's swapped halfway.
+    An old snapshot is freed once the last caller using it lets go of it.
+    '''
+
+    def __init__(self, database_path, interval=5.0, settle=0.0, **options):
+        '''
+        Loads the first snapshot right away, then checks for changes
+        every interval seconds.  options are the candidates, shards, and
+        nprobe of load.
+        '''
+        self.database_path = database_path
+        self.interval = interval
+        self.settle = settle
+        self.options = options
+
+        # The version that the database changed to and when it was first
+        # seen, while waiting for it to settle
+        self.pending = None
+
+        database = db.Database(database_path)
+        self.snapshot = load(database, database_path, **options)
+        database.connection.close()
+
+        self.thread = threading.Thread(target=self.run, name='snapshot-refresher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self):
+        '''
+        Returns the current Snapshot
+        '''
+        return self.snapshot
+
+    def refresh(self, database):
+        '''
+        Swaps in a new snapshot if the database changed since the current
+        one and has stayed that way for settle seconds, returning whether
+        it did
+        '''
+        version = get_version(
+            database,
+            self.database_path,
+            self.options.get('nprobe'),
+        )
+        if version == self.snapshot.version:
+            self.pending = None
+            return False
+
+        start = time.time()
+        if self.pending is None or self.pending[0] != version:
+            self.pending = (version, start)
+        if start - self.pending[1] < self.settle:
+            return False
+
+        snapshot = load(database, self.database_path, **self.options)
+        self.snapshot = snapshot
+        self.pending = None
+        logger.info(
+            'Swapped in snapshot %s of %s employees in %.2fs',
+            snapshot.version,
+            len(snapshot.matrix),
+            time.time() - start,
+        )
+        return True
+
+    def run(self):
+        '''
+        Checks for changes forever, on the background thread, with its
+        own connection since those can't be shared between threads
+        '''
+        database = db.Database(self.database_path)
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh(database)
+            except Exception:  # pylint: disable=broad-except
+                # Keep serving the old snapshot and try again next time
+                logger.exception('Could not refresh snapshot')
@@ -0,0 +1,242 @@
+'''
+Histograms of how long each stage of processing a photo takes, kept in
+memory and shown as a table by the CLI or as Prometheus text by the server
+
+Timing is off until enable() is called, and while it's off, stage() hands
+back one shared context manager that does nothing, so the instrumented code
+pays for little more than a function call.
+'''
+
+import bisect
+import threading
+import time
+
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = [
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+]
+
+
+# The stages of the hot path, in the order they happen
+STAGES = [
+    'b64_decode',
+    'image_load',
+    'detection',
+    'landmarks',
+    'encoding',
+    'compare',
+    'json',
+]
+
+
+class Histogram(object):
+    '''
+    Counts of durations in each of the BUCKETS, plus one for anything longer
+    '''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.longest = 0.0
+
+    def observe(self, seconds):
+        '''
+        Counts one more duration
+        '''
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+
+    def merge(self, other):
+        '''
+        Adds the counts of another histogram into this one
+        '''
+        self.counts = [mine + theirs for (mine, theirs) in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.longest = max(self.longest, other.longest)
+
+    def count(self):
+        '''
+        How many durations were counted
+        '''
+        return sum(self.counts)
+
+    def quantile(self, fraction):
+        '''
+        The upper bound of the bucket that the given fraction of durations
+        fall at or under, which is as close as the buckets let us say
+        '''
+        wanted = fraction * self.count()
+        seen = 0
+        for (bound, count) in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.longest)
+        return self.longest
+
+
+class Timer(object):
+    '''
+    Times one run of a stage, as a context manager
+    '''
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+
+
+class NullTimer(object):
+    '''
+    Stands in for a Timer when timing is off
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Registry(object):
+    '''
+    The histogram of every stage, shared by all the threads of a process
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def stage(self, name):
+        '''
+        Returns a context manager that times the code it wraps as the stage
+        '''
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def observe(self, name, seconds):
+        '''
+        Counts one run of a stage that took seconds
+        '''
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    def drain(self):
+        '''
+        Returns the histograms so far and starts over, so that a worker
+        process can hand what it timed to the process that started it
+        '''
+        with self.lock:
+            (histograms, self.histograms) = (self.histograms, {})
+        return histograms
+
+    def merge(self, histograms):
+        '''
+        Adds histograms from drain, probably of another process, into these
+        '''
+        with self.lock:
+            for (name, histogram) in histograms.items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram()
+                self.histograms[name].merge(histogram)
+
+    def snapshot(self):
+        '''
+        Returns a list of (stage, copy of its Histogram) in STAGES order,
+        then any other stages by name
+        '''
+        with self.lock:
+            names = [name for name in STAGES if name in self.histograms]
+            names += sorted(set(self.histograms) - set(STAGES))
+            copies = []
+            for name in names:
+                histogram = Histogram()
+                histogram.merge(self.histograms[name])
+                copies.append((name, histogram))
+            return copies
+
+
+REGISTRY = Registry()
+
+
+def enable(enabled=True):
+    '''
+    Turns timing on or off for this process
+    '''
+    REGISTRY.enabled = enabled
+
+
+def stage(name):
+    '''
+    Times the code in a with block as the named stage, if timing is on
+    '''
+    return REGISTRY.stage(name)
+
+
+def prometheus():
+    '''
+    Every histogram in the Prometheus text exposition format
+    '''
+    lines = [
+        '# HELP doppelganger_stage_seconds Time spent in each stage of '
+        'processing a photo',
+        '# TYPE doppelganger_stage_seconds histogram',
+    ]
+    for (name, histogram) in REGISTRY.snapshot():
+        cumulative = 0
+        for (bound, count) in zip(BUCKETS + ['+Inf'], histogram.counts):
+            cumulative += count
+            lines.append(
+                'doppelganger_stage_seconds_bucket{{stage="{}",le="{}"}} {}'
+                .format(name, bound, cumulative)
+            )
+        lines.append('doppelganger_stage_seconds_sum{{stage="{}"}} {!r}'.format(
+            name,
+            histogram.total,
+        ))
+        lines.append('doppelganger_stage_seconds_count{{stage="{}"}} {}'.format(
+            name,
+            cumulative,
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    '''
+    Every histogram as a table for people to read, in milliseconds.  The
+    quantiles are the upper bounds of the buckets that they fall in.
+    '''
+    lines = ['{:>12} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'stage', 'count', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+    )]
+    for (name, histogram) in REGISTRY.snapshot():
+        count = histogram.count()
+        lines.append(
+            '{:>12} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'
+            .format(
+                name,
+                count,
+                histogram.total / max(count, 1) * 1000,
+                histogram.quantile(0.5) * 1000,
+                histogram.quantile(0.9) * 1000,
+                histogram.quantile(0.99) * 1000,
+                histogram.longest * 1000,
+            )
+        )
+    return '\n'.join(lines)
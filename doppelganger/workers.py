@@ -0,0 +1,268 @@
+'''
+Runs the machine learning pipeline over many employees, optionally spread
+across a pool of processes since dlib only uses one core per image
+'''
+
+import base64
+import itertools
+import time
+from concurrent import futures
+
+from testlogger import logger
+
+from . import (
+    ml,
+    profiles,
+    timings,
+)
+
+
+# How often, in employees, to log how far along we are
+PROGRESS_EVERY = 100
+
+# How many employees' faces are encoded together in one batched call
+CHUNK_SIZE = 16
+
+# How many chunks may be waiting on or in the pool per worker, which
+# keeps a fast directory from being buffered into memory all at once
+PENDING_PER_WORKER = 2
+
+# The pipeline of the current process and the profiles.PROFILES name to run it
+# with, loaded once by start_worker
+PIPELINE = {}
+
+
+def start_worker(profile=profiles.DEFAULT_PROFILE, timed=False):
+    '''
+    Loads the pipeline once per worker process, since that is slow
+    '''
+    PIPELINE['pipeline'] = ml.get_pipeline()
+    PIPELINE['profile'] = profile
+    timings.enable(timed)
+
+
+def encode(jobs):
+    '''
+    Calculates the encodings of every face in a chunk of images using this
+    process's pipeline, all in one batch.  jobs is a list of tuples of
+    (key, jpeg bytes), and this returns a list of tuples of
+    (key, list of encodings, error message or None).
+
+    Every error is caught and returned, so that one bad jpeg only costs us
+    that one employee and not the worker or the rest of the run.
+    '''
+    results = []
+    images = []
+    for (key, image_bytes) in jobs:
+        try:
+            images.append((key, ml.decode_image(image_bytes)))
+        except Exception as error:  # pylint: disable=broad-except
+            results.append((key, None, describe_error(error)))
+
+    try:
+        batch = ml.calculate_encodings_for_images(
+            [image for (_, image) in images],
+            PIPELINE['pipeline'],
+            PIPELINE['profile'],
+        )
+    except Exception:  # pylint: disable=broad-except
+        # Something in the chunk broke the whole batch, so go one
+        # image at a time to find out which and save the rest
+        return results + [encode_one(key, image) for (key, image) in images]
+
+    for ((key, _), image_results) in zip(images, batch):
+        results.append((key, [result.encoding for result in image_results], None))
+    return results
+
+
+def encode_timed(jobs):
+    '''
+    Like encode, but also hands back what the worker timed while doing it,
+    as a tuple of (results, timings histograms)
+    '''
+    return encode(jobs), timings.REGISTRY.drain()
+
+
+def encode_one(key, image):
+    '''
+    Calculates the encodings of the faces in a single decoded image
+    '''
+    try:
+        (image_results,) = ml.calculate_encodings_for_images(
+            [image],
+            PIPELINE['pipeline'],
+            PIPELINE['profile'],
+        )
+        return key, [result.encoding for result in image_results], None
+    except Exception as error:  # pylint: disable=broad-except
+        return key, None, describe_error(error)
+
+
+def describe_error(error):
+    '''
+    A short description of an error that can be sent between processes
+    '''
+    return '{}: {}'.format(type(error).__name__, error)
+
+
+def chunk(iterable, size):
+    '''
+    Generates lists of up to size items from iterable
+    '''
+    iterator = iter(iterable)
+    while True:
+        items = list(itertools.islice(iterator, size))
+        if not items:
+            return
+        yield items
+
+
+class Progress(object):
+    '''
+    Keeps count of how the encoding is going and logs it now and then
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.done = 0
+        self.faceless = 0
+        self.failed = 0
+
+    def record(self, encodings, error):
+        '''
+        Counts one more finished employee, logging progress periodically
+        '''
+        self.done += 1
+        if error is not None:
+            self.failed += 1
+        elif not encodings:
+            self.faceless += 1
+
+        if self.done % PROGRESS_EVERY == 0:
+            self.log('Encoded')
+
+    def rate(self):
+        '''
+        Employees per second so far
+        '''
+        return self.done / max(time.time() - self.start, 1e-9)
+
+    def log(self, message):
+        '''
+        Logs the counts so far along with the throughput
+        '''
+        logger.info(
+            '%s %s employees (%s without faces, %s failed) '
+            'in %.1fs, %.2f employees/s',
+            message,
+            self.done,
+            self.faceless,
+            self.failed,
+            time.time() - self.start,
+            self.rate(),
+        )
+
+
+def get_image_bytes(employee):
+    '''
+    The raw jpeg bytes of an employee record from ldap_utils
+    '''
+    return base64.b64decode(employee['applePhotoOfficial-jpeg'])
+
+
+def encode_employees(employees, worker_count=1, profile=profiles.DEFAULT_PROFILE):
+    '''
+    Generator of (employee, list of encodings, error message or None) for
+    every employee record from ldap_utils.get_employees, encoded with the
+    named profiles.PROFILES profile
+
+    With more than one worker the images are encoded by a process pool and
+    come back in whatever order they finish in.  Either way, this runs in
+    the caller's process so that it can own the database connection.
+    '''
+    if worker_count > 1:
+        results = encode_in_pool(employees, worker_count, profile)
+    else:
+        results = encode_in_process(employees, profile)
+
+    progress = Progress()
+    for (employee, encodings, error) in results:
+        if error is not None:
+            logger.warning(
+                'Could not encode %s, %s: %s',
+                employee['cn'],
+                employee['appledsId'],
+                error,
+            )
+        progress.record(encodings, error)
+        yield employee, encodings, error
+
+    progress.log('Finished encoding')
+
+
+def encode_in_process(employees, profile):
+    '''
+    Encodes a chunk of employees at a time in this process
+    '''
+    start_worker(profile, timings.REGISTRY.enabled)
+    for employees_chunk in chunk(employees, CHUNK_SIZE):
+        jobs = [
+            (key, get_image_bytes(employee))
+            for (key, employee) in enumerate(employees_chunk)
+        ]
+        for (key, encodings, error) in encode(jobs):
+            yield employees_chunk[key], encodings, error
+
+
+def encode_in_pool(employees, worker_count, profile):
+    '''
+    Encodes chunks of employees across a pool of worker_count processes
+
+    Chunks are handed to the pool from this thread, as earlier ones finish,
+    so that stopping early leaves nothing blocked that has to be waited on.
+    A worker that dies outright, say in dlib or to the OOM killer, or that
+    can't load the pipeline at all, breaks the pool, and that's raised here
+    as a concurrent.futures.process.BrokenProcessPool rather than waiting
+    forever on the chunk it had.
+    '''
+    logger.info('Starting %s encoding workers', worker_count)
+    pool = futures.ProcessPoolExecutor(
+        worker_count,
+        initializer=start_worker,
+        initargs=(profile, timings.REGISTRY.enabled),
+    )
+    chunks = chunk(enumerate(employees), CHUNK_SIZE)
+
+    # The employees of each chunk in the pool, by key, until it's back
+    pending = {}
+    try:
+        while True:
+            fill_pool(pool, chunks, pending, worker_count * PENDING_PER_WORKER)
+            if not pending:
+                return
+
+            (done, _) = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                keyed = pending.pop(future)
+                (results, histograms) = future.result()
+                timings.REGISTRY.merge(histograms)
+                for (key, encodings, error) in results:
+                    yield keyed[key], encodings, error
+    finally:
+        # Only the chunks the workers already started are waited for
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def fill_pool(pool, chunks, pending, size):
+    '''
+    Hands the pool chunks of (key, employee) until size of them are in it,
+    remembering in pending the employees of each by key
+    '''
+    for keyed_chunk in itertools.islice(chunks, size - len(pending)):
+        jobs = [
+            (key, get_image_bytes(employee))
+            for (key, employee) in keyed_chunk
+        ]
+        pending[pool.submit(encode_timed, jobs)] = dict(keyed_chunk)
@@ -0,0 +1,63 @@
+'''
+Tests the code in batch.py
+'''
+
+import csv
+import io
+import json
+
+from benchmarks import synthetic
+from doppelganger import (
+    batch,
+    sharded,
+)
+
+
+def test_find_rows():
+    '''
+    Dsids become rows, skipping the unknown
+    '''
+    matrix = synthetic.make_matrix(10, first_dsid=100)
+    assert batch.find_rows(matrix, [105, 42, 100]) == [5, 0]
+
+
+def test_lookalikes_are_nearest():
+    '''
+    Every employee's lookalikes are their nearest others, whatever the tile
+    size and however many shards
+    '''
+    matrix = synthetic.make_matrix(120, first_dsid=100)
+    found = list(batch.find_lookalikes(
+        matrix, range(len(matrix)), 5, tile_size=16,
+        searcher=sharded.ShardedSearcher(matrix, 3),
+    ))
+    assert [row for (row, _) in found] == list(range(120))
+
+    for (row, twins) in found:
+        (indices, distances) = matrix.nearest(matrix.encodings[row], 6)
+        assert indices[0] == row
+        assert [twin.dsid for twin in twins] == [100 + index for index in indices[1:]]
+        assert [twin.distance for twin in twins] == distances[1:].tolist()
+
+
+def test_writers():
+    '''
+    Both formats have every twin of every employee asked for, in rank order
+    '''
+    matrix = synthetic.make_matrix(20, first_dsid=100)
+    lookalikes = list(batch.find_lookalikes(matrix, [3, 7], 2))
+
+    handle = io.StringIO()
+    batch.write_csv(handle, matrix, lookalikes)
+    lines = list(csv.DictReader(io.StringIO(handle.getvalue())))
+    assert len(lines) == 4
+    assert [line['dsid'] for line in lines] == ['103', '103', '107', '107']
+    assert [line['rank'] for line in lines] == ['1', '2', '1', '2']
+    assert lines[0]['twin_dsid'] == str(lookalikes[0][1][0].dsid)
+    assert float(lines[0]['distance']) == lookalikes[0][1][0].distance
+
+    handle = io.StringIO()
+    batch.write_jsonl(handle, matrix, lookalikes)
+    objects = [json.loads(line) for line in handle.getvalue().splitlines()]
+    assert [data['name'] for data in objects] == ['Employee 3', 'Employee 7']
+    assert objects[1]['twins'][1]['dsid'] == lookalikes[1][1][1].dsid
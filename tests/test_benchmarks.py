@@ -0,0 +1,36 @@
+'''
+Tests the comparison of benchmark suite results
+'''
+
+from benchmarks import suite
+
+
+def make_run(**values):
+    '''
+    A saved run of the suite with the given measurements, where ones whose
+    names end in _s are better lower and the rest better higher
+    '''
+    return {
+        'measurements': dict(
+            (name, {
+                'value': value,
+                'unit': 's' if name.endswith('_s') else 'queries/s',
+                'higher_is_better': not name.endswith('_s'),
+            })
+            for (name, value) in values.items()
+        ),
+    }
+
+
+def test_compare():
+    '''
+    Only changes for the worse beyond the threshold are regressions
+    '''
+    baseline = make_run(search=100.0, faster=100.0, load_s=1.0, quick_s=1.0, old=1.0)
+    current = make_run(search=85.0, faster=200.0, load_s=1.05, quick_s=0.5, new=1.0)
+
+    assert suite.compare(baseline, current, 0.1) == [('search', 100.0, 85.0, -0.15)]
+    assert not suite.compare(baseline, current, 0.2)
+
+    regressed = suite.compare(baseline, current, 0.01)
+    assert [name for (name, _, _, _) in regressed] == ['load_s', 'search']
@@ -34,9 +34,9 @@ def test_create_entry_from_record(b64decode_func):
     b64decode_func.assert_called_once_with(record['applePhotoOfficial-jpeg'])
 
 
-@patch('doppelganger.db.str')
+@patch('doppelganger.db.bytes')
 @patch('doppelganger.db.bin_to_nparray')
-def test_create_entry_from_row(bin_to_nparray_func, str_func):
+def test_create_entry_from_row(bin_to_nparray_func, bytes_func):
     '''
     Checks that we properly set values in create_entry_from_row
     '''
@@ -50,16 +50,16 @@ def test_create_entry_from_row(bin_to_nparray_func, str_func):
     np_array = MagicMock()
     bin_to_nparray_func.return_value = np_array
 
-    str_result = MagicMock()
-    str_func.return_value = str_result
+    bytes_result = MagicMock()
+    bytes_func.return_value = bytes_result
 
     result = db.create_entry_from_row(row)
     assert result.dsid == row['dsid']
     assert result.name == row['name']
     assert result.facial_encoding == np_array
-    assert result.picture == str_result
+    assert result.picture == bytes_result
 
-    str_func.assert_called_once_with(row['picture'])
+    bytes_func.assert_called_once_with(row['picture'])
     bin_to_nparray_func.assert_called_once_with(row['facial_encoding'])
 
 
@@ -73,3 +73,103 @@ def test_numpy_array_serialization():
     assert binary
     and_back_again = db.bin_to_nparray(binary)
     assert numpy.array_equal(array, and_back_again)
+
+
+def test_pictures_by_dsid():
+    '''
+    Checks that pictures can be fetched on their own, one or many at a time,
+    and that entries_without_pictures leaves them out
+    '''
+    import numpy
+    database = db.Database(':memory:')
+    for dsid in [1, 2, 3]:
+        database.put(db.Entry(
+            dsid=dsid,
+            name='Employee {}'.format(dsid),
+            facial_encoding=numpy.zeros(128),
+            picture=b'jpeg ' + str(dsid).encode('ascii'),
+        ))
+
+    assert database.get_picture(2) == b'jpeg 2'
+    assert database.get_picture(4) is None
+    assert database.get_pictures([1, 3, 4]) == {1: b'jpeg 1', 3: b'jpeg 3'}
+    assert not database.get_pictures([])
+
+    entries = list(database.entries_without_pictures())
+    assert sorted(entry.dsid for entry in entries) == [1, 2, 3]
+    assert all(entry.picture is None for entry in entries)
+
+
+def test_put_many(tmpdir):
+    '''
+    Checks that put_many writes everything across batches and that a bulk
+    load leaves the database in write ahead logging mode
+    '''
+    import numpy
+    database = db.Database(str(tmpdir.join('doppelganger.db')))
+    entries = (
+        db.Entry(
+            dsid=dsid,
+            name='Employee {}'.format(dsid),
+            facial_encoding=numpy.full(128, dsid),
+            picture=b'jpeg',
+        )
+        for dsid in range(25)
+    )
+
+    with database.bulk_load():
+        assert database.put_many(entries, batch_size=10) == 25
+
+    assert database.count() == 25
+    assert numpy.array_equal(
+        database.get_by_dsid(24).facial_encoding,
+        numpy.full(128, 24),
+    )
+    cursor = database.connection.execute('PRAGMA journal_mode')
+    assert cursor.fetchone()[0] == 'wal'
+
+
+def test_add_missing_columns(tmpdir):
+    '''
+    A database from before photo_hash and model_version should get them
+    '''
+    import sqlite3
+    path = str(tmpdir.join('doppelganger.db'))
+    connection = sqlite3.connect(path)
+    connection.execute('''
+        CREATE TABLE entry (
+            dsid INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            facial_encoding BLOB NOT NULL,
+            picture BLOB NOT NULL
+        )
+    ''')
+    connection.execute(
+        'INSERT INTO entry VALUES (1, ?, ?, ?)',
+        ('Employee 1', db.nparray_to_bin([0.5]), b'jpeg'),
+    )
+    connection.commit()
+    connection.close()
+
+    database = db.Database(path)
+    assert database.get_fingerprints() == {1: ('Employee 1', None, None)}
+    entry = database.get_by_dsid(1)
+    assert entry.photo_hash is None
+    assert entry.model_version is None
+
+
+def test_open_while_writing(tmpdir):
+    '''
+    Opening a database that's set up doesn't write, so it doesn't wait on
+    whoever is writing to it
+    '''
+    import sqlite3
+    path = str(tmpdir.join('doppelganger.db'))
+    assert db.Database(path).get_revision() == 0
+
+    writer = sqlite3.connect(path)
+    writer.execute('BEGIN IMMEDIATE')
+    writer.execute('UPDATE revision SET number = number + 1')
+
+    assert db.Database(path).get_revision() == 0
+    writer.rollback()
@@ -2,7 +2,12 @@
 Tests for doppelganger
 '''
 
+import base64
+
+import numpy
+
 import doppelganger
+from benchmarks import fake_ldap
 
 from mock import (
     patch,
@@ -32,6 +37,18 @@ def test_arguments_init(init_func):
     assert parser.parse_args(['init']).func == init_func
 
 
+@patch('doppelganger.cli.lookalikes')
+def test_arguments_lookalikes(lookalikes_func):
+    '''
+    Checks that lookalikes takes any number of dsids, none meaning everyone
+    '''
+    parser = doppelganger.cli.argument_parser()
+    args = parser.parse_args(['lookalikes', '--format', 'jsonl', '3', '4'])
+    assert args.func == lookalikes_func
+    assert args.dsids == [3, 4]
+    assert parser.parse_args(['lookalikes']).dsids == []
+
+
 @patch('doppelganger.db.Database')
 def test_get_db(database_class):
     '''
@@ -68,6 +85,35 @@ def test_process_result():
     assert result['applePhotoOfficial-jpeg'] == '/9j/4AAQSkZJRgABAQEASABIAAA='
 
 
+def test_get_employees_paged():
+    '''
+    Makes sure every employee comes back exactly once across pages,
+    and that we stop once the server says there are no more pages
+    '''
+    server = fake_ldap.FakeLdap(25)
+    employees = list(doppelganger.ldap_utils.get_employees(server, 10))
+
+    assert [employee['appledsId'] for employee in employees] == [
+        str(dsid) for dsid in range(25)
+    ]
+    assert employees[3]['cn'] == 'Employee 3'
+    assert server.searches == 3
+    assert not server.requests
+
+
+def test_get_employees_unpaged():
+    '''
+    A server that ignores paging sends everything in one go, and we stop
+    '''
+    server = MagicMock()
+    entry = fake_ldap.FakeLdap(1).make_entry(7)
+    server.result3.return_value = (None, [entry], None, [])
+
+    employees = list(doppelganger.ldap_utils.get_employees(server))
+    assert [employee['appledsId'] for employee in employees] == ['7']
+    server.search_ext.assert_called_once()
+
+
 @patch('doppelganger.ml.dlib.face_recognition_model_v1')
 @patch('doppelganger.ml.dlib.shape_predictor')
 @patch('doppelganger.ml.dlib.get_frontal_face_detector')
@@ -83,3 +129,171 @@ def test_get_pipeline(face_detector, pose_analyzer, face_encoder):
     assert pipeline.face_detector == face_detector.return_value
     assert pipeline.pose_analyzer == pose_analyzer.return_value
     assert pipeline.face_encoder == face_encoder.return_value
+
+
+def make_record(dsid, name, jpeg):
+    '''
+    Builds an employee record like the ones ldap_utils.get_employees returns
+    '''
+    return {
+        'appledsId': str(dsid),
+        'cn': name,
+        'applePhotoOfficial-jpeg': base64.b64encode(jpeg),
+    }
+
+
+def test_sync():
+    '''
+    Checks that init's Sync only lets new or changed photos through to be
+    encoded, even those without faces, and renames, deletes, and counts
+    everything else
+    '''
+    database = doppelganger.db.Database(':memory:')
+    for (dsid, name, jpeg) in [
+            (1, 'Unchanged', b'one'),
+            (2, 'Old Name', b'two'),
+            (3, 'New Photo', b'three'),
+            (4, 'Gone', b'four'),
+            (5, 'Old Model', b'five'),
+    ]:
+        database.put(doppelganger.db.Entry(
+            dsid=dsid,
+            name=name,
+            facial_encoding=numpy.zeros(128),
+            picture=jpeg,
+            photo_hash=doppelganger.db.hash_picture(jpeg),
+            model_version=doppelganger.profiles.get_model_version() if dsid != 5 else 'old',
+        ))
+
+    sync = doppelganger.cli.Sync(database)
+    changed = list(sync.changed([
+        make_record(1, 'Unchanged', b'one'),
+        make_record(2, 'New Name', b'two'),
+        make_record(3, 'New Photo', b'changed'),
+        make_record(5, 'Old Model', b'five'),
+        make_record(6, 'Added', b'six'),
+        make_record(7, 'Faceless', b'seven'),
+    ]))
+    assert [employee['appledsId'] for employee in changed] == ['3', '5', '6', '7']
+
+    results = [(employee, [numpy.ones(128)], None) for employee in changed]
+    results[-1] = (changed[-1], [], None)
+    database.put_many(sync.entries(results))
+    sync.finish()
+
+    assert sync.counts['added'] == 1
+    assert sync.counts['updated'] == 3
+    assert sync.counts['unchanged'] == 1
+    assert sync.counts['deleted'] == 1
+    assert sync.counts['faceless'] == 1
+
+    fingerprints = database.get_fingerprints()
+    assert sorted(fingerprints) == [1, 2, 3, 5, 6]
+    assert fingerprints[2][0] == 'New Name'
+    assert fingerprints[3][1] == doppelganger.db.hash_picture(b'changed')
+    assert fingerprints[5][2] == doppelganger.profiles.get_model_version()
+
+    # The faceless photo isn't looked at again, and an employee whose new
+    # photo has no face is removed without counting as deleted
+    sync = doppelganger.cli.Sync(database)
+    changed = list(sync.changed([
+        make_record(1, 'Unchanged', b'no face'),
+        make_record(7, 'Faceless', b'seven'),
+    ]))
+    assert [employee['appledsId'] for employee in changed] == ['1']
+    database.put_many(sync.entries([(changed[0], [], None)]))
+    sync.finish()
+
+    assert sync.counts['faceless'] == 2
+    assert sync.counts['deleted'] == 4
+    assert sorted(database.get_fingerprints()) == []
+    assert sorted(doppelganger.db.Faceless(database).get_fingerprints()) == [1, 7]
+
+    # A new photo with a face is added and no longer remembered as faceless
+    sync = doppelganger.cli.Sync(database)
+    changed = list(sync.changed([make_record(7, 'Faceless', b'face')]))
+    database.put_many(sync.entries([(changed[0], [numpy.ones(128)], None)]))
+    sync.finish()
+
+    assert sync.counts['added'] == 1
+    assert sync.counts['deleted'] == 0
+    assert sorted(database.get_fingerprints()) == [7]
+    assert sorted(doppelganger.db.Faceless(database).get_fingerprints()) == []
+
+
+def put_lookalikes(database, dsids, center):
+    '''
+    Puts an employee per dsid with an encoding close to center
+    '''
+    for dsid in dsids:
+        jpeg = str(dsid).encode('ascii')
+        database.put(doppelganger.db.Entry(
+            dsid=dsid,
+            name='Employee {}'.format(dsid),
+            facial_encoding=numpy.full(128, center) + dsid * 0.0001,
+            picture=jpeg,
+            photo_hash=doppelganger.db.hash_picture(jpeg),
+        ))
+
+
+def test_cluster(tmpdir):
+    '''
+    Checks that cluster puts lookalikes together, the same way every time,
+    and that afterwards it only fits in who changed
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    database = doppelganger.db.Database(path)
+    put_lookalikes(database, range(1, 11), 0.1)
+    put_lookalikes(database, range(11, 21), -0.1)
+    clusters = doppelganger.db.Clusters(database)
+    parser = doppelganger.cli.argument_parser()
+
+    with patch('doppelganger.cli.db.DB_PATH', path):
+        args = parser.parse_args(['cluster', '--clusters', '2', '--chunk-size', '4'])
+        args.func(args)
+        members = dict((dsid, label) for (label, dsid, _, _) in clusters.get_members())
+        assert len(set(members[dsid] for dsid in range(1, 11))) == 1
+        assert len(set(members[dsid] for dsid in range(11, 21))) == 1
+        assert members[1] != members[11]
+        (centroids, weights) = clusters.get_centroids()
+        assert weights.sum() == 60
+
+        args = parser.parse_args(['cluster', '--full', '--chunk-size', '4'])
+        args.func(args)
+        assert numpy.array_equal(clusters.get_centroids()[0], centroids)
+
+        # One gone and one added is few enough to fit into the clusters
+        database.delete_many([20])
+        put_lookalikes(database, [21], -0.1)
+        assert clusters.count_changed() == 1
+        args = parser.parse_args(['cluster'])
+        args.func(args)
+
+    assert clusters.count_changed() == 0
+    (moved, moved_weights) = clusters.get_centroids()
+    assert list(moved_weights) == list(weights)
+    assert not numpy.array_equal(moved, centroids)
+    members = dict((dsid, label) for (label, dsid, _, _) in clusters.get_members())
+    assert sorted(members) == list(range(1, 20)) + [21]
+    assert members[21] == members[11]
+
+
+def test_cluster_too_many(tmpdir):
+    '''
+    Checks that asking for more clusters than employees stores one per
+    employee, and that asking again doesn't cluster them all over again
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    database = doppelganger.db.Database(path)
+    put_lookalikes(database, range(1, 6), 0.1)
+    clusters = doppelganger.db.Clusters(database)
+    parser = doppelganger.cli.argument_parser()
+    args = parser.parse_args(['cluster', '--clusters', '8'])
+
+    with patch('doppelganger.cli.db.DB_PATH', path):
+        args.func(args)
+        assert len(clusters.get_centroids()[0]) == 5
+
+        with patch('doppelganger.cli.recluster') as recluster:
+            args.func(args)
+        assert not recluster.called
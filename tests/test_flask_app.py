@@ -0,0 +1,121 @@
+'''
+Tests the startup of the web service
+'''
+
+import base64
+
+from mock import (
+    patch,
+    MagicMock,
+)
+
+from doppelganger import (
+    flask_app,
+    logic,
+    ml,
+    snapshot,
+)
+
+
+def get_ready():
+    '''
+    Returns the status code and ready flag that /ready answers with
+    '''
+    response = flask_app.APP.test_client().get('/ready')
+    return response.status_code, response.get_json()['ready']
+
+
+@patch('doppelganger.flask_app.get_batcher')
+@patch('doppelganger.flask_app.get_snapshot')
+@patch('doppelganger.flask_app.get_pipeline')
+@patch('doppelganger.flask_app.ml.warm_up')
+def test_warm_up(warm_up_func, pipeline_func, snapshot_func, batcher_func):
+    '''
+    The server is only ready once everything has been loaded and run once
+    '''
+    flask_app.READY.clear()
+    snapshot_func.return_value.searcher.nearest_many.return_value = []
+    assert get_ready() == (503, False)
+
+    flask_app.start().join()
+    warm_up_func.assert_called_once_with(
+        pipeline_func.return_value,
+        flask_app.APP.config['PROFILE'],
+    )
+    snapshot_func.return_value.searcher.nearest_many.assert_called_once()
+    batcher_func.assert_called_once_with()
+    assert get_ready() == (200, True)
+    flask_app.READY.clear()
+
+
+@patch('doppelganger.flask_app.get_batcher', MagicMock())
+@patch('doppelganger.flask_app.get_snapshot', MagicMock())
+@patch('doppelganger.flask_app.get_pipeline', MagicMock())
+@patch('doppelganger.flask_app.ml.warm_up')
+def test_warm_up_failed(warm_up_func):
+    '''
+    A server that couldn't warm up never says it's ready
+    '''
+    flask_app.READY.clear()
+    warm_up_func.side_effect = IOError('No models')
+    flask_app.warm_up()
+    assert get_ready() == (503, False)
+
+
+@patch('doppelganger.flask_app.get_database')
+@patch('doppelganger.flask_app.get_snapshot')
+@patch('doppelganger.flask_app.get_batcher')
+def test_process(batcher_func, snapshot_func, database_func):
+    '''
+    /process answers compactly by default, or streams pictures if asked
+    '''
+    flask_app.CACHE.clear()
+    snapshot_func.return_value = snapshot.Snapshot(1, None, None)
+    face = ml.PipelineResult({'x': 1, 'y': 2, 'width': 3, 'height': 4}, [], None)
+    twin = logic.Twin(0.5, 'Name', 7, None)
+    batcher_func.return_value.submit.return_value = [(face, [twin])]
+    database_func.return_value.get_pictures.return_value = {7: b'jpeg'}
+
+    client = flask_app.APP.test_client()
+    image_uri = 'data:image/jpeg;base64,' + base64.b64encode(b'image').decode()
+
+    response = client.post('/process', data={'image_uri': image_uri})
+    assert 'Content-Length' in response.headers
+    assert response.get_json()['faces'][0]['twins'] == [
+        {'dsid': 7, 'name': 'Name', 'distance': 0.5},
+    ]
+
+    response = client.post('/process', data={'image_uri': image_uri, 'compact': '0'})
+    assert 'Content-Length' not in response.headers
+    assert response.get_json()['faces'][0]['twins'][0]['picture'] == 'anBlZw=='
+
+    # The second upload of the same image came from the cache
+    batcher_func.return_value.submit.assert_called_once_with(b'image')
+    flask_app.CACHE.clear()
+
+
+@patch('doppelganger.flask_app.get_database')
+def test_picture(database_func):
+    '''
+    /picture has the browser check its copy every time, and only sends the
+    jpeg again once it has changed
+    '''
+    database_func.return_value.get_picture.return_value = b'jpeg'
+    client = flask_app.APP.test_client()
+
+    response = client.get('/picture/7')
+    assert response.data == b'jpeg'
+    assert response.cache_control.no_cache
+    assert response.cache_control.max_age is None
+    etag = response.headers['ETag']
+
+    response = client.get('/picture/7', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    database_func.return_value.get_picture.return_value = b'new jpeg'
+    response = client.get('/picture/7', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.data == b'new jpeg'
+
+    database_func.return_value.get_picture.return_value = None
+    assert client.get('/picture/8').status_code == 404
@@ -0,0 +1,141 @@
+'''
+Tests the code in cluster.py and ivf.py
+'''
+
+import numpy
+
+from benchmarks import synthetic
+from doppelganger import (
+    cluster,
+    ivf,
+    search,
+)
+
+
+def test_kmeans_deterministic():
+    '''
+    The same seed should always train the same centroids
+    '''
+    matrix = synthetic.make_matrix(300)
+    first = cluster.kmeans(matrix.encodings, 10, seed=3)
+    second = cluster.kmeans(matrix.encodings, 10, seed=3)
+    assert first.shape == (10, 128)
+    assert numpy.array_equal(first, second)
+
+
+def test_minibatch_kmeans():
+    '''
+    Mini-batch k-means over chunks finds the same centers as the data has,
+    and the same seed always trains the same centroids
+    '''
+    matrix = synthetic.make_matrix(600, seed=3, center_count=10, spread=0.02)
+
+    def get_chunks():
+        '''
+        The encodings a hundred at a time
+        '''
+        for start in range(0, len(matrix), 100):
+            yield matrix.encodings[start:start + 100]
+
+    (first, weights) = cluster.minibatch_kmeans(get_chunks, 10, epochs=2, seed=3)
+    (second, _) = cluster.minibatch_kmeans(get_chunks, 10, epochs=2, seed=3)
+    assert first.shape == (10, 128)
+    assert numpy.array_equal(first, second)
+    assert weights.sum() == 1200
+
+    labels = cluster.assign(matrix.encodings, first)
+    distances = cluster.distances_to(matrix.encodings, first, labels)
+    assert distances.mean() < 0.3
+
+
+def test_assign_nearest():
+    '''
+    Every row should be assigned to its closest centroid
+    '''
+    matrix = synthetic.make_matrix(200)
+    centroids = matrix.encodings[:7]
+    labels = cluster.assign(matrix.encodings, centroids)
+    for (row, label) in zip(matrix.encodings, labels):
+        distances = numpy.linalg.norm(centroids - row, axis=1)
+        assert distances[label] == distances.min()
+
+
+def test_full_probe_is_exact():
+    '''
+    When every list is probed, the index must agree with the exact search
+    '''
+    matrix = synthetic.make_matrix(500)
+    ivf_index = ivf.IVFIndex.train(matrix, 16)
+    for row in [0, 17, 499]:
+        query = matrix.encodings[row]
+        exact_indices, exact_distances = matrix.nearest(query, 20)
+        indices, distances = ivf_index.nearest(query, 20, nprobe=16)
+        assert list(indices) == list(exact_indices)
+        assert numpy.allclose(distances, exact_distances)
+
+
+def test_save_and_load(tmpdir):
+    '''
+    A saved index should load back up against a changed matrix, dropping
+    employees that are gone and filing ones that are new
+    '''
+    matrix = synthetic.make_matrix(300)
+    ivf_index = ivf.IVFIndex.train(matrix, 8)
+    path = str(tmpdir.join('doppelganger.ivf.npz'))
+    ivf_index.save(path)
+
+    loaded = ivf.IVFIndex.load(path, matrix)
+    assert numpy.array_equal(loaded.rows, ivf_index.rows)
+    assert numpy.array_equal(loaded.offsets, ivf_index.offsets)
+
+    changed = search.EncodingMatrix(
+        list(range(100, 400)),
+        matrix.names,
+        matrix.encodings,
+    )
+    loaded = ivf.IVFIndex.load(path, changed, nprobe=8)
+    assert loaded.offsets[-1] == 300
+    indices, _ = loaded.nearest(changed.encodings[250], 1)
+    assert list(indices) == [250]
+
+
+def test_recall_report():
+    '''
+    The exact search is always first, and probing everything is full recall
+    '''
+    matrix = synthetic.make_matrix(400)
+    ivf_index = ivf.IVFIndex.train(matrix, 10)
+    report = ivf.recall_report(matrix, ivf_index, [1, 10], 5, 20)
+    assert [nprobe for (nprobe, _, _) in report] == [None, 1, 10]
+    assert report[0][1] == 1.0
+    assert report[2][1] == 1.0
+    assert 0 <= report[1][1] <= 1.0
+
+
+def test_index_path():
+    '''
+    The index sits next to the database
+    '''
+    assert ivf.get_index_path('./doppelganger.db') == './doppelganger.ivf.npz'
+
+
+def test_nearest_many():
+    '''
+    Searching many faces at once should match searching one at a time
+    '''
+    matrix = synthetic.make_matrix(500)
+    ivf_index = index_for(matrix)
+    queries = matrix.encodings[[3, 30, 300, 499]]
+    for nprobe in [1, 3]:
+        results = ivf_index.nearest_many(queries, 10, nprobe)
+        for (query, (indices, distances)) in zip(queries, results):
+            expected_indices, expected_distances = ivf_index.nearest(query, 10, nprobe)
+            assert list(indices) == list(expected_indices)
+            assert numpy.allclose(distances, expected_distances)
+
+
+def index_for(matrix):
+    '''
+    Trains a small index over the matrix
+    '''
+    return ivf.IVFIndex.train(matrix, 12)
@@ -0,0 +1,78 @@
+'''
+Tests the results cache
+'''
+
+from doppelganger import lru
+
+
+def test_get_put():
+    '''
+    Values come back until something newer pushes them out
+    '''
+    cache = lru.LRUCache(max_size=2)
+    assert cache.get('a', 1) is None
+    cache.put('a', 'A', 1)
+    cache.put('b', 'B', 1)
+    assert cache.get('a', 1) == 'A'
+
+    # b is now the least recently used, so it goes first
+    cache.put('c', 'C', 1)
+    assert cache.get('b', 1) is None
+    assert cache.get('a', 1) == 'A'
+    assert cache.get('c', 1) == 'C'
+
+    stats = cache.stats()
+    assert stats['hits'] == 3
+    assert stats['misses'] == 2
+    assert stats['evicted'] == 1
+    assert stats['size'] == 2
+
+
+def test_max_age():
+    '''
+    Values are forgotten once they're too old
+    '''
+    now = [1000.0]
+    cache = lru.LRUCache(max_age=10, clock=lambda: now[0])
+    cache.get('a', 1)
+    cache.put('a', 'A', 1)
+
+    now[0] += 10
+    assert cache.get('a', 1) == 'A'
+    now[0] += 1
+    assert cache.get('a', 1) is None
+    assert cache.stats()['expired'] == 1
+
+
+def test_version():
+    '''
+    A new version empties the cache, and puts from old versions are ignored
+    '''
+    cache = lru.LRUCache()
+    cache.get('a', 1)
+    cache.put('a', 'A', 1)
+    assert cache.get('a', 2) is None
+    assert cache.stats()['invalidated'] == 1
+
+    cache.put('a', 'A', 1)
+    assert cache.get('a', 2) is None
+    cache.put('a', 'A2', 2)
+    assert cache.get('a', 2) == 'A2'
+
+
+def test_old_version():
+    '''
+    A request still on an older version misses without emptying the cache
+    '''
+    cache = lru.LRUCache()
+    cache.get('a', (2, 0))
+    cache.put('a', 'A2', (2, 0))
+
+    assert cache.get('a', (1, 0)) is None
+    cache.put('a', 'A1', (1, 0))
+    assert cache.get('a', (2, 0)) == 'A2'
+    assert cache.stats()['invalidated'] == 0
+
+    # A rebuilt index is newer at the same revision
+    assert cache.get('a', (2, 5.0)) is None
+    assert cache.stats()['invalidated'] == 1
@@ -2,7 +2,10 @@
 Tests functions defined in the ml module
 '''
 
-from doppelganger import ml
+from doppelganger import (
+    ml,
+    profiles,
+)
 
 from mock import (
     MagicMock,
@@ -52,83 +55,114 @@ def test_pipeline_result():
     assert pipeline[2] == pipeline.encoding
 
 
-@patch('doppelganger.ml.calculate_encoding_for_face')
-@patch('doppelganger.ml.dlib.load_rgb_image')
-def test_calculate_encoding_image(loader_func, calculator_func):
+@patch('doppelganger.ml.calculate_encodings_for_images')
+@patch('doppelganger.ml.decode_image')
+def test_calculate_encoding_bytes(decoder_func, calculator_func):
     '''
-    Verifies calculate_encoding_for_image behaves correctly
+    Verifies calculate_encoding_for_bytes behaves correctly
     '''
-
-    # Mock the inputs
-    file_name = MagicMock()
+    image_bytes = MagicMock()
     pipeline = MagicMock()
-
-    # Mock the internal calls
-    face_image = MagicMock()
-    loader_func.return_value = face_image
-
-    face_locations = [MagicMock(), MagicMock()]
-    pipeline.face_detector = MagicMock(return_value=face_locations)
     pipeline_results = [MagicMock(), MagicMock()]
-    calculator_func.side_effect = pipeline_results
+    calculator_func.return_value = [pipeline_results]
 
-    # Execute
-    result = ml.calculate_encoding_for_image(file_name, pipeline)
+    result = ml.calculate_encoding_for_bytes(image_bytes, pipeline)
     assert result == pipeline_results
 
-    # Check the internal calls
-    loader_func.assert_called_once_with(file_name)
-    pipeline.face_detector.assert_called_once_with(loader_func.return_value, 1)
-    calculator_func.assert_has_calls(
-        [call(pipeline, face_image, location) for location in face_locations],
-        any_order=True,
+    decoder_func.assert_called_once_with(image_bytes)
+    calculator_func.assert_called_once_with(
+        [decoder_func.return_value],
+        pipeline,
+        profiles.DEFAULT_PROFILE,
     )
 
 
-@patch('doppelganger.ml.primitivize_encoding')
-@patch('doppelganger.ml.primitivize_landmarks')
-@patch('doppelganger.ml.primitivize_location')
-def test_calculate_encoding_face(location_func, landmarks_func, encoding_func):
+@patch('doppelganger.ml.build_pipeline_result')
+@patch('doppelganger.ml.dlib.full_object_detections', list)
+def test_calculate_encodings_images(builder_func):
     '''
-    Checks calculate_encoding_for_face runs properly
+    Verifies that every face of every image is encoded in one batch, and
+    that images without faces are left out of it
     '''
-    # Mock inputs
+    images = [MagicMock(), MagicMock(), MagicMock()]
+    locations = {
+        images[0]: [MagicMock(), MagicMock()],
+        images[1]: [],
+        images[2]: [MagicMock()],
+    }
     pipeline = MagicMock()
-    face_image = MagicMock()
-    location = MagicMock()
+    pipeline.face_detector.side_effect = lambda image, _upsample: locations[image]
+    pipeline.pose_analyzer.side_effect = lambda image, location: (image, location)
+    pipeline.face_encoder.compute_face_descriptor.return_value = [
+        ['encoding 0', 'encoding 1'],
+        ['encoding 2'],
+    ]
+    builder_func.side_effect = lambda *args: args
+
+    results = ml.calculate_encodings_for_images(
+        images,
+        pipeline,
+        profiles.Profile(max_size=None, upsample=1, jitter=1),
+    )
+    assert results == [
+        [
+            (location, (images[0], location), encoding)
+            for (location, encoding)
+            in zip(locations[images[0]], ['encoding 0', 'encoding 1'])
+        ],
+        [],
+        [(locations[images[2]][0], (images[2], locations[images[2]][0]), 'encoding 2')],
+    ]
 
-    # Mock internals
-    landmarks = MagicMock()
-    pipeline.pose_analyzer.return_value = landmarks
+    pipeline.face_encoder.compute_face_descriptor.assert_called_once_with(
+        [images[0], images[2]],
+        [
+            [(images[0], location) for location in locations[images[0]]],
+            [(images[2], locations[images[2]][0])],
+        ],
+        1,
+    )
 
-    encoding = MagicMock()
-    pipeline.face_encoder.compute_face_descriptor.return_value = encoding
 
-    primitive_location = MagicMock()
-    location_func.return_value = primitive_location
+@patch('doppelganger.ml.calculate_encoding_for_bytes')
+def test_calculate_encoding_image(calculator_func, tmpdir):
+    '''
+    Verifies calculate_encoding_for_image just reads the file for
+    calculate_encoding_for_bytes
+    '''
+    image_file = tmpdir.join('face.jpg')
+    image_file.write_binary(b'jpeg bits')
+    pipeline = MagicMock()
 
-    primitive_landmarks = MagicMock()
-    landmarks_func.return_value = primitive_landmarks
+    result = ml.calculate_encoding_for_image(str(image_file), pipeline)
+    assert result == calculator_func.return_value
+    calculator_func.assert_called_once_with(
+        b'jpeg bits',
+        pipeline,
+        profiles.DEFAULT_PROFILE,
+    )
 
-    primitive_encoding = MagicMock()
-    encoding_func.return_value = primitive_encoding
 
-    # Drive function and check result
-    result = ml.calculate_encoding_for_face(pipeline, face_image, location)
-    assert result.location == primitive_location
-    assert result.landmarks == primitive_landmarks
-    assert result.encoding == primitive_encoding
+def test_decode_image():
+    '''
+    Checks that encoded images come back as RGB arrays, and that
+    garbage is an error rather than a crash inside dlib
+    '''
+    import cv2
+    import numpy
+    import pytest
 
-    # Check internals
-    pipeline.pose_analyzer.assert_called_once_with(face_image, location)
-    pipeline.face_encoder.compute_face_descriptor.assert_called_once_with(
-        face_image,
-        landmarks,
-        1,
-    )
-    location_func.assert_called_once_with(location)
-    landmarks_func.assert_called_once_with(landmarks)
-    encoding_func.assert_called_once_with(encoding)
+    # A 2x1 image of pure red then pure blue, in OpenCV's BGR order
+    bgr = numpy.array([[[0, 0, 255], [255, 0, 0]]], dtype=numpy.uint8)
+    _, png = cv2.imencode('.png', bgr)  # pylint: disable=no-member
+
+    rgb = ml.decode_image(png.tobytes())
+    assert rgb.shape == (1, 2, 3)
+    assert list(rgb[0][0]) == [255, 0, 0]
+    assert list(rgb[0][1]) == [0, 0, 255]
+
+    with pytest.raises(ValueError):
+        ml.decode_image(b'not an image')
 
 
 @patch('doppelganger.ml.point_to_dict')
@@ -206,3 +240,60 @@ def test_save_bytes_to_file():
     file_name = ml.save_bytes_to_file(content)
     with open(file_name) as handle:
         assert handle.read() == content
+
+
+def test_get_scale():
+    '''
+    Only images bigger than the profile allows are shrunk
+    '''
+    assert ml.get_scale((480, 640, 3), None) == 1
+    assert ml.get_scale((480, 640, 3), 640) == 1
+    assert ml.get_scale((480, 640, 3), 320) == 0.5
+    assert ml.get_scale((1000, 500, 3), 250) == 0.25
+
+
+@patch('doppelganger.ml.dlib.rectangles', list)
+@patch('doppelganger.ml.dlib.rectangle')
+def test_detect_faces_shrunk(rectangle_func):
+    '''
+    Faces found in a shrunk image are given back in full size coordinates
+    '''
+    import numpy
+
+    image = numpy.zeros((400, 800, 3), dtype=numpy.uint8)
+    location = MagicMock()
+    location.left.return_value = 10
+    location.top.return_value = 20
+    location.right.return_value = 30
+    location.bottom.return_value = 41
+    pipeline = MagicMock()
+    pipeline.face_detector.return_value = [location]
+
+    profile = profiles.Profile(max_size=200, upsample=0, jitter=1)
+    locations = ml.detect_faces(pipeline, image, profile)
+
+    (small_image, upsample) = pipeline.face_detector.call_args[0]
+    assert small_image.shape == (100, 200, 3)
+    assert upsample == 0
+    assert locations == [rectangle_func.return_value]
+    rectangle_func.assert_called_once_with(40, 80, 120, 164)
+
+
+@patch('doppelganger.ml.dlib.full_object_detections', list)
+@patch('doppelganger.ml.calculate_encodings_for_images')
+def test_warm_up(calculator_func):
+    '''
+    Every model of the pipeline gets run once, even with no face to find
+    '''
+    pipeline = MagicMock()
+    ml.warm_up(pipeline, 'accurate')
+
+    ((images, called_pipeline, profile), _) = calculator_func.call_args
+    assert images[0].shape == (256, 256, 3)
+    assert (called_pipeline, profile) == (pipeline, 'accurate')
+    pipeline.pose_analyzer.assert_called_once()
+    pipeline.face_encoder.compute_face_descriptor.assert_called_once_with(
+        [images[0]],
+        [[pipeline.pose_analyzer.return_value]],
+        profiles.PROFILES['accurate'].jitter,
+    )
@@ -0,0 +1,30 @@
+'''
+Tests the speed vs accuracy profiles
+'''
+
+import pytest
+
+from doppelganger import profiles
+
+
+def test_get_profile():
+    '''
+    Profiles can be asked for by name or given directly
+    '''
+    assert profiles.get_profile('fast') == profiles.PROFILES['fast']
+    profile = profiles.Profile(max_size=100, upsample=2, jitter=3)
+    assert profiles.get_profile(profile) is profile
+    with pytest.raises(ValueError):
+        profiles.get_profile('ludicrous')
+
+
+def test_get_model_version():
+    '''
+    Every setting of a profile changes the model version, since detection
+    decides which faces get encoded
+    '''
+    versions = set(profiles.get_model_version(name) for name in profiles.PROFILES)
+    assert len(versions) == len(profiles.PROFILES)
+    assert profiles.get_model_version(
+        profiles.Profile(max_size=1024, upsample=2, jitter=1)
+    ) != profiles.get_model_version('balanced')
@@ -0,0 +1,53 @@
+'''
+Tests the code in quantized.py
+'''
+
+import numpy
+
+from benchmarks import synthetic
+from doppelganger import (
+    quantized,
+    search,
+)
+
+
+def test_quantize_round_trip():
+    '''
+    Codes come back to within half a step of the encodings
+    '''
+    encodings = synthetic.make_matrix(200).encodings
+    (codes, center, scale) = quantized.quantize(encodings)
+    assert codes.dtype == numpy.int8
+    decoded = center + scale * codes
+    assert (numpy.abs(decoded - encodings) <= scale * 0.5001).all()
+
+
+def test_same_as_exact():
+    '''
+    With enough candidates, the twins and their distances are exactly
+    those of the exact search
+    '''
+    matrix = synthetic.make_matrix(500)
+    searcher = quantized.QuantizedMatrix(matrix, candidates=64)
+    queries = matrix.encodings[::50] + 0.01
+
+    for (query, (indices, distances)) in zip(
+            queries, searcher.nearest_many(queries, 10, block_size=64)):
+        (exact_indices, exact_distances) = matrix.nearest(query, 10)
+        assert list(indices) == list(exact_indices)
+        assert numpy.array_equal(distances, exact_distances)
+
+    (indices, _) = searcher.nearest(matrix.encodings[7], 1)
+    assert list(indices) == [7]
+    assert searcher.names[7] == 'Employee 7'
+
+
+def test_empty():
+    '''
+    An empty matrix quantizes to nothing and finds no one
+    '''
+    matrix = search.EncodingMatrix([], [], numpy.empty((0, 128)))
+    searcher = quantized.QuantizedMatrix(matrix)
+    assert len(searcher) == 0  # pylint: disable=len-as-condition
+    (indices, _) = searcher.nearest(numpy.zeros(128), 5)
+    assert indices.size == 0
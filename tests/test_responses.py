@@ -0,0 +1,75 @@
+'''
+Tests the json schema of /process responses
+'''
+
+import json
+
+from doppelganger import (
+    logic,
+    ml,
+    responses,
+)
+
+
+def make_faces():
+    '''
+    Two faces with a twin each, as /process gets them from the batcher
+    '''
+    return [
+        (
+            ml.PipelineResult(
+                location={'x': face, 'y': 2, 'width': 3, 'height': 4},
+                landmarks=iter([{'x': 5, 'y': 6}]),
+                encoding=None,
+            ),
+            [logic.Twin(distance=0.25, name='Name {}'.format(face), dsid=face, picture=None)],
+        )
+        for face in [1, 2]
+    ]
+
+
+def test_compact():
+    '''
+    Compact responses have every key but the pictures, in a fixed order
+    '''
+    body = responses.dumps(make_faces())
+    assert body.startswith('{"version": 1, "compact": true, "faces": [{"location"')
+
+    decoded = json.loads(body)
+    assert len(decoded['faces']) == 2
+    assert decoded['faces'][1] == {
+        'location': {'x': 2, 'y': 2, 'width': 3, 'height': 4},
+        'landmarks': [{'x': 5, 'y': 6}],
+        'twins': [{'dsid': 2, 'name': 'Name 2', 'distance': 0.25}],
+    }
+    assert list(decoded['faces'][0]['twins'][0]) == ['dsid', 'name', 'distance']
+
+
+def test_full():
+    '''
+    Full responses look up the pictures a face at a time as they're written
+    '''
+    looked_up = []
+
+    def get_pictures(dsids):
+        '''
+        Remembers what was asked for, and gives back a jpeg per dsid
+        '''
+        looked_up.append(dsids)
+        return dict((dsid, b'jpeg') for dsid in dsids)
+
+    chunks = responses.stream(make_faces(), compact=False, get_pictures=get_pictures)
+    assert json.loads(next(chunks) + ']}') == {'version': 1, 'compact': False, 'faces': []}
+    assert not looked_up
+    next(chunks)
+    assert looked_up == [[1]]
+
+    decoded = json.loads(responses.dumps(make_faces(), False, get_pictures))
+    assert decoded['faces'][0]['twins'][0]['picture'] == 'anBlZw=='
+
+
+def test_no_faces():
+    '''
+    No faces is still a whole response
+    '''
+    assert json.loads(responses.dumps([])) == {'version': 1, 'compact': True, 'faces': []}
@@ -0,0 +1,141 @@
+'''
+Tests the code in scheduler.py
+'''
+
+import threading
+import time
+
+import pytest
+
+from doppelganger import scheduler
+
+
+def run_concurrently(batcher, items):
+    '''
+    Submits every item from its own thread, returning results by item
+    '''
+    results = {}
+
+    def submit(item):
+        '''
+        Records the result, or error, of one item
+        '''
+        try:
+            results[item] = batcher.submit(item)
+        except Exception as error:  # pylint: disable=broad-except
+            results[item] = error
+
+    threads = [threading.Thread(target=submit, args=(item,)) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batches_within_window():
+    '''
+    Items arriving together are processed in one batch, and each caller
+    only gets the result for their own item
+    '''
+    batches = []
+
+    def process_batch(items):
+        '''
+        Squares numbers, failing on negative ones
+        '''
+        batches.append(list(items))
+        return [
+            ValueError(item) if item < 0 else item * item
+            for item in items
+        ]
+
+    batcher = scheduler.MicroBatcher(process_batch, window=0.2)
+    results = run_concurrently(batcher, [1, 2, 3, -4])
+
+    assert results[1] == 1
+    assert results[3] == 9
+    assert isinstance(results[-4], ValueError)
+    assert len(batches) == 1
+    assert sorted(batches[0]) == [-4, 1, 2, 3]
+
+
+def test_batch_size_limit():
+    '''
+    No batch holds more than max_batch items
+    '''
+    batches = []
+
+    def process_batch(items):
+        '''
+        Records the batch and echoes the items back
+        '''
+        batches.append(len(items))
+        return items
+
+    batcher = scheduler.MicroBatcher(process_batch, window=0.2, max_batch=2)
+    results = run_concurrently(batcher, range(5))
+    assert results == dict((item, item) for item in range(5))
+    assert max(batches) <= 2
+
+
+def test_window_caps_latency():
+    '''
+    A lone item doesn't wait much longer than the window
+    '''
+    batcher = scheduler.MicroBatcher(lambda items: items, window=0.05)
+    start = time.time()
+    assert batcher.submit('alone') == 'alone'
+    assert time.time() - start < 0.5
+
+
+def test_failed_batch():
+    '''
+    A batch that blows up fails its items but not the batcher
+    '''
+    calls = []
+
+    def process_batch(items):
+        '''
+        Fails the first batch only
+        '''
+        calls.append(items)
+        if len(calls) == 1:
+            raise RuntimeError('Broken')
+        return items
+
+    batcher = scheduler.MicroBatcher(process_batch, window=0)
+    with pytest.raises(RuntimeError):
+        batcher.submit('first')
+    assert batcher.submit('second') == 'second'
+
+
+def test_overloaded():
+    '''
+    A full queue turns work away instead of queueing it
+    '''
+    release = threading.Event()
+
+    def process_batch(items):
+        '''
+        Blocks until released
+        '''
+        release.wait()
+        return items
+
+    batcher = scheduler.MicroBatcher(
+        process_batch,
+        window=0,
+        max_batch=1,
+        max_queue=1,
+    )
+    waiting = threading.Thread(target=batcher.submit, args=('busy',))
+    waiting.start()
+    time.sleep(0.1)  # Let the batcher take it and block
+    batcher.jobs.put_nowait(scheduler.Job('queued'))
+
+    with pytest.raises(scheduler.Overloaded):
+        batcher.submit('turned away')
+
+    release.set()
+    waiting.join()
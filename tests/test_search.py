@@ -0,0 +1,164 @@
+'''
+Tests the code in search.py and the twin finding in logic.py
+'''
+
+import numpy
+
+from doppelganger import (
+    db,
+    logic,
+    search,
+)
+
+
+def make_entries(count, seed=0):
+    '''
+    Builds `count` fake db.Entry with random encodings
+    '''
+    random = numpy.random.RandomState(seed)
+    return [
+        db.Entry(
+            name='Employee {}'.format(index),
+            dsid=index + 1000,
+            facial_encoding=random.uniform(-0.3, 0.3, 128).astype(numpy.float32),
+            picture=b'jpeg bits',
+        )
+        for index in range(count)
+    ]
+
+
+def test_nearest_brute_force():
+    '''
+    The batched search should agree with checking each employee one by one
+    '''
+    entries = make_entries(500)
+    matrix = search.EncodingMatrix.from_entries(entries)
+    query = entries[42].facial_encoding + 0.01
+
+    expected = sorted(
+        range(len(entries)),
+        key=lambda i: numpy.linalg.norm(entries[i].facial_encoding - query),
+    )[:20]
+
+    indices, distances = matrix.nearest(query, 20)
+    assert list(indices) == expected
+    assert indices[0] == 42
+    assert list(distances) == sorted(distances)
+
+
+def test_nearest_past_corpus():
+    '''
+    Asking for more twins than there are employees returns everyone
+    '''
+    matrix = search.EncodingMatrix.from_entries(make_entries(5))
+    indices, _ = matrix.nearest(numpy.zeros(128), 20)
+    assert sorted(indices) == [0, 1, 2, 3, 4]
+
+
+def test_nearest_empty():
+    '''
+    An empty database should not blow up
+    '''
+    matrix = search.EncodingMatrix.from_entries([])
+    indices, distances = matrix.nearest(numpy.zeros(128), 20)
+    assert len(indices) == 0
+    assert len(distances) == 0
+
+
+def test_compare():
+    '''
+    Checks that compare returns twins nearest first with encoded pictures
+    '''
+    entries = make_entries(50)
+    twins = logic.compare(entries[7].facial_encoding, entries, 3)
+
+    assert len(twins) == 3
+    assert twins[0].dsid == 1007
+    assert twins[0].name == 'Employee 7'
+    assert twins[0].distance == 0
+    assert twins[0].picture == 'anBlZyBiaXRz'
+    assert [twin.distance for twin in twins] == sorted(
+        twin.distance for twin in twins
+    )
+
+
+def test_nearest_many():
+    '''
+    Searching many faces at once should give the same answers as
+    searching them one at a time
+    '''
+    entries = make_entries(300)
+    matrix = search.EncodingMatrix.from_entries(entries)
+    queries = numpy.array([entries[row].facial_encoding + 0.01 for row in [0, 5, 299]])
+
+    results = matrix.nearest_many(queries, 10)
+    assert len(results) == 3
+    for (query, (indices, distances)) in zip(queries, results):
+        expected_indices, expected_distances = matrix.nearest(query, 10)
+        assert list(indices) == list(expected_indices)
+        assert numpy.array_equal(distances, expected_distances)
+
+
+def test_find_twins_many():
+    '''
+    Twins for many faces come back in the order the faces were given
+    '''
+    entries = make_entries(30)
+    matrix = search.EncodingMatrix.from_entries(entries)
+    twins = logic.find_twins_many(
+        matrix,
+        [entries[4].facial_encoding, entries[9].facial_encoding],
+        2,
+        lambda dsids: dict((dsid, b'jpeg') for dsid in dsids),
+    )
+    assert [face_twins[0].dsid for face_twins in twins] == [1004, 1009]
+    assert twins[1][0].picture == 'anBlZw=='
+
+
+def test_nearest_many_blocked():
+    '''
+    Going through the employees in blocks shouldn't change the answers,
+    including when the last block is a short one
+    '''
+    entries = make_entries(250)
+    matrix = search.EncodingMatrix.from_entries(entries)
+    queries = numpy.array([entries[row].facial_encoding for row in range(0, 250, 25)])
+
+    whole = matrix.nearest_many(queries, 5, block_size=1000)
+    blocked = matrix.nearest_many(queries, 5, block_size=16)
+    for ((indices, distances), (blocked_indices, blocked_distances)) in zip(
+            whole, blocked):
+        assert list(indices) == list(blocked_indices)
+        assert numpy.array_equal(distances, blocked_distances)
+
+
+def test_name_table():
+    '''
+    Names come back by row however many rows share them
+    '''
+    names = search.NameTable.from_names(['Zoë', 'Bob', 'Zoë', '', 'Bob'])
+    assert list(names) == ['Zoë', 'Bob', 'Zoë', '', 'Bob']
+    assert names[numpy.int64(2)] == 'Zoë'
+    assert len(names) == 5
+    assert len(names.offsets) == 4
+    assert names.data.tobytes() == 'ZoëBob'.encode('utf8')
+
+
+def test_from_database():
+    '''
+    Streaming the database into the matrix gives the same matrix as
+    building it from the entries, without any pictures
+    '''
+    entries = make_entries(50)
+    database = db.Database(':memory:')
+    database.put_many(entries)
+
+    matrix = search.EncodingMatrix.from_database(database)
+    expected = search.EncodingMatrix.from_entries(entries)
+    assert list(matrix.dsids) == list(expected.dsids)
+    assert list(matrix.names) == list(expected.names)
+    assert numpy.array_equal(matrix.encodings, expected.encodings)
+
+    empty = search.EncodingMatrix.from_database(db.Database(':memory:'))
+    assert len(empty) == 0  # pylint: disable=len-as-condition
+    assert empty.nearest(numpy.zeros(128), 5)[0].size == 0
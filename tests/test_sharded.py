@@ -0,0 +1,60 @@
+'''
+Tests the code in sharded.py
+'''
+
+import numpy
+from mock import patch
+
+from benchmarks import synthetic
+from doppelganger import (
+    quantized,
+    search,
+    sharded,
+)
+
+
+def test_split():
+    '''
+    Shards cover every row once, and aren't made too small to be worth it
+    '''
+    with patch('doppelganger.sharded.MIN_SHARD_SIZE', 10):
+        shards = sharded.split(105, 4)
+        assert [len(shard) for shard in shards] == [26, 26, 26, 27]
+        assert [row for shard in shards for row in shard] == list(range(105))
+        assert len(sharded.split(25, 4)) == 2
+        assert len(sharded.split(5, 4)) == 1
+        assert not list(sharded.split(0, 4)[0])
+
+
+def test_same_as_unsharded():
+    '''
+    However many shards, the twins and distances are those of the matrix
+    '''
+    matrix = synthetic.make_matrix(400)
+    queries = matrix.encodings[::40] + 0.01
+    expected = matrix.nearest_many(queries, 10)
+
+    with patch('doppelganger.sharded.MIN_SHARD_SIZE', 16):
+        for shard_count in [1, 3, 8]:
+            searcher = sharded.ShardedSearcher(matrix, shard_count)
+            assert len(searcher.shards) == shard_count
+            for ((indices, distances), (expected_indices, expected_distances)) in zip(
+                    searcher.nearest_many(queries, 10), expected):
+                assert list(indices) == list(expected_indices)
+                assert numpy.array_equal(distances, expected_distances)
+
+        searcher = sharded.ShardedSearcher(quantized.QuantizedMatrix(matrix, 32), 4)
+        (indices, distances) = searcher.nearest(queries[3], 10)
+        assert list(indices) == list(expected[3][0])
+        assert numpy.array_equal(distances, expected[3][1])
+        assert searcher.names[int(indices[0])] == matrix.names[int(indices[0])]
+
+
+def test_empty():
+    '''
+    An empty matrix has one empty shard and finds no one
+    '''
+    matrix = search.EncodingMatrix([], [], numpy.empty((0, 128)))
+    searcher = sharded.ShardedSearcher(matrix, 4)
+    (indices, _) = searcher.nearest(numpy.zeros(128), 5)
+    assert indices.size == 0
@@ -0,0 +1,152 @@
+'''
+Tests the code in sidecar.py
+'''
+
+import os
+
+import numpy
+from mock import patch
+
+from doppelganger import (
+    db,
+    ivf,
+    sidecar,
+)
+
+
+def put_employees(database, dsids):
+    '''
+    Puts an employee with a distinct encoding into the database per dsid
+    '''
+    for dsid in dsids:
+        database.put(db.Entry(
+            dsid=dsid,
+            name='Employee {}'.format(dsid),
+            facial_encoding=numpy.full(128, dsid / 100.0),
+            picture=b'jpeg',
+        ))
+
+
+def test_revision_tracks_changes():
+    '''
+    Any write to the entry table should move the revision forward
+    '''
+    database = db.Database(':memory:')
+    before = database.get_revision()
+    put_employees(database, [1])
+    inserted = database.get_revision()
+    put_employees(database, [1])
+    assert before < inserted < database.get_revision()
+
+
+def test_load_matrix(tmpdir):
+    '''
+    The memory mapped matrix should match the database
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    database = db.Database(path)
+    put_employees(database, [3, 1, 2])
+
+    matrix = sidecar.load_matrix(database, path)
+    assert not matrix.encodings.flags.owndata
+    assert sorted(matrix.dsids) == [1, 2, 3]
+    row = list(matrix.dsids).index(2)
+    assert matrix.names[row] == 'Employee 2'
+    assert numpy.allclose(matrix.encodings[row], 0.02)
+    assert database.count() == 3
+
+
+def test_stale_sidecar_rebuilt(tmpdir):
+    '''
+    Changing the database should rebuild the sidecar and clean up the old one
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    database = db.Database(path)
+    put_employees(database, [1, 2])
+    first = sidecar.write(database, path)
+
+    # An unchanged database reuses the same generation
+    sidecar.load_matrix(database, path)
+    assert sidecar.read_manifest(path) == first
+
+    put_employees(database, [3])
+    matrix = sidecar.load_matrix(database, path)
+    assert sorted(matrix.dsids) == [1, 2, 3]
+
+    second = sidecar.read_manifest(path)
+    assert second['revision'] == database.get_revision()
+
+    # The generation before is kept for anyone who was just opening it,
+    # but the one before that is gone
+    assert os.path.exists(
+        sidecar.get_array_path(path, first['revision'], 'encodings')
+    )
+    put_employees(database, [4])
+    sidecar.load_matrix(database, path)
+    assert not os.path.exists(
+        sidecar.get_array_path(path, first['revision'], 'encodings')
+    )
+    assert os.path.exists(
+        sidecar.get_array_path(path, second['revision'], 'encodings')
+    )
+
+
+def test_empty_database(tmpdir):
+    '''
+    An empty database still makes a usable, empty sidecar
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    matrix = sidecar.load_matrix(db.Database(path), path)
+    assert not matrix
+
+
+def test_opened_generation_removed(tmpdir):
+    '''
+    A generation removed between reading the manifest and opening it is
+    retried with whatever the manifest names by then
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    database = db.Database(path)
+    put_employees(database, [1])
+    sidecar.write(database, path)
+
+    opened = []
+    open_matrix = sidecar.open_matrix
+
+    def open_once_missing(database_path, manifest):
+        '''
+        Fails the first time, as if a newer generation got in first
+        '''
+        opened.append(manifest)
+        if len(opened) == 1:
+            raise IOError('No such file')
+        return open_matrix(database_path, manifest)
+
+    with patch('doppelganger.sidecar.open_matrix', open_once_missing):
+        (manifest, matrix) = sidecar.load_generation(database, path)
+    assert len(opened) == 2
+    assert manifest['revision'] == database.get_revision()
+    assert list(matrix.dsids) == [1]
+
+
+def test_share_index(tmpdir):
+    '''
+    Every process serving the same generation maps the same index lists
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    database = db.Database(path)
+    put_employees(database, range(1, 41))
+    (manifest, matrix) = sidecar.load_generation(database, path)
+    index_path = ivf.get_index_path(path)
+    ivf.IVFIndex.train(matrix, 4).save(index_path)
+
+    indexes = [ivf.IVFIndex.load(index_path, matrix) for _ in range(2)]
+    for ivf_index in indexes:
+        sidecar.share_index(path, manifest, ivf_index, index_path)
+        assert isinstance(ivf_index.encodings, numpy.memmap)
+        assert numpy.array_equal(ivf_index.encodings, matrix.encodings[ivf_index.rows])
+    assert indexes[0].encodings.filename == indexes[1].encodings.filename
+
+    query = matrix.encodings[7]
+    (indices, _) = indexes[0].nearest(query, 3, nprobe=4)
+    assert indices[0] == 7
@@ -0,0 +1,129 @@
+'''
+Tests the code in snapshot.py
+'''
+
+import numpy
+
+from doppelganger import (
+    db,
+    ivf,
+    quantized,
+    sharded,
+    snapshot,
+)
+
+
+def put_employee(database, dsid):
+    '''
+    Puts one employee into the database
+    '''
+    database.put(db.Entry(
+        dsid=dsid,
+        name='Employee {}'.format(dsid),
+        facial_encoding=numpy.full(128, dsid / 10.0),
+        picture=b'jpeg',
+    ))
+
+
+def test_refresh_swaps_on_change(tmpdir):
+    '''
+    A changed database gets a new snapshot, while whoever held on to the
+    old one still sees it as it was
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    database = db.Database(path)
+    put_employee(database, 1)
+
+    # A long interval keeps the background thread out of the way
+    refresher = snapshot.Refresher(path, interval=3600)
+    old = refresher.get()
+    assert list(old.matrix.dsids) == [1]
+    assert old.searcher is old.matrix
+
+    assert not refresher.refresh(database)
+    assert refresher.get() is old
+
+    put_employee(database, 2)
+    assert refresher.refresh(database)
+
+    new = refresher.get()
+    assert new.version != old.version
+    assert sorted(new.matrix.dsids) == [1, 2]
+    assert list(old.matrix.dsids) == [1]
+
+
+def test_background_refresh(tmpdir):
+    '''
+    The background thread picks up changes on its own
+    '''
+    import time
+    path = str(tmpdir.join('doppelganger.db'))
+    database = db.Database(path)
+    put_employee(database, 1)
+
+    refresher = snapshot.Refresher(path, interval=0.01)
+    put_employee(database, 2)
+
+    deadline = time.time() + 5
+    while len(refresher.get().matrix) != 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(refresher.get().matrix) == 2
+
+
+def test_searcher_options(tmpdir):
+    '''
+    Without an index, candidates picks the quantized search, and shards
+    splits whichever search it is across threads
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    database = db.Database(path)
+    put_employee(database, 1)
+
+    loaded = snapshot.load(database, path, candidates=16)
+    assert isinstance(loaded.searcher, quantized.QuantizedMatrix)
+    assert loaded.searcher.matrix is loaded.matrix
+
+    loaded = snapshot.load(database, path, candidates=16, shards=4)
+    assert isinstance(loaded.searcher, sharded.ShardedSearcher)
+    assert isinstance(loaded.searcher.matrix, quantized.QuantizedMatrix)
+
+
+def test_index_only_with_nprobe(tmpdir):
+    '''
+    An index next to the database is only searched when nprobe asks for
+    it, and otherwise the other options still apply
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    database = db.Database(path)
+    for dsid in range(1, 5):
+        put_employee(database, dsid)
+    matrix = snapshot.load(database, path).matrix
+    ivf.IVFIndex.train(matrix, 2).save(ivf.get_index_path(path))
+
+    loaded = snapshot.load(database, path, candidates=16)
+    assert isinstance(loaded.searcher, quantized.QuantizedMatrix)
+
+    loaded = snapshot.load(database, path, candidates=16, nprobe=1)
+    assert isinstance(loaded.searcher, ivf.IVFIndex)
+    assert loaded.searcher.nprobe == 1
+
+
+def test_refresh_waits_to_settle(tmpdir):
+    '''
+    A database that keeps changing isn't loaded until it stops
+    '''
+    path = str(tmpdir.join('doppelganger.db'))
+    database = db.Database(path)
+    put_employee(database, 1)
+    refresher = snapshot.Refresher(path, interval=3600, settle=3600)
+
+    put_employee(database, 2)
+    assert not refresher.refresh(database)
+    put_employee(database, 3)
+    assert not refresher.refresh(database)
+    assert len(refresher.get().matrix) == 1
+
+    # Long enough after the last change, as if settle seconds went by
+    refresher.pending = (refresher.pending[0], refresher.pending[1] - 3600)
+    assert refresher.refresh(database)
+    assert len(refresher.get().matrix) == 3
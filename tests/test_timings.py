@@ -0,0 +1,94 @@
+'''
+Tests the stage timing histograms
+'''
+
+from doppelganger import timings
+
+
+def test_disabled():
+    '''
+    Nothing is timed, or even allocated, until timing is turned on
+    '''
+    registry = timings.Registry()
+    assert registry.stage('detection') is timings.NULL_TIMER
+    with registry.stage('detection'):
+        pass
+    assert not registry.snapshot()
+
+    registry.enabled = True
+    with registry.stage('detection'):
+        pass
+    snapshot = registry.snapshot()
+    assert len(snapshot) == 1
+    (name, histogram) = snapshot[0]
+    assert name == 'detection'
+    assert histogram.count() == 1
+
+
+def test_histogram():
+    '''
+    Durations land in the first bucket at least as long as they are
+    '''
+    histogram = timings.Histogram()
+    for seconds in [0.001, 0.002, 0.003, 0.2, 20]:
+        histogram.observe(seconds)
+
+    assert histogram.counts[timings.BUCKETS.index(0.001)] == 1
+    assert histogram.counts[timings.BUCKETS.index(0.0025)] == 1
+    assert histogram.counts[timings.BUCKETS.index(0.005)] == 1
+    assert histogram.counts[timings.BUCKETS.index(0.25)] == 1
+    assert histogram.counts[-1] == 1
+    assert histogram.count() == 5
+    assert histogram.quantile(0.5) == 0.005
+    assert histogram.quantile(1) == 20
+
+    other = timings.Histogram()
+    other.observe(0.001)
+    histogram.merge(other)
+    assert histogram.counts[timings.BUCKETS.index(0.001)] == 2
+    assert histogram.total == 0.001 + 0.002 + 0.003 + 0.2 + 20 + 0.001
+
+
+def test_drain_merge():
+    '''
+    What one registry drains, another can merge, like across processes
+    '''
+    worker = timings.Registry()
+    worker.observe('encoding', 0.5)
+    worker.observe('encoding', 0.5)
+    parent = timings.Registry()
+    parent.observe('encoding', 0.1)
+
+    parent.merge(worker.drain())
+    assert not worker.snapshot()
+    snapshot = parent.snapshot()
+    assert len(snapshot) == 1
+    histogram = snapshot[0][1]
+    assert histogram.count() == 3
+    assert histogram.longest == 0.5
+
+
+def test_prometheus(monkeypatch):
+    '''
+    Buckets are cumulative and end with +Inf, as Prometheus expects
+    '''
+    registry = timings.Registry()
+    registry.observe('json', 0.003)
+    registry.observe('b64_decode', 0.00005)
+    registry.observe('b64_decode', 30)
+    monkeypatch.setattr(timings, 'REGISTRY', registry)
+
+    lines = timings.prometheus().splitlines()
+    assert lines[1] == '# TYPE doppelganger_stage_seconds histogram'
+    assert 'doppelganger_stage_seconds_bucket{stage="b64_decode",le="0.0001"} 1' in lines
+    assert 'doppelganger_stage_seconds_bucket{stage="b64_decode",le="10.0"} 1' in lines
+    assert 'doppelganger_stage_seconds_bucket{stage="b64_decode",le="+Inf"} 2' in lines
+    assert 'doppelganger_stage_seconds_count{stage="json"} 1' in lines
+
+    # Stages come in the order they happen in
+    stages = [line.split('"')[1] for line in lines[2:]]
+    assert stages.index('b64_decode') < stages.index('json')
+
+    table = timings.summary().splitlines()
+    assert len(table) == 3
+    assert table[1].split()[:2] == ['b64_decode', '2']
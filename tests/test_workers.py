@@ -0,0 +1,205 @@
+'''
+Tests the code in workers.py
+'''
+
+import base64
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy
+
+from mock import (
+    patch,
+    MagicMock,
+)
+
+from doppelganger import (
+    ml,
+    workers,
+)
+
+
+def make_employees(count):
+    '''
+    Builds fake ldap records whose jpeg is just the dsid
+    '''
+    return [
+        {
+            'cn': 'Employee {}'.format(dsid),
+            'appledsId': dsid,
+            'applePhotoOfficial-jpeg': base64.b64encode(str(dsid).encode()),
+        }
+        for dsid in range(count)
+    ]
+
+
+def fake_decode(image_bytes):
+    '''
+    Stands in for decoding: the image is just its number, and 13 is corrupt
+    '''
+    number = int(image_bytes)
+    if number == 13:
+        raise ValueError('Bad jpeg')
+    return number
+
+
+def fake_calculate(images, _pipeline, profile):
+    '''
+    Stands in for the pipeline: an encoding of the image's number, no faces
+    for multiples of five, and 17 breaks any batch it is in
+    '''
+    assert profile == 'fast'
+    if 17 in images:
+        raise RuntimeError('Bad face')
+    return [
+        [] if number % 5 == 0
+        else [ml.PipelineResult(None, None, numpy.full(128, number))]
+        for number in images
+    ]
+
+
+@patch('doppelganger.workers.ml.calculate_encodings_for_images', fake_calculate)
+@patch('doppelganger.workers.ml.decode_image', fake_decode)
+@patch('doppelganger.workers.ml.get_pipeline', MagicMock())
+def check_encode_employees(worker_count):
+    '''
+    Every employee comes back once with their own encodings, or an error
+    '''
+    results = list(workers.encode_employees(
+        make_employees(40),
+        worker_count,
+        'fast',
+    ))
+    assert len(results) == 40
+
+    for (employee, encodings, error) in results:
+        dsid = employee['appledsId']
+        if dsid == 13:
+            assert encodings is None
+            assert 'Bad jpeg' in error
+        elif dsid == 17:
+            assert encodings is None
+            assert 'Bad face' in error
+        elif dsid % 5 == 0:
+            assert encodings == []
+            assert error is None
+        else:
+            assert len(encodings) == 1
+            assert encodings[0][0] == dsid
+            assert error is None
+
+
+def test_encode_in_process():
+    '''
+    A single worker encodes everything in this process
+    '''
+    check_encode_employees(1)
+
+
+def test_encode_in_pool():
+    '''
+    Several workers encode across processes, and a failure doesn't stop them
+    '''
+    check_encode_employees(3)
+
+
+def run_briefly(function, seconds=30):
+    '''
+    Runs function on a thread, so that a hang fails the test instead of
+    stopping the suite, and returns the exception it raised, if any
+    '''
+    raised = []
+
+    def run():
+        '''
+        Calls function, keeping what it raises
+        '''
+        try:
+            function()
+        except Exception as error:  # pylint: disable=broad-except
+            raised.append(error)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive()
+    return raised[0] if raised else None
+
+
+def slow_calculate(images, _pipeline, _profile):
+    '''
+    Stands in for a pipeline slow enough that the pool stays full
+    '''
+    time.sleep(0.1)
+    return [[] for _ in images]
+
+
+@patch('doppelganger.workers.ml.calculate_encodings_for_images', slow_calculate)
+@patch('doppelganger.workers.ml.decode_image', fake_decode)
+@patch('doppelganger.workers.ml.get_pipeline', MagicMock())
+def test_encode_in_pool_stops_early():
+    '''
+    Stopping before the end, as when writing the results fails, doesn't
+    wait on the rest of the employees
+    '''
+    results = workers.encode_in_pool(make_employees(1000), 2, 'fast')
+    next(results)
+    time.sleep(0.5)
+    assert run_briefly(results.close) is None
+
+
+def dying_calculate(images, _pipeline, _profile):
+    '''
+    Stands in for a pipeline that crashes its whole process on image 7
+    '''
+    if 7 in images:
+        os._exit(1)  # pylint: disable=protected-access
+    return [[] for _ in images]
+
+
+@patch('doppelganger.workers.ml.calculate_encodings_for_images', dying_calculate)
+@patch('doppelganger.workers.ml.decode_image', fake_decode)
+@patch('doppelganger.workers.ml.get_pipeline', MagicMock())
+def test_encode_in_pool_worker_dies():
+    '''
+    A worker dying outright stops the run instead of hanging it
+    '''
+    employees = make_employees(40)
+    error = run_briefly(lambda: list(workers.encode_in_pool(employees, 2, 'fast')))
+    assert isinstance(error, BrokenProcessPool)
+
+
+@patch('doppelganger.workers.ml.get_pipeline', MagicMock(side_effect=IOError('No model')))
+def test_encode_in_pool_no_pipeline():
+    '''
+    Workers that can't load the pipeline stop the run instead of being
+    started again forever
+    '''
+    employees = make_employees(40)
+    error = run_briefly(lambda: list(workers.encode_in_pool(employees, 2, 'fast')))
+    assert isinstance(error, BrokenProcessPool)
+
+
+def test_chunk():
+    '''
+    Chunks should cover everything in order, with a short last chunk
+    '''
+    assert list(workers.chunk(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert not list(workers.chunk([], 2))
+
+
+def test_progress():
+    '''
+    Checks that progress counts failures and images without faces
+    '''
+    progress = workers.Progress()
+    progress.record([MagicMock()], None)
+    progress.record([], None)
+    progress.record(None, 'Broken')
+    assert progress.done == 3
+    assert progress.faceless == 1
+    assert progress.failed == 1
+    assert progress.rate() > 0